@@ -2,6 +2,9 @@ import argparse
 import os, csv
 from pathlib import Path
 from PIL import Image
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.fast_decode import draft_open
 from numpy import savetxt
 import torch.nn as nn
 
@@ -16,6 +19,8 @@ def parse_args():
     parser.add_argument('--seeds', type=int, required=False, default=0,
                         help="random seed")
     parser.add_argument('--img_size', type=int, required=False, default=512, help="Image Size")
+    parser.add_argument('--draft_decode', action='store_true',
+                        help="decode JPEGs at the smallest 1/2, 1/4 or 1/8 scale still at least img_size")
     args = parser.parse_args()
     return args
 
@@ -63,7 +68,7 @@ EVAL_MODEL = '../../models/' + model_name + '_' + str(args.seeds) + ".pth"
 img_size = args.img_size
 
 # Load the model for evaluation
-model = torch.load(EVAL_MODEL)
+model = torch.load(EVAL_MODEL, weights_only=False)
 model.eval()
 
 
@@ -94,7 +99,10 @@ for class_name in class_names:
     image_list = []
 
     for img in images:
-        image = Image.open(img).convert('RGB')
+        if args.draft_decode:
+            image = draft_open(img, img_size)
+        else:
+            image = Image.open(img).convert('RGB')
         inputs = preprocess(image)
         image_list.append(inputs)
 
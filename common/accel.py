@@ -0,0 +1,157 @@
+"""
+channels_last memory format and graph compilation for the model zoo.
+
+`accelerate_model` converts the model to channels_last and/or compiles it with
+`torch.compile`. Compilation is triggered right away on synthetic batches, for
+the training step and the evaluation forward and for a second batch size (the
+last, partial batch of an epoch recompiles for dynamic shapes), so that
+architectures that fail to compile fall back to eager execution here, with the
+reason logged, instead of crashing in the middle of training. A compilation
+that still fails later (a shape or mode not seen during the warm-up) switches
+the model to eager execution from that call on. The
+compile time and the steady-state step time of the eager and compiled models
+are measured and appended to compile_performance.csv, together with the number
+of steps after which compiling pays off.
+"""
+import os
+import csv
+import copy
+import time
+
+import torch
+
+CSV_FILE = 'compile_performance.csv'
+
+
+def to_channels_last(inputs, enabled=True):
+    return inputs.contiguous(memory_format=torch.channels_last) if enabled else inputs
+
+
+def unwrap(model):
+    """The eager module behind a compiled one (what should be saved with torch.save)."""
+    return getattr(model, '_orig_mod', model)
+
+
+def compile_error(model_name, e):
+    print('Compiling {} failed, falling back to eager execution: {}: {}'.format(
+        model_name, type(e).__name__, str(e).splitlines()[0] if str(e) else ''))
+
+
+class CompiledModel(torch.nn.Module):
+    """Compiled model that runs its eager module once a compilation fails.
+
+    The eager module is `_orig_mod`, as in the module returned by torch.compile, so the
+    state dict keys and `unwrap` are the same.
+    """
+
+    def __init__(self, model, compiled, model_name):
+        super(CompiledModel, self).__init__()
+        self._orig_mod = model
+        # not a registered submodule: its parameters are those of _orig_mod
+        self.__dict__['compiled'] = compiled
+        self.model_name = model_name
+
+    def forward(self, *args, **kwargs):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as e:
+                compile_error(self.model_name, e)
+                self.__dict__['compiled'] = None
+        return self._orig_mod(*args, **kwargs)
+
+
+def time_steps(model, step, num_steps):
+    since = time.time()
+    for _ in range(num_steps):
+        step(model)
+    return (time.time() - since) / num_steps
+
+
+def accelerate_model(model, model_name, input_size, device, channels_last=False, compile=False,
+                     train=True, num_steps=3, steps_per_epoch=None):
+    """Return the model converted/compiled as requested, falling back to eager if compilation fails.
+
+    `steps_per_epoch` turns the break-even step count into a number of epochs in the log.
+    """
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if not compile:
+        return model
+    if not hasattr(torch, 'compile'):
+        print('torch.compile is not available in this PyTorch, running {} eagerly'.format(model_name))
+        return model
+
+    g = torch.Generator()
+    g.manual_seed(0)
+    bs = input_size[0]
+    # a second batch size, large enough for BatchNorm in train mode
+    other_size = (bs // 2 if bs >= 4 else bs + 1,) + tuple(input_size[1:])
+    batches = [(to_channels_last(torch.randn(*size, generator=g).to(device), channels_last),
+                torch.zeros(size[0], dtype=torch.long, device=device)) for size in [input_size, other_size]]
+    criterion = torch.nn.CrossEntropyLoss()
+
+    def step(m, train=train, batch=0):
+        inputs, labels = batches[batch]
+        if train:
+            m.train()
+            m.zero_grad()
+            outputs = m(inputs)
+            criterion(outputs, labels).backward()
+        else:
+            m.eval()
+            with torch.no_grad():
+                m(inputs)
+
+    def warm_up(m):
+        # every graph the run will need: train step and eval forward, at both batch sizes
+        for mode in ([True, False] if train else [False]):
+            for batch in range(len(batches)):
+                step(m, mode, batch)
+        m.train(train)
+
+    # warm-up steps must not leave any trace in the weights, BN statistics or RNG streams
+    state = copy.deepcopy(model.state_dict())
+    rng_state = torch.get_rng_state()
+    model.train(train)
+    eager_step = time_steps(model, step, num_steps)
+    compiled = torch.compile(model)
+    try:
+        since = time.time()
+        warm_up(compiled)
+        warm_up_time = time.time() - since
+    except Exception as e:
+        compile_error(model_name, e)
+        compiled = None
+    if compiled is not None:
+        compiled_step = time_steps(compiled, step, num_steps)
+        compile_time = max(warm_up_time - compiled_step, 0.0)
+        saved = eager_step - compiled_step
+        break_even = int(compile_time / saved) + 1 if saved > 0 else ''
+        break_even_epochs = ''
+        if break_even != '' and steps_per_epoch:
+            break_even_epochs = '{:.2f}'.format(break_even / steps_per_epoch)
+        print('{} compiled in {:.1f}s, step {:.3f}s eager vs {:.3f}s compiled, pays off after {} steps {}'.format(
+            model_name, compile_time, eager_step, compiled_step, break_even if break_even != '' else 'no',
+            '({} epochs)'.format(break_even_epochs) if break_even_epochs else ''))
+        record(model_name, 'train' if train else 'eval', input_size, channels_last, compile_time,
+               eager_step, compiled_step, break_even, break_even_epochs)
+    model.load_state_dict(state)
+    model.zero_grad()
+    torch.set_rng_state(rng_state)
+    return CompiledModel(model, compiled, model_name) if compiled is not None else model
+
+
+def record(model_name, mode, input_size, channels_last, compile_time, eager_step, compiled_step, break_even,
+           break_even_epochs=''):
+    if not os.path.isfile(CSV_FILE):
+        with open(CSV_FILE, mode='w') as csv_file:
+            fieldnames = ['Model', 'Mode', 'Batch Size', 'Image Size', 'Channels Last', 'Compile Time (s)',
+                          'Eager Step (s)', 'Compiled Step (s)', 'Break-even Steps', 'Break-even Epochs']
+            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+            writer.writeheader()
+    with open(CSV_FILE, 'a+', newline='') as write_obj:
+        csv_writer = csv.writer(write_obj)
+        csv_writer.writerow([model_name, mode, input_size[0], input_size[-1], channels_last,
+                             '{:.2f}'.format(compile_time), '{:.4f}'.format(eager_step),
+                             '{:.4f}'.format(compiled_step), break_even, break_even_epochs])
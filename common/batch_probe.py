@@ -0,0 +1,155 @@
+"""
+Largest micro-batch probing for gradient accumulation.
+
+`probe_max_batch` runs forward + backward passes of the model at doubling
+batch sizes and keeps the largest one whose peak memory stays within a
+fraction of the memory available on the device (RAM on CPU). It stops before
+trying a size whose extrapolated peak would not fit, so the probe itself does
+not get the process killed. The result is cached per host, model, image size,
+precision, activation checkpointing (and its number of segments) and memory
+format in batch_probe.json.
+"""
+import os
+import gc
+import copy
+import json
+import socket
+
+import torch
+
+CACHE_FILE = 'batch_probe.json'
+
+
+def probe_key(model_name, img_size, precision='fp32', checkpoint_segments=0, channels_last=False):
+    """Cache key of a probe; `checkpoint_segments` is 0 without activation checkpointing."""
+    return '{}/{}/{}/{}/{}/{}'.format(socket.gethostname(), model_name, img_size, precision,
+                                      'ckpt{}'.format(checkpoint_segments) if checkpoint_segments else 'stored',
+                                      'channels_last' if channels_last else 'contiguous')
+
+
+def read_status(field):
+    """Value of a /proc/self/status field in bytes (Linux), 0 if unavailable."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        try:
+            # resets VmHWM, the peak resident set size of the process
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+
+
+def peak_memory(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    return read_status('VmHWM')
+
+
+def current_memory(device):
+    if device.type == 'cuda':
+        return torch.cuda.memory_allocated(device)
+    return read_status('VmRSS')
+
+
+def memory_budget(device, fraction):
+    if device.type == 'cuda':
+        return fraction * torch.cuda.get_device_properties(device).total_memory
+    available = 0
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                available = int(line.split()[1]) * 1024
+    return fraction * (available + current_memory(device))
+
+
+def probe_max_batch(model, img_size, device, limit, key, precision='fp32', memory_fraction=0.8,
+                    cache_file=CACHE_FILE, channels_last=False):
+    """Largest batch size (powers of two, then `limit` itself) whose training step fits in memory.
+
+    With `channels_last` the model is converted in place and the probe batches are channels_last.
+    """
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    if key in cache:
+        print('Largest micro-batch for {} (cached): {}'.format(key, cache[key]))
+        return min(cache[key], limit)
+
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    state = copy.deepcopy(model.state_dict())
+    rng_state = torch.get_rng_state()
+    criterion = torch.nn.CrossEntropyLoss()
+    budget = memory_budget(device, memory_fraction)
+    model.train()
+
+    print('Probing the largest micro-batch for {} (budget {:.1f} GB) ...'.format(key, budget / 2 ** 30))
+    fits, batch_size, memory_bound = 0, 1, False
+    while True:
+        gc.collect()
+        base = current_memory(device)
+        reset_peak_memory(device)
+        try:
+            inputs = torch.randn(batch_size, 3, img_size, img_size, device=device)
+            if channels_last:
+                inputs = inputs.contiguous(memory_format=torch.channels_last)
+            labels = torch.zeros(batch_size, dtype=torch.long, device=device)
+            model.zero_grad()
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=precision == 'bf16'):
+                loss = criterion(model(inputs), labels)
+            loss.backward()
+            del inputs, labels, loss
+        except RuntimeError as e:
+            if 'memory' not in str(e).lower() and 'alloc' not in str(e).lower():
+                raise
+            memory_bound = True
+            break
+        peak = peak_memory(device)
+        print('  batch {}: peak {:.2f} GB'.format(batch_size, peak / 2 ** 30))
+        if peak > budget:
+            memory_bound = True
+            break
+        fits = batch_size
+        if batch_size == limit:
+            break
+        next_size = min(2 * batch_size, limit)
+        # do not try a size that would not fit if memory grows linearly with the batch
+        if base + next_size / batch_size * (peak - base) > budget:
+            memory_bound = True
+            break
+        batch_size = next_size
+
+    model.load_state_dict(state)
+    model.zero_grad()
+    torch.set_rng_state(rng_state)
+    gc.collect()
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+
+    fits = max(fits, 1)
+    if memory_bound:
+        # only a real memory limit is worth caching, not the target we were asked for
+        cache[key] = fits
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+    print('Largest micro-batch for {}: {}'.format(key, fits))
+    return fits
+
+
+def micro_batch_for(effective_batch_size, max_batch_size):
+    """(micro-batch, accumulation steps) reaching exactly `effective_batch_size` with micro-batches that fit."""
+    micro = max(d for d in range(1, min(effective_batch_size, max_batch_size) + 1) if effective_batch_size % d == 0)
+    return micro, effective_batch_size // micro
@@ -0,0 +1,58 @@
+"""
+Batched augmentation on uint8 image batches.
+
+The DataLoader workers only crop/resize and hand over uint8 CHW tensors (a
+quarter of the float32 bytes through shared memory). Random flips, the float
+cast and the normalization are then applied once per batch on the compute
+device instead of once per image in every worker.
+"""
+import torch
+from torchvision import transforms
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def uint8_transforms(img_size, is_augmentation=True):
+    """Per-sample part of the usual pipelines, stopping before ToTensor/Normalize."""
+    if is_augmentation:
+        train = transforms.Compose([
+            transforms.RandomResizedCrop(size=img_size),
+            transforms.PILToTensor()
+        ])
+    else:
+        train = transforms.Compose([
+            transforms.Resize(size=img_size),
+            transforms.PILToTensor()
+        ])
+    valid = transforms.Compose([
+        transforms.Resize(size=img_size),
+        transforms.CenterCrop(size=img_size),
+        transforms.PILToTensor()
+    ])
+    return {'train': train, 'valid': valid}
+
+
+class BatchAugment(object):
+    """Random horizontal flip + cast + Normalize for a uint8 NCHW batch.
+
+    Flip decisions are drawn from `generator` on the CPU, so the stream is
+    reproducible per seed whatever the device or the number of workers.
+    """
+
+    def __init__(self, flip=False, mean=MEAN, std=STD, generator=None):
+        self.flip = flip
+        self.generator = generator
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1) * 255
+        self.inv_std = 1.0 / (torch.tensor(std).view(1, -1, 1, 1) * 255)
+
+    def __call__(self, batch):
+        if self.flip:
+            mask = torch.rand(batch.size(0), generator=self.generator) < 0.5
+            mask = mask.view(-1, 1, 1, 1).to(batch.device, non_blocking=True)
+            # flip while still uint8, a quarter of the bytes of the float batch
+            batch = torch.where(mask, batch.flip(3), batch)
+        if self.mean.device != batch.device:
+            self.mean = self.mean.to(batch.device)
+            self.inv_std = self.inv_std.to(batch.device)
+        return batch.float().sub_(self.mean).mul_(self.inv_std)
@@ -0,0 +1,85 @@
+"""
+Benchmark full-resolution vs reduced-size (draft) JPEG decoding.
+
+Decodes the images of a split through the evaluation transform with both
+loaders and reports images/sec. If a trained model is given, the accuracy on
+the split is measured with both loaders as well. One row per loader is
+appended to decode_benchmark.csv.
+"""
+import os
+import csv
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import torch
+from torchvision import datasets, transforms
+import torch.utils.data as data
+from common.fast_decode import DraftLoader
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark JPEG decoding for the CottonWeed pipelines')
+    parser.add_argument('--data_dir', type=str, required=False,
+                        default='/home/dong9/PycharmProjects/CottonWeeds/DATASET/DATA_0/test',
+                        help="image folder to decode (e.g. the test split)")
+    parser.add_argument('--model_path', type=str, required=False, default=None,
+                        help="trained model (.pth) to also compare accuracy, optional")
+    parser.add_argument('--img_size', type=int, required=False, default=512, help="Image Size")
+    parser.add_argument('--batch_size', type=int, required=False, default=8, help="Batch size")
+    parser.add_argument('--num_workers', type=int, required=False, default=0,
+                        help="DataLoader workers (0 measures single-core decode throughput)")
+    return parser.parse_args()
+
+
+def run(loader_name, loader, args, model, device):
+    transform = transforms.Compose([
+        transforms.Resize(size=args.img_size),
+        transforms.CenterCrop(size=args.img_size),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406],
+                             [0.229, 0.224, 0.225])])
+    dataset = datasets.ImageFolder(root=args.data_dir, transform=transform, loader=loader)
+    dataloader = data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+
+    decode_time = 0.0
+    correct = 0
+    since = time.time()
+    with torch.no_grad():
+        for images, labels in dataloader:
+            decode_time += time.time() - since
+            if model is not None:
+                outputs = model(images.to(device))
+                correct += (outputs.argmax(1).cpu() == labels).sum().item()
+            since = time.time()
+
+    images_per_sec = len(dataset) / decode_time
+    accuracy = 100 * correct / len(dataset) if model is not None else ''
+    print('{:>6}: {:.1f} images/s, accuracy {}'.format(loader_name, images_per_sec, accuracy))
+    return [loader_name, args.data_dir, args.img_size, len(dataset), '{:.2f}'.format(images_per_sec), accuracy]
+
+
+def main():
+    args = parse_args()
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model = None
+    if args.model_path:
+        model = torch.load(args.model_path, map_location=device, weights_only=False)
+        model.eval()
+
+    rows = [run('full', datasets.folder.default_loader, args, model, device),
+            run('draft', DraftLoader(args.img_size), args, model, device)]
+
+    if not os.path.isfile('decode_benchmark.csv'):
+        with open('decode_benchmark.csv', mode='w') as csv_file:
+            fieldnames = ['Loader', 'Data', 'Image Size', 'Images', 'Images/s', 'Accuracy']
+            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+            writer.writeheader()
+    with open('decode_benchmark.csv', 'a+', newline='') as write_obj:
+        csv_writer = csv.writer(write_obj)
+        csv_writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Best-model tracking without a new allocation per improvement.
+
+`copy.deepcopy(model.state_dict())` allocates a fresh copy of every parameter
+and buffer each time the validation accuracy improves. `BestWeights`
+allocates one shadow buffer per state_dict entry once, on the model's device,
+and every improvement copies into them in place. With `path`, the shadows live
+in one memory-mapped file instead, so very large models do not keep a second
+resident copy of their weights; the kernel writes the pages back and evicts
+them as needed.
+"""
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+ALIGNMENT = 64
+
+
+class BestWeights(object):
+    """In-place shadow copy of a model's state_dict, initialized with the current weights."""
+
+    def __init__(self, model, path=None):
+        state = model.state_dict()
+        self.path = path
+        if path is None:
+            self.shadow = OrderedDict((name, torch.empty_like(t)) for name, t in state.items())
+        else:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            offsets, size = [], 0
+            for t in state.values():
+                offsets.append(size)
+                size += (t.numel() * t.element_size() + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+            self._buffer = np.memmap(path, dtype=np.uint8, mode='w+', shape=(max(size, 1),))
+            # byte views of the file reinterpreted with the dtype and shape of each entry
+            self.shadow = OrderedDict(
+                (name, torch.from_numpy(self._buffer[offset:offset + t.numel() * t.element_size()])
+                 .view(t.dtype).view(t.shape))
+                for (name, t), offset in zip(state.items(), offsets))
+        self.nbytes = sum(t.numel() * t.element_size() for t in self.shadow.values())
+        self.update(model)
+
+    def update(self, model):
+        """Copy the current weights into the shadow buffers, return the seconds it took."""
+        since = time.time()
+        with torch.no_grad():
+            for name, t in model.state_dict().items():
+                self.shadow[name].copy_(t)
+        if self.shadow and next(iter(self.shadow.values())).is_cuda:
+            torch.cuda.synchronize()
+        return time.time() - since
+
+    def load_state_dict(self, state_dict):
+        """Overwrite the shadows, e.g. with the best weights of a resumed checkpoint."""
+        with torch.no_grad():
+            for name, t in state_dict.items():
+                self.shadow[name].copy_(t)
+
+    def state_dict(self):
+        return self.shadow
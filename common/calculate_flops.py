@@ -1,6 +1,5 @@
 import torchvision.models as models
 import torch
-from ptflops import get_model_complexity_info
 """no random rotation"""
 import csv
 import argparse
@@ -24,6 +23,8 @@ def parse_args():
     parser.add_argument('--epochs', type=int, required=False, default=50, help="Training Epochs")
     parser.add_argument('--batch_size', type=int, required=False, default=12, help="Training batch size")
     parser.add_argument('--img_size', type=int, required=False, default=512, help="Image Size")
+    parser.add_argument('--weight_store', type=str, required=False, default=None,
+                        help="memory-map the pretrained weights from this offline store (python -m common.weight_store)")
     parser.add_argument('--use_weighting', type=bool, required=False, default=False, help="use weighted cross entropy or not")
     args = parser.parse_args()
     return args
@@ -57,15 +58,14 @@ g.manual_seed(args.seeds)
 
 from torchvision import datasets, models, transforms
 import torch.utils.data as data
-from torch.utils.tensorboard import SummaryWriter
 import torch.optim as optim
 from torch.optim import lr_scheduler
 import torch.nn as nn
-from torchsummary import summary
 import time, copy
 import multiprocessing
-import pretrainedmodels  # for inception-v4 and xception
-from efficientnet_pytorch import EfficientNet
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.model_zoo import MODELS, build_model, input_size
 
 
 num_classes = args.num_classes
@@ -143,122 +143,14 @@ print("\nLoading pretrained-model for finetuning ...\n")
 model_ft = None
 
 
-if model_name == 'resnet18':
-    # Modify fc layers to match num_classes
-    model_ft = models.resnet18(pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'resnet50':
-    # Modify fc layers to match num_classes
-    model_ft = models.resnet50(pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'resnet101':
-    # Modify fc layers to match num_classes
-    model_ft = models.resnet101(pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'alexnet':
-    model_ft = models.alexnet(pretrained=True)
-    model_ft.classifier[6] = nn.Linear(4096, num_classes)
-elif model_name == 'vgg11':
-    model_ft = models.vgg11(pretrained=True)
-    model_ft.classifier[6] = nn.Linear(4096, num_classes)
-elif model_name == 'vgg16':
-    model_ft = models.vgg16(pretrained=True)
-    model_ft.classifier[6] = nn.Linear(4096, num_classes)
-elif model_name == 'vgg19':
-    model_ft = models.vgg19(pretrained=True)
-    model_ft.classifier[6] = nn.Linear(4096, num_classes)
-elif model_name == 'squeezenet':
-    model_ft = models.squeezenet1_0(pretrained=True)
-    model_ft.classifier[1] = nn.Conv2d(512, num_classes, kernel_size=(1, 1), stride=(1, 1))
-elif model_name == 'densenet121':
-    model_ft = models.densenet121(pretrained=True)
-    num_ftrs = model_ft.classifier.in_features
-    model_ft.classifier = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'densenet169':
-    model_ft = models.densenet169(pretrained=True)
-    num_ftrs = model_ft.classifier.in_features
-    model_ft.classifier = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'densenet161':
-    model_ft = models.densenet161(pretrained=True)
-    num_ftrs = model_ft.classifier.in_features
-    model_ft.classifier = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'inception':
-    model_ft = models.inception_v3(pretrained=True)
-    model_ft.aux_logits = False
-    # Handle the auxilary net
-    num_ftrs = model_ft.AuxLogits.fc.in_features
-    model_ft.AuxLogits.fc = nn.Linear(num_ftrs, num_classes)
-    # Handle the primary net
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'inceptionv4':
-    model_ft = pretrainedmodels.inceptionv4(pretrained='imagenet')
-    num_ftrs = model_ft.last_linear.in_features
-    model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'googlenet':
-    model_ft = models.googlenet(pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'xception':
-    model_ft = pretrainedmodels.xception(pretrained='imagenet')
-    num_ftrs = model_ft.last_linear.in_features
-    model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'mobilenet_v2':
-    model_ft = models.mobilenet_v2(pretrained=True)
-    model_ft.classifier[1] = nn.Linear(model_ft.last_channel, num_classes)
-elif model_name == 'mobilenet_v3_small':
-    model_ft = models.mobilenet_v3_small(pretrained=True)
-    model_ft.classifier[3] = nn.Linear(model_ft.classifier[3].in_features, num_classes)
-elif model_name == 'mobilenet_v3_large':
-    model_ft = models.mobilenet_v3_large(pretrained=True)
-    model_ft.classifier[3] = nn.Linear(model_ft.classifier[3].in_features, num_classes)
-elif model_name == 'shufflenet_v2_x0_5':
-    model_ft = models.shufflenet_v2_x0_5(pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'shufflenet_v2_x1_0':
-    model_ft = models.shufflenet_v2_x1_0(pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'inceptionresnetv2':
-    model_ft = pretrainedmodels.inceptionresnetv2(pretrained='imagenet')
-    num_ftrs = model_ft.last_linear.in_features
-    model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'nasnetamobile':
-    model_ft = pretrainedmodels.nasnetamobile(num_classes=1000, pretrained='imagenet')
-    num_ftrs = model_ft.last_linear.in_features
-    model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'dpn68':
-    model_ft = pretrainedmodels.dpn68(pretrained='imagenet')
-    model_ft.last_linear = nn.Conv2d(832, num_classes, kernel_size=(1, 1), stride=(1, 1))
-elif model_name == 'polynet':
-    model_ft = pretrainedmodels.polynet(num_classes=1000, pretrained='imagenet')
-    num_ftrs = model_ft.last_linear.in_features
-    model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'mnasnet1_0':
-    model_ft = models.mnasnet1_0(pretrained=True)
-    num_ftrs = model_ft.classifier[1].in_features
-    model_ft.classifier[1] = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'efficientnet-b0':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b0', num_classes=num_classes)
-elif model_name == 'efficientnet-b1':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b1', num_classes=num_classes)
-elif model_name == 'efficientnet-b2':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b2', num_classes=num_classes)
-elif model_name == 'efficientnet-b3':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b3', num_classes=num_classes)
-elif model_name == 'efficientnet-b4':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b4', num_classes=num_classes)
-elif model_name == 'efficientnet-b5':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b5', num_classes=num_classes)
-elif model_name == 'efficientnet-b6':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b6', num_classes=num_classes)
-else:
+if model_name not in MODELS:
     print("Invalid model name, exiting...")
     exit()
+weight_store = None
+if args.weight_store:
+    from common.weight_store import WeightStore
+    weight_store = WeightStore(args.weight_store)
+model_ft = build_model(model_name, num_classes, weight_store)
 
 # Transfer the model to GPU
 # Set default device as gpu, if available
@@ -266,9 +158,17 @@ device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 # model_ft = nn.DataParallel(model_ft)
 model_ft = model_ft.to(device)
 
+
+def complexity(model, model_name):
+    """(MACs, parameters) of `model` at the native input size of `model_name`, as strings."""
+    # ptflops is only needed here, importing the module does not require it
+    from ptflops import get_model_complexity_info
+    size = input_size(model_name, 224)
+    return get_model_complexity_info(model, (3, size, size), as_strings=True, print_per_layer_stat=True, verbose=True)
+
+
 with torch.cuda.device(0):
-  macs, params = get_model_complexity_info(model_ft, (3, 224, 224), as_strings=True,
-                                           print_per_layer_stat=True, verbose=True)
+  macs, params = complexity(model_ft, model_name)
   print('{:<30}  {:<8}'.format('Computational complexity: ', macs))
   print('{:<30}  {:<8}'.format('Number of parameters: ', params))
 
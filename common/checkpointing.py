@@ -0,0 +1,184 @@
+"""
+Activation checkpointing for the sequential feature stages of the model zoo.
+
+`checkpoint_activations` replaces the nn.Sequential stages of a model (the
+residual stages of ResNet/ResNeXt/RepVGG, the `features` of DenseNet/VGG/
+MobileNet, the repeated blocks of Inception-ResNet-v2 and PolyNet, ...) by
+`CheckpointedSequential`, which splits them into `segments` chunks and keeps
+only the chunk boundaries during the forward pass; the activations inside a
+chunk are recomputed during backward. The parameter names do not change, so
+saved models load into the plain architecture.
+
+A recomputed chunk runs its BatchNorm layers in train mode a second time;
+their running statistics are put back afterwards, so they are updated once per
+step as without checkpointing.
+
+`checkpoint_report` measures the peak resident memory (peak allocated memory
+on GPU) and the step time of one training step with and without
+checkpointing and appends them to checkpoint_performance.csv.
+"""
+import os
+import csv
+import gc
+import copy
+import time
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+from common.batch_probe import reset_peak_memory, peak_memory
+from common.model_zoo import MODELS
+
+CSV_FILE = 'checkpoint_performance.csv'
+
+
+def norm_buffers(modules):
+    """Running statistics of the BatchNorm layers in `modules`."""
+    return [buffer for module in modules for m in module.modules()
+            if isinstance(m, nn.modules.batchnorm._BatchNorm) for buffer in m.buffers(recurse=False)]
+
+
+def run_segment(modules):
+    """Forward of `modules` that leaves the BatchNorm statistics untouched when it is recomputed in backward."""
+    calls = []
+
+    def run(input):
+        with torch.no_grad():
+            stash = [(buffer, buffer.clone()) for buffer in norm_buffers(modules)] if calls else []
+        calls.append(None)
+        try:
+            for module in modules:
+                input = module(input)
+        finally:
+            # the recomputation stops early, by an exception, once it has what backward needs
+            with torch.no_grad():
+                for buffer, value in stash:
+                    buffer.copy_(value)
+        return input
+    return run
+
+
+class CheckpointedSequential(nn.Sequential):
+    """nn.Sequential that recomputes the activations inside its segments during backward."""
+
+    def __init__(self, modules, segments=2):
+        super(CheckpointedSequential, self).__init__(modules)
+        self.segments = min(segments, len(modules))
+        self.checkpointing = True
+
+    def forward(self, input):
+        if not (self.checkpointing and self.training and torch.is_grad_enabled()):
+            return super(CheckpointedSequential, self).forward(input)
+        # the segments of checkpoint_sequential: the last one keeps its activations, it is not recomputed
+        modules = list(self.children())
+        size = len(modules) // self.segments
+        end = 0
+        for start in range(0, size * (self.segments - 1), size):
+            end = start + size
+            input = checkpoint(run_segment(modules[start:end]), input, use_reentrant=False)
+        for module in modules[end:]:
+            input = module(input)
+        return input
+
+
+def stage_names(model, model_name):
+    """Names of the direct children of `model` to checkpoint."""
+    if model_name in MODELS and MODELS[model_name].stages:
+        return [n for n in MODELS[model_name].stages if isinstance(getattr(model, n, None), nn.Sequential)]
+    # unknown architecture: every sequential child with several blocks
+    return [n for n, m in model.named_children() if isinstance(m, nn.Sequential) and len(m) > 1]
+
+
+def checkpoint_activations(model, model_name, segments=2):
+    """Wrap the sequential feature stages of `model` in place, return the names of the wrapped stages."""
+    names = stage_names(model, model_name)
+    for name in names:
+        stage = getattr(model, name)
+        setattr(model, name, CheckpointedSequential(OrderedDict(stage.named_children()), segments))
+    if names:
+        print('Activation checkpointing on {} ({} segments each)'.format(', '.join(names), segments))
+    else:
+        print('No sequential stage to checkpoint in {}, training without checkpointing'.format(model_name))
+    return names
+
+
+def remove_checkpointing(model):
+    """Undo `checkpoint_activations`, e.g. before saving a pickled model."""
+    for name, module in list(model.named_children()):
+        if isinstance(module, CheckpointedSequential):
+            setattr(model, name, nn.Sequential(OrderedDict(module.named_children())))
+    return model
+
+
+def set_checkpointing(model, enabled):
+    for module in model.modules():
+        if isinstance(module, CheckpointedSequential):
+            module.checkpointing = enabled
+
+
+def measure_step(model, inputs, labels, device, precision='fp32', num_steps=2):
+    """(peak memory in bytes, seconds per step) of forward + backward, after one warm-up step."""
+    criterion = nn.CrossEntropyLoss()
+
+    def step():
+        model.zero_grad()
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=precision == 'bf16'):
+            loss = criterion(model(inputs), labels)
+        loss.backward()
+
+    step()
+    gc.collect()
+    reset_peak_memory(device)
+    since = time.time()
+    for _ in range(num_steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return peak_memory(device), (time.time() - since) / num_steps
+
+
+def checkpoint_report(model, model_name, input_size, device, segments, precision='fp32'):
+    """Peak memory and step time of one training step with, then without, checkpointing.
+
+    The checkpointed step is measured first: memory freed by the larger step is
+    not always returned to the OS and would otherwise hide the saving on CPU.
+
+    `model` must already be wrapped by `checkpoint_activations`; its weights,
+    buffers and the global torch RNG are restored afterwards.
+    """
+    state = copy.deepcopy(model.state_dict())
+    rng_state = torch.get_rng_state()
+    g = torch.Generator()
+    g.manual_seed(0)
+    inputs = torch.randn(*input_size, generator=g).to(device)
+    labels = torch.zeros(input_size[0], dtype=torch.long, device=device)
+    model.train()
+
+    rows = []
+    for enabled in [True, False]:
+        set_checkpointing(model, enabled)
+        peak, step_time = measure_step(model, inputs, labels, device, precision)
+        print('{} checkpointing: peak memory {:.2f} GB, step {:.3f}s'.format(
+            'with' if enabled else 'without', peak / 2 ** 30, step_time))
+        rows.append([model_name, input_size[0], input_size[-1], precision, segments if enabled else 0,
+                     '{:.3f}'.format(peak / 2 ** 30), '{:.4f}'.format(step_time)])
+    set_checkpointing(model, True)
+
+    model.load_state_dict(state)
+    model.zero_grad()
+    torch.set_rng_state(rng_state)
+    record(rows)
+
+
+def record(rows):
+    if not os.path.isfile(CSV_FILE):
+        with open(CSV_FILE, mode='w') as csv_file:
+            fieldnames = ['Model', 'Batch Size', 'Image Size', 'Precision', 'Segments', 'Peak Memory (GB)',
+                          'Step Time (s)']
+            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+            writer.writeheader()
+    with open(CSV_FILE, 'a+', newline='') as write_obj:
+        csv_writer = csv.writer(write_obj)
+        csv_writer.writerows(rows)
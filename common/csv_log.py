@@ -0,0 +1,44 @@
+"""
+Result CSVs whose columns grow over time.
+
+The entry points append one row per run to their CSV (train_performance.csv,
+test_performance.csv, ...) and write the header only when the file is new.
+When a version adds columns, an existing file still carries the old header.
+`ensure_header` upgrades it instead of appending rows that no longer match:
+if the old columns are the first columns of the new header (columns are only
+ever appended), the file is rewritten with the new header and its rows are
+padded with empty cells; any other header is moved aside to <name>.<n>.csv
+and a new file is started.
+"""
+import os
+import csv
+
+
+def ensure_header(path, fieldnames):
+    """Make `path` a CSV with the header `fieldnames`, keeping the rows of an older header."""
+    if not os.path.isfile(path):
+        with open(path, mode='w') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+            writer.writeheader()
+        return
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    header = rows[0] if rows else []
+    if header == list(fieldnames):
+        return
+    if header == list(fieldnames[:len(header)]):
+        with open(path + '.tmp', 'w', newline='') as f:
+            csv_writer = csv.writer(f)
+            csv_writer.writerow(fieldnames)
+            for row in rows[1:]:
+                csv_writer.writerow(row + [''] * (len(fieldnames) - len(row)))
+        os.replace(path + '.tmp', path)
+        print('{}: added the columns {}'.format(path, ', '.join(fieldnames[len(header):])))
+        return
+    root, ext = os.path.splitext(path)
+    n = 1
+    while os.path.exists('{}.{}{}'.format(root, n, ext)):
+        n += 1
+    os.replace(path, '{}.{}{}'.format(root, n, ext))
+    print('{}: different columns, moved to {}.{}{}'.format(path, root, n, ext))
+    ensure_header(path, fieldnames)
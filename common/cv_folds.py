@@ -0,0 +1,145 @@
+"""
+Fold bookkeeping and fold-parallel training for train_cross_val.py.
+
+`save_folds` persists which fold holds out each image, as
+``models_cv/folds_<seed>.json`` (relative sample paths and their held-out
+fold), so eval_cross_val.py evaluates every image with the model that did not
+train on it, whatever order its own dataset lists the images in. The fold
+models are ``models_cv/<model>_<seed>_<fold>[_w].pth``: every seed has its own
+split, its own models and its own checkpoints.
+
+`run_folds` trains the folds in `workers` concurrent processes. Each fold
+builds its own model, optimizer and generators from a per-fold seed, so the
+result of a fold does not depend on which folds ran before it or next to it.
+The processes are forked after the dataset has been built, sharing its decoded
+cache, and each gets its own share of the CPUs (its NUMA node when there is one
+per worker) and, on a multi-GPU machine, its own GPU. A fold's output goes to
+``<log_prefix>_fold<k>.log``. With one worker the folds run one after another
+in this process. The children measure their time to first batch from the
+start of the parent, not from the fork.
+"""
+import os
+import sys
+import json
+import multiprocessing
+from multiprocessing.connection import wait
+
+import torch
+
+
+def folds_path(directory, seed):
+    return os.path.join(directory, 'folds_{}.json'.format(seed))
+
+
+def fold_model_path(model_name, seed, fold, weighted=False, directory='models_cv'):
+    return os.path.join(directory, '{}_{}_{}{}.pth'.format(model_name, seed, fold, '_w' if weighted else ''))
+
+
+def sample_paths(dataset):
+    """Path of every sample of an ImageFolder-like dataset, relative to its root."""
+    root = os.path.normpath(getattr(dataset, 'root', '') or '.')
+    paths = []
+    for path, _ in dataset.samples:
+        # ImageFolder and ManifestDataset list root/<class>/<file>, with a relative or an absolute root;
+        # ShardDataset lists <class>/<file> already
+        if os.path.isabs(path) or os.path.normpath(path).startswith(root + os.sep):
+            path = os.path.relpath(path, root)
+        paths.append(path.replace(os.sep, '/'))
+    return paths
+
+
+def save_folds(path, dataset, folds, seed):
+    """Record the held-out fold of every sample; `folds` is [(train indices, held-out indices)]."""
+    held_out = [-1] * len(dataset.samples)
+    for fold, (_, test_idx) in enumerate(folds):
+        for idx in test_idx:
+            held_out[int(idx)] = fold
+    record = {'seed': seed, 'k_folds': len(folds), 'samples': sample_paths(dataset), 'folds': held_out}
+    with open(path + '.tmp', 'w') as f:
+        json.dump(record, f)
+    os.replace(path + '.tmp', path)
+
+
+def load_folds(path):
+    """{relative sample path: held-out fold}, number of folds."""
+    with open(path) as f:
+        record = json.load(f)
+    return dict(zip(record['samples'], record['folds'])), record['k_folds']
+
+
+def fold_workers(k_folds, cpus_per_fold):
+    """Concurrent folds the machine has room for: one per GPU, or one per `cpus_per_fold` CPUs."""
+    if torch.cuda.is_available():
+        return max(1, min(k_folds, torch.cuda.device_count()))
+    return max(1, min(k_folds, len(os.sched_getaffinity(0)) // cpus_per_fold))
+
+
+def slot_device(slot):
+    if torch.cuda.is_available():
+        return torch.device('cuda:{}'.format(slot % torch.cuda.device_count()))
+    return torch.device('cpu')
+
+
+def fold_process(conn, train_fold, fold, train_idx, test_idx, slot, workers, log_path, start_time):
+    from common.ddp import rank_cpus
+    from common.startup import inherit_start
+    inherit_start(start_time)
+    cpus = rank_cpus(slot, workers)
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+    log = open(log_path, 'a', buffering=1)
+    sys.stdout = sys.stderr = log
+    row = train_fold(fold, train_idx, test_idx, slot_device(slot), num_cpu=len(cpus))
+    conn.send(row)
+    conn.close()
+
+
+def run_folds(train_fold, folds, workers, log_prefix, default_workers):
+    """Run `train_fold` on every fold, return (rows of the trained folds in fold order, failed folds)."""
+    folds = [(fold, train_idx, test_idx) for fold, (train_idx, test_idx) in enumerate(folds)]
+    if workers <= 1:
+        rows = [train_fold(fold, train_idx, test_idx, slot_device(0), default_workers)
+                for fold, train_idx, test_idx in folds]
+        return [row for row in rows if row is not None], []
+
+    directory = os.path.dirname(log_prefix)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    # fork: the children inherit the dataset and its cache; CUDA is first used in the children
+    ctx = multiprocessing.get_context('fork')
+    # /proc gives the fork time of a child, the startup benchmark measures from the launch of this process
+    from common.startup import process_start_time
+    start_time = process_start_time()
+    pending, running, rows, failed = list(folds), {}, {}, []
+    free_slots = list(range(workers))
+    print('Training {} folds, {} at a time'.format(len(folds), workers))
+    while pending or running:
+        while pending and free_slots:
+            fold, train_idx, test_idx = pending.pop(0)
+            slot = free_slots.pop(0)
+            receiver, sender = ctx.Pipe(duplex=False)
+            log_path = '{}_fold{}.log'.format(log_prefix, fold)
+            process = ctx.Process(target=fold_process,
+                                  args=(sender, train_fold, fold, train_idx, test_idx, slot, workers, log_path,
+                                        start_time))
+            process.start()
+            sender.close()
+            running[process.sentinel] = (process, receiver, fold, slot)
+            print('Fold {} started on {} (log: {})'.format(fold, slot_device(slot), log_path))
+        for sentinel in wait(list(running)):
+            process, receiver, fold, slot = running.pop(sentinel)
+            try:
+                row = receiver.recv()
+            except EOFError:  # the fold died before sending its row
+                row = None
+            receiver.close()
+            process.join()
+            free_slots.append(slot)
+            if process.exitcode != 0:
+                failed.append(fold)
+                print('Fold {} failed (exit code {})'.format(fold, process.exitcode))
+            else:
+                print('Fold {} finished'.format(fold))
+                if row is not None:
+                    rows[fold] = row
+    return [rows[fold] for fold in sorted(rows)], sorted(failed)
@@ -0,0 +1,112 @@
+"""
+Multi-process data-parallel CPU training (DistributedDataParallel over gloo).
+
+Launch train_1.py with one rank per NUMA node of this machine:
+
+    python -m common.ddp train_1.py --model_name resnet18 --seeds 0
+
+and across machines with the usual torchrun rendezvous arguments, e.g. on each
+of two hosts:
+
+    python -m common.ddp --nnodes 2 --node_rank <0|1> --master_addr <host0> train_1.py ...
+
+`--nproc_per_node` overrides the number of local ranks (several ranks on a
+single NUMA box are fine for testing). Each local rank is pinned to the CPUs
+of its NUMA node (or an equal share of the CPUs) and uses as many intra-op
+threads as it has CPUs, so the ranks do not oversubscribe the machine.
+"""
+import os
+import sys
+import glob
+import argparse
+
+import torch
+import torch.distributed as dist
+
+
+def parse_cpu_list(text):
+    """'0-3,8-11' -> [0, 1, 2, 3, 8, 9, 10, 11]"""
+    cpus = []
+    for part in text.strip().split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_cpus():
+    """CPUs of each NUMA node usable by this process, a single group if the topology is unknown."""
+    available = set(os.sched_getaffinity(0))
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+                       key=lambda p: int(os.path.basename(os.path.dirname(p))[4:])):
+        with open(path) as f:
+            cpus = [c for c in parse_cpu_list(f.read()) if c in available]
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(available)]
+
+
+def rank_cpus(local_rank, local_world_size):
+    """CPUs for a local rank: its NUMA node if there is one node per rank, an equal share otherwise."""
+    nodes = numa_cpus()
+    if len(nodes) == local_world_size:
+        return nodes[local_rank]
+    cpus = sorted(c for node in nodes for c in node)
+    share = max(1, len(cpus) // local_world_size)
+    return cpus[local_rank * share:(local_rank + 1) * share] or cpus
+
+
+def init_distributed():
+    """Join the gloo process group set up by the launcher, pin this rank, return (rank, world size)."""
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    cpus = rank_cpus(local_rank, local_world_size)
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+    dist.init_process_group(backend='gloo')
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    print('Rank {}/{} (local rank {}) on {} CPUs'.format(rank, world_size, local_rank, len(cpus)))
+    return rank, world_size
+
+
+def all_reduce_sum(values):
+    """Sum a list of numbers over all ranks."""
+    t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t.tolist()
+
+
+def on_rank0(fn):
+    """Run `fn` on rank 0 only and return its (picklable) result on every rank."""
+    result = [fn() if dist.get_rank() == 0 else None]
+    dist.broadcast_object_list(result, src=0)
+    return result[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Launch a training script with one rank per NUMA node')
+    parser.add_argument('--nproc_per_node', type=int, required=False, default=None,
+                        help="local ranks (default: one per NUMA node)")
+    parser.add_argument('--nnodes', type=int, required=False, default=1, help="number of machines")
+    parser.add_argument('--node_rank', type=int, required=False, default=0, help="rank of this machine")
+    parser.add_argument('--master_addr', type=str, required=False, default='127.0.0.1',
+                        help="address of the machine with node_rank 0")
+    parser.add_argument('--master_port', type=int, required=False, default=29500, help="rendezvous port")
+    parser.add_argument('script', type=str, help="training script, e.g. train_1.py")
+    parser.add_argument('script_args', nargs=argparse.REMAINDER, help="arguments of the training script")
+    args = parser.parse_args()
+
+    nproc = args.nproc_per_node or len(numa_cpus())
+    # the OMP_NUM_THREADS default of torchrun is overridden per rank by init_distributed
+    os.environ.setdefault('OMP_NUM_THREADS', '1')
+    from torch.distributed.run import main as torchrun
+    torchrun(['--nproc_per_node', str(nproc), '--nnodes', str(args.nnodes), '--node_rank', str(args.node_rank),
+              '--master_addr', args.master_addr, '--master_port', str(args.master_port),
+              args.script, '--distributed'] + args.script_args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
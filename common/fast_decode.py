@@ -0,0 +1,39 @@
+"""
+Reduced-size JPEG decoding.
+
+libjpeg can decode directly at 1/2, 1/4 or 1/8 scale (scaled IDCT). PIL
+exposes it through `Image.draft`, which picks the smallest of these scales
+that still keeps both sides at least the requested size. The regular
+`transforms.Resize` then does the precise resize from a far smaller image.
+Non-JPEG files are decoded as usual.
+"""
+import os
+
+from PIL import Image
+
+
+def draft_open(path, min_size):
+    """Open `path` (or a binary file object) as RGB, letting JPEGs decode straight to a scale of at least
+    `min_size` pixels per side."""
+    if not isinstance(path, (str, bytes, os.PathLike)):
+        return draft_decode(path, min_size)
+    with open(path, 'rb') as f:
+        return draft_decode(f, min_size)
+
+
+def draft_decode(f, min_size):
+    img = Image.open(f)
+    if img.format == 'JPEG':
+        img.draft('RGB', (min_size, min_size))
+    return img.convert('RGB')
+
+
+class DraftLoader(object):
+    """`loader` for `datasets.ImageFolder`, `ShardDataset` and `ManifestDataset` using `draft_open`
+    (a class so it pickles into workers)."""
+
+    def __init__(self, min_size):
+        self.min_size = min_size
+
+    def __call__(self, path):
+        return draft_open(path, self.min_size)
@@ -0,0 +1,247 @@
+"""
+Frozen-backbone feature store for `--train_mode transfer`.
+
+In transfer mode only the new classification head is trained. The pretrained
+backbone runs once per image (in eval mode, without gradients) and the input
+of the head is appended to a memory-mapped float16 store; every epoch then
+trains the head from the stored features, which takes seconds instead of
+minutes.
+
+Stores are keyed by the model, the image size and the view of the image, and
+their rows by the sha1 of the encoded image, so the five DATA_<seed> splits
+(which hold copies of the same photos) share one store. With augmentation,
+`passes` random views of each training image are stored and the epochs cycle
+through them.
+
+Layout of ``<store_root>/<model_name>_<img_size>/<view>/``:
+    features.bin  float16 rows, one per image
+    index.csv     sha1, row
+    sources.csv   source key (path, size, mtime) -> sha1, to avoid rehashing
+    shape.json    shape of one row as seen by the head
+"""
+import os
+import csv
+import json
+import fcntl
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.utils.data as data
+
+from common.image_cache import content_digests, source_location
+from common.model_zoo import get_spec, get_module
+
+FEATURES_FILE = 'features.bin'
+INDEX_FILE = 'index.csv'
+SOURCES_FILE = 'sources.csv'
+SHAPE_FILE = 'shape.json'
+LOCK_FILE = 'lock'
+
+
+def freeze_backbone(model, model_name):
+    """Freeze every parameter but those of the classification head, return the head."""
+    head = get_module(model, get_spec(model_name).head)
+    for param in model.parameters():
+        param.requires_grad = False
+    for param in head.parameters():
+        param.requires_grad = True
+    return head
+
+
+class TransferHead(nn.Module):
+    """The classification head of a model, applied to stored backbone features.
+
+    A 1x1 convolution head is followed by the model's own pooling (`ModelSpec.head_pool`, as in eval mode,
+    where the features were extracted): global average pooling, ReLU then average pooling (squeezenet) or
+    the mean of average and max pooling (the test-time pooling of dpn68).
+    """
+
+    def __init__(self, head, shape, pool='avg'):
+        super(TransferHead, self).__init__()
+        self.head = head
+        self.shape = tuple(shape)
+        self.pool = pool
+
+    def forward(self, x):
+        x = self.head(x.view(-1, *self.shape))
+        if x.dim() > 2:
+            if self.pool == 'relu_avg':
+                x = F.relu(x)
+            if self.pool == 'avgmax':
+                x = 0.5 * (F.adaptive_avg_pool2d(x, 1) + F.adaptive_max_pool2d(x, 1))
+            else:
+                x = F.adaptive_avg_pool2d(x, 1)
+            x = torch.flatten(x, 1)
+        return x
+
+
+def dataset_digests(dataset, sources_path):
+    """sha1 of every sample of an ImageFolder, ShardDataset, ManifestDataset or CachedImageFolder."""
+    if hasattr(dataset, 'digests'):
+        return dataset.digests
+    return content_digests([source_location(dataset, i) for i in range(len(dataset.samples))], sources_path)
+
+
+class FeatureStore(object):
+    """Backbone features of one model, image size and view."""
+
+    def __init__(self, store_root, model_name, img_size, view):
+        self.store_dir = os.path.join(store_root, '{}_{}'.format(model_name, img_size), view)
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir, exist_ok=True)
+        self.rows = {}
+        self.shape = None
+
+    def path(self, name):
+        return os.path.join(self.store_dir, name)
+
+    def ensure(self, dataset, extract, batch_size, num_workers=0):
+        """Rows of the samples of `dataset`, running `extract(inputs)` on the samples not stored yet."""
+        with open(self.path(LOCK_FILE), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isfile(self.path(INDEX_FILE)):
+                with open(self.path(INDEX_FILE), newline='') as f:
+                    self.rows = {row[0]: int(row[1]) for row in csv.reader(f)}
+            if os.path.isfile(self.path(SHAPE_FILE)):
+                with open(self.path(SHAPE_FILE)) as f:
+                    self.shape = json.load(f)
+
+            digests = dataset_digests(dataset, self.path(SOURCES_FILE))
+            missing = {}
+            for idx, digest in enumerate(digests):
+                if digest not in self.rows:
+                    missing.setdefault(digest, idx)
+            if missing:
+                print('Extracting backbone features of {} images into {} ...'.format(len(missing), self.store_dir))
+                self._append(data.Subset(dataset, list(missing.values())), list(missing), extract, batch_size,
+                             num_workers)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        return np.array([self.rows[d] for d in digests], dtype=np.int64)
+
+    def _append(self, subset, digests, extract, batch_size, num_workers):
+        loader = data.DataLoader(subset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        rows = []
+        with open(self.path(FEATURES_FILE), 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            start = 0
+            for inputs, _ in loader:
+                features = extract(inputs)
+                if self.shape is None:
+                    self.shape = list(features.shape[1:])
+                    with open(self.path(SHAPE_FILE), 'w') as shape_file:
+                        json.dump(self.shape, shape_file)
+                features = features.reshape(len(features), -1).half().cpu().numpy()
+                row_bytes = features.shape[1] * 2
+                if offset % row_bytes:
+                    # skip the partial row an interrupted extraction may have left behind
+                    f.write(bytes(row_bytes - offset % row_bytes))
+                    offset += row_bytes - offset % row_bytes
+                f.write(features.tobytes())
+                for digest in digests[start:start + len(features)]:
+                    rows.append((digest, offset // row_bytes))
+                    offset += row_bytes
+                start += len(features)
+            f.flush()
+            os.fsync(f.fileno())
+        # index rows go in only once their features are on disk
+        with open(self.path(INDEX_FILE), 'a', newline='') as f:
+            csv.writer(f).writerows(rows)
+        self.rows.update(rows)
+
+    def features(self):
+        row_size = int(np.prod(self.shape))
+        # a partial row left by an interrupted extraction is not part of the store
+        num_rows = os.path.getsize(self.path(FEATURES_FILE)) // (2 * row_size)
+        return np.memmap(self.path(FEATURES_FILE), dtype=np.float16, mode='r', shape=(num_rows, row_size))
+
+
+def backbone_extractor(model, head, device, batch_transform=None):
+    """extract(inputs) -> inputs of `head` when `model` runs on `inputs`."""
+    def extract(inputs):
+        captured = []
+        handle = head.register_forward_hook(lambda module, args, output: captured.append(args[0].detach()))
+        model.eval()
+        inputs = inputs.to(device)
+        if batch_transform is not None:
+            inputs = batch_transform(inputs)
+        with torch.no_grad():
+            model(inputs)
+        handle.remove()
+        return captured[0]
+    return extract
+
+
+class FeatureLoader(object):
+    """Batches of (features, labels) read from one or more stored views, cycling through the views per epoch.
+
+    With `num_replicas` > 1 (data-parallel training) rank `rank` reads its own share of every epoch, like
+    `DistributedSampler`: all ranks shuffle with `seed` + epoch and keep every `num_replicas`-th image.
+    """
+
+    def __init__(self, views, targets, batch_size, shuffle=False, drop_last=False, generator=None,
+                 num_replicas=1, rank=0, seed=0):
+        self.views = views  # [(features memmap, rows)]
+        self.targets = torch.as_tensor(targets)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def num_samples(self):
+        return len(self.targets) // self.num_replicas if self.num_replicas > 1 else len(self.targets)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples() // self.batch_size
+        return (self.num_samples() + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        features, rows = self.views[self.epoch % len(self.views)]
+        if self.num_replicas > 1:
+            # the same permutation on every rank, then a disjoint share per rank
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(self.targets), generator=g) if self.shuffle else torch.arange(len(self.targets))
+            order = order[self.rank:self.num_samples() * self.num_replicas:self.num_replicas]
+        elif self.shuffle:
+            order = torch.randperm(len(self.targets), generator=self.generator)
+        else:
+            order = torch.arange(len(self.targets))
+        self.epoch += 1
+        for b in range(len(self)):
+            idx = order[b * self.batch_size:(b + 1) * self.batch_size].numpy()
+            yield torch.from_numpy(features[rows[idx]].astype(np.float32)), self.targets[idx]
+
+
+def feature_loaders(model, head, model_name, dataset, transforms, batch_transforms, store_root, img_size,
+                    batch_size, device, passes=1, augmented=True, generator=None, num_workers=0,
+                    num_replicas=1, rank=0, seed=0):
+    """Feature loaders for the 'train' and 'valid' splits of `dataset`, and the head to train on them.
+
+    With `num_replicas` > 1 each rank's loaders read its own share of the features.
+    """
+    loaders = {}
+    shape = None
+    for phase in ['train', 'valid']:
+        dataset[phase].transform = transforms[phase]
+        extract = backbone_extractor(model, head, device, batch_transforms[phase])
+        if phase == 'train':
+            names = ['train_aug{}'.format(p) for p in range(passes)] if augmented else ['train']
+        else:
+            names = ['valid']
+        views = []
+        for name in names:
+            store = FeatureStore(store_root, model_name, img_size, name)
+            rows = store.ensure(dataset[phase], extract, batch_size, num_workers)
+            views.append((store.features(), rows))
+            shape = store.shape
+        targets = [t for _, t in dataset[phase].samples]
+        loaders[phase] = FeatureLoader(views, targets, batch_size, shuffle=True, drop_last=True, generator=generator,
+                                       num_replicas=num_replicas, rank=rank, seed=seed)
+    return loaders, TransferHead(head, shape, pool=get_spec(model_name).head_pool)
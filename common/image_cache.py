@@ -0,0 +1,220 @@
+"""
+Decode-once image cache shared by all the training and evaluation scripts.
+
+Every image is decoded a single time, shrunk so that its short side is at most
+``scale * img_size`` and its uint8 RGB pixels are appended to one flat file.
+Entries are keyed by the sha1 of the encoded source bytes, so the same photo
+seen through DATA_0 ... DATA_4, a manifest or a shard is decoded and stored
+once. DataLoader workers memory-map the pixel file and rebuild a PIL image with
+a memcpy, so the usual transforms run as before without the JPEG decode.
+
+Layout of ``<cache_root>/short_<S>/``:
+    pixels.bin   concatenated uint8 HxWx3 arrays
+    index.csv    sha1, offset, height, width
+    sources.csv  source key (path, size, mtime) -> sha1, to avoid rehashing
+"""
+import os
+import io
+import csv
+import math
+import fcntl
+import hashlib
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import Dataset
+
+PIXELS_FILE = 'pixels.bin'
+INDEX_FILE = 'index.csv'
+SOURCES_FILE = 'sources.csv'
+LOCK_FILE = 'lock'
+
+
+def cache_short_side(img_size, scale=1.15):
+    return int(math.ceil(img_size * scale))
+
+
+def read_source(location):
+    path, offset, length = location
+    with open(path, 'rb') as f:
+        if offset is None:
+            return f.read()
+        f.seek(offset)
+        return f.read(length)
+
+
+def decode_image(payload, short_side):
+    """Decode encoded image bytes to RGB, downscaled so the short side is at most `short_side`."""
+    img = Image.open(io.BytesIO(payload))
+    if img.format == 'JPEG':
+        # scaled IDCT: decode at the smallest 1/2, 1/4 or 1/8 scale that keeps `short_side`
+        img.draft('RGB', (short_side, short_side))
+    img = img.convert('RGB')
+    w, h = img.size
+    if min(w, h) > short_side:
+        if w < h:
+            size = (short_side, int(round(h * short_side / w)))
+        else:
+            size = (int(round(w * short_side / h)), short_side)
+        img = img.resize(size, Image.BILINEAR)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def _hash_job(location):
+    return hashlib.sha1(read_source(location)).hexdigest()
+
+
+def _decode_job(job):
+    location, short_side = job
+    return decode_image(read_source(location), short_side)
+
+
+def source_location(source, idx):
+    """(path, offset, length) of the encoded bytes of sample `idx` of an ImageFolder-like dataset."""
+    if hasattr(source, 'entries'):  # ShardDataset
+        shard, offset, length = source.entries[idx]
+        return os.path.join(source.shard_dir, shard), offset, length
+    return source.samples[idx][0], None, None
+
+
+def source_key(location):
+    path, offset, length = location
+    st = os.stat(path)
+    return '{}:{}:{}:{}:{}'.format(os.path.abspath(path), offset, length, st.st_size, st.st_mtime_ns)
+
+
+def content_digests(locations, sources_path, known=None, num_workers=None):
+    """sha1 of the encoded bytes of every location, hashing only sources not listed in `sources_path` yet.
+
+    The caller holds the lock of the directory of `sources_path`. `known` is
+    the source key -> sha1 table already read from it, if any.
+    """
+    if known is None:
+        known = {}
+        if os.path.isfile(sources_path):
+            with open(sources_path, newline='') as f:
+                known = {row[0]: row[1] for row in csv.reader(f)}
+    keys = [source_key(loc) for loc in locations]
+    unhashed = sorted(set(k for k in keys if k not in known))
+    if unhashed:
+        by_key = dict(zip(keys, locations))
+        with multiprocessing.Pool(num_workers or multiprocessing.cpu_count()) as pool:
+            digests = pool.map(_hash_job, [by_key[k] for k in unhashed], chunksize=8)
+        with open(sources_path, 'a', newline='') as f:
+            csv.writer(f).writerows(zip(unhashed, digests))
+        known.update(zip(unhashed, digests))
+    return [known[k] for k in keys]
+
+
+class ImageCache(object):
+    """Content-addressed store of decoded images for one resize budget."""
+
+    def __init__(self, cache_root, img_size, scale=1.15):
+        self.short_side = cache_short_side(img_size, scale)
+        self.cache_dir = os.path.join(cache_root, 'short_{}'.format(self.short_side))
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.entries = {}
+        self.hashes = {}
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _read_tables(self):
+        if os.path.isfile(self.path(INDEX_FILE)):
+            with open(self.path(INDEX_FILE), newline='') as f:
+                self.entries = {row[0]: (int(row[1]), int(row[2]), int(row[3])) for row in csv.reader(f)}
+        if os.path.isfile(self.path(SOURCES_FILE)):
+            with open(self.path(SOURCES_FILE), newline='') as f:
+                self.hashes = {row[0]: row[1] for row in csv.reader(f)}
+
+    def ensure(self, locations, num_workers=None):
+        """Make sure every source in `locations` is cached; returns the list of their sha1 keys.
+
+        Concurrent jobs are serialized with a file lock, so several scripts
+        can safely fill the same cache.
+        """
+        num_workers = num_workers or multiprocessing.cpu_count()
+        with open(self.path(LOCK_FILE), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._read_tables()
+
+            digests = content_digests(locations, self.path(SOURCES_FILE), self.hashes, num_workers)
+            missing = {}
+            for digest, loc in zip(digests, locations):
+                if digest not in self.entries:
+                    missing.setdefault(digest, loc)
+            if missing:
+                print('Caching {} new images at short side {} ...'.format(len(missing), self.short_side))
+                self._append(missing, num_workers)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        return digests
+
+    def _append(self, missing, num_workers):
+        rows = []
+        jobs = [(loc, self.short_side) for loc in missing.values()]
+        with open(self.path(PIXELS_FILE), 'ab') as f, multiprocessing.Pool(num_workers) as pool:
+            # start after whatever an interrupted build may have left behind
+            offset = f.seek(0, os.SEEK_END)
+            for digest, pixels in zip(missing, pool.imap(_decode_job, jobs, chunksize=8)):
+                f.write(pixels.tobytes())
+                rows.append((digest, offset, pixels.shape[0], pixels.shape[1]))
+                offset += pixels.nbytes
+            f.flush()
+            os.fsync(f.fileno())
+        # index rows go in only once their pixels are on disk
+        with open(self.path(INDEX_FILE), 'a', newline='') as f:
+            csv.writer(f).writerows(rows)
+        self.entries.update((r[0], r[1:]) for r in rows)
+
+
+class CachedImageFolder(Dataset):
+    """Serve an ImageFolder, ShardDataset or ManifestDataset from the shared decode cache.
+
+    Missing images are decoded into the cache on construction. Samples come back
+    as PIL images through the source's transform, so RandomResizedCrop, Resize,
+    ... apply unchanged.
+    """
+
+    def __init__(self, source, cache_root, img_size, scale=1.15):
+        self.root = source.root
+        self.transform = source.transform
+        self.target_transform = source.target_transform
+        self.classes = source.classes
+        self.class_to_idx = source.class_to_idx
+        self.samples = source.samples
+        self.targets = [t for _, t in source.samples]
+        self.imgs = self.samples
+
+        cache = ImageCache(cache_root, img_size, scale)
+        digests = cache.ensure([source_location(source, i) for i in range(len(source.samples))])
+        # content keys of the samples, e.g. for the transfer-learning feature store
+        self.digests = digests
+        self.pixels_path = cache.path(PIXELS_FILE)
+        self.index = np.array([cache.entries[d] for d in digests], dtype=np.int64).reshape(-1, 3)
+        # opened lazily so that each DataLoader worker maps the file itself
+        self._pixels = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def load_pixels(self, idx):
+        if self._pixels is None:
+            self._pixels = np.memmap(self.pixels_path, dtype=np.uint8, mode='r')
+        offset, h, w = self.index[idx]
+        return np.array(self._pixels[offset:offset + h * w * 3]).reshape(h, w, 3)
+
+    def __getitem__(self, idx):
+        sample = Image.fromarray(self.load_pixels(idx))
+        target = self.targets[idx]
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pixels'] = None
+        return state
@@ -0,0 +1,136 @@
+"""
+DataLoader autotuning.
+
+A short calibration runs real steps of the current model on the current
+machine for a few DataLoader configurations (num_workers, prefetch_factor,
+persistent_workers) and keeps the fastest one. For each configuration the time
+the step spends waiting on data and the time spent in compute are measured
+separately and printed. The winner is cached per host, model, image size,
+batch size and input pipeline (shards, manifest, decoded-image cache, draft
+decoding, batch augmentation, tensor cache) in loader_tune.json, so later runs
+reuse it at no cost.
+"""
+import os
+import copy
+import json
+import time
+import socket
+import multiprocessing
+
+import torch
+import torch.utils.data as data
+
+CACHE_FILE = 'loader_tune.json'
+# command-line flags that change what the workers do per sample, and so the best settings
+PIPELINE_FLAGS = ['use_shards', 'use_manifest', 'cache_dir', 'draft_decode', 'batch_augmentation', 'tensor_cache_dir']
+
+
+def tune_key(model_name, img_size, batch_size, mode='train', args=None):
+    """Cache key of a calibration; `args` are the parsed arguments of the script, for its pipeline flags."""
+    key = '{}/{}/{}/{}/{}'.format(socket.gethostname(), model_name, img_size, batch_size, mode)
+    pipeline = [flag for flag in PIPELINE_FLAGS if getattr(args, flag, None)]
+    # the default pipeline keeps the key of the calibrations cached before the flags existed
+    return key + '/' + '+'.join(pipeline) if pipeline else key
+
+
+def train_step_fn(model, criterion, device, batch_transform=None):
+    """Forward + backward of one batch, without touching the weights."""
+    def step(inputs, labels):
+        inputs = inputs.to(device, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
+        if batch_transform is not None:
+            inputs = batch_transform(inputs)
+        model.zero_grad()
+        loss = criterion(model(inputs), labels)
+        loss.backward()
+        loss.item()
+    return step
+
+
+def eval_step_fn(model, device, batch_transform=None):
+    def step(inputs, labels):
+        inputs = inputs.to(device, non_blocking=True)
+        if batch_transform is not None:
+            inputs = batch_transform(inputs)
+        with torch.no_grad():
+            model(inputs).cpu()
+    return step
+
+
+def measure(dataset, batch_size, step, config, num_batches, worker_init_fn=None):
+    """(data wait, compute) seconds over two short passes, the second one showing the restart cost of the workers."""
+    g = torch.Generator()
+    g.manual_seed(0)
+    loader = data.DataLoader(dataset, batch_size=batch_size, shuffle=True, pin_memory=True, drop_last=True,
+                             worker_init_fn=worker_init_fn, generator=g, **config)
+    wait, compute = 0.0, 0.0
+    for _ in range(2):
+        since = time.time()
+        for i, (inputs, labels) in enumerate(loader):
+            ready = time.time()
+            wait += ready - since
+            step(inputs, labels)
+            since = time.time()
+            compute += since - ready
+            if i + 1 == num_batches:
+                break
+    del loader
+    return wait, compute
+
+
+def candidate_workers(max_workers=None):
+    max_workers = max_workers or multiprocessing.cpu_count()
+    workers = sorted(set([max(1, max_workers // 8), max(1, max_workers // 4), max(1, max_workers // 2), max_workers]))
+    return workers
+
+
+def autotune_loader(dataset, batch_size, step, key, model=None, num_batches=6, worker_init_fn=None,
+                    cache_file=CACHE_FILE, persistent=True):
+    """DataLoader keyword arguments (num_workers, prefetch_factor, persistent_workers) tuned for `step`.
+
+    The search is staged: the number of workers first, then the prefetch depth
+    for the best worker count, then whether to keep the workers alive between
+    epochs. `model` weights, buffers and the global torch RNG are restored
+    afterwards, so calibration does not change the training run.
+
+    With `persistent=False` the workers are never kept alive: resumable training
+    needs every epoch to reseed its workers from the loader generator.
+    """
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    if key in cache:
+        best = cache[key] if persistent else dict(cache[key], persistent_workers=False)
+        print('DataLoader config for {} (cached): {}'.format(key, best))
+        return best
+
+    model_state = copy.deepcopy(model.state_dict()) if model is not None else None
+    rng_state = torch.get_rng_state()
+    results = {}
+
+    def trial(config):
+        name = json.dumps(config, sort_keys=True)
+        if name not in results:
+            wait, compute = measure(dataset, batch_size, step, config, num_batches, worker_init_fn)
+            results[name] = (wait + compute, config)
+            print('  {}: data wait {:.2f}s, compute {:.2f}s'.format(name, wait, compute))
+        return results[name][0]
+
+    print('Calibrating the DataLoader for {} ...'.format(key))
+    best = min(({'num_workers': n, 'prefetch_factor': 2, 'persistent_workers': persistent}
+                for n in candidate_workers()), key=trial)
+    best = min((dict(best, prefetch_factor=p) for p in [2, 4, 8]), key=trial)
+    if persistent:
+        best = min((dict(best, persistent_workers=p) for p in [True, False]), key=trial)
+
+    if model is not None:
+        model.load_state_dict(model_state)
+        model.zero_grad()
+    torch.set_rng_state(rng_state)
+
+    cache[key] = best
+    with open(cache_file, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    print('DataLoader config for {}: {}'.format(key, best))
+    return best
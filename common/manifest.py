@@ -0,0 +1,153 @@
+"""
+Index manifests describing a train/val/test split (and k-fold assignment) of
+the single original image directory.
+
+A manifest is a small JSON file listing, for one seed, the relative paths of
+the members of every split. Building one takes milliseconds, nothing is copied,
+and the stored sha256 of its content lets every consumer check that it uses
+exactly the split the partitioner produced.
+"""
+import os
+import json
+import math
+import random
+import hashlib
+
+from PIL import Image
+from torch.utils.data import Dataset
+
+SPLITS = ['train', 'val', 'test']
+EXTENSIONS = (".JPEG", "jpeg", "JPG", ".jpg", ".png", "PNG")
+
+
+def manifest_path_for(directory, seed):
+    """Manifest standing in for `directory`/DATA_`seed`."""
+    return os.path.join(directory, 'DATA_{}.json'.format(seed))
+
+
+def content_hash(manifest):
+    body = {k: v for k, v in manifest.items() if k != 'sha256'}
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def list_images(source):
+    """Sorted relative paths of the images of every class folder of `source`."""
+    images = {}
+    for item in sorted(os.listdir(source)):
+        if not os.path.isdir(os.path.join(source, item)):
+            continue
+        images[item] = []
+        for (dirpath, dirnames, filenames) in os.walk(os.path.join(source, item)):
+            for filename in filenames:
+                if filename.endswith(EXTENSIONS):
+                    rel_path = os.path.relpath(os.path.join(dirpath, filename), source)
+                    images[item].append(rel_path.replace(os.sep, '/'))
+        images[item].sort()
+    return images
+
+
+def build_manifest(source, seed, ratio_list, k_folds=0, images=None):
+    """Stratified train/val/test split of `source` for one seed.
+
+    Each class is shuffled once with a seeded generator and cut into val, test
+    and train members (linear in the class size). With `k_folds` every image is
+    also given a stratified fold number for cross-validation.
+    """
+    images = images if images is not None else list_images(source)
+    rng = random.Random(seed)
+    classes = sorted(images)
+    splits = {split: [] for split in SPLITS}
+    folds = {}
+    for class_idx, item in enumerate(classes):
+        members = list(images[item])
+        rng.shuffle(members)
+        num_images = len(members)
+        num_val_images = math.ceil(ratio_list[1] * num_images)
+        num_test_images = math.ceil(ratio_list[2] * num_images)
+        print("class", "total images", "n_train", "n_val", "n_test",
+              item, num_images, (num_images - num_val_images - num_test_images), num_val_images, num_test_images)
+        splits['val'] += [[p, class_idx] for p in members[:num_val_images]]
+        splits['test'] += [[p, class_idx] for p in members[num_val_images:num_val_images + num_test_images]]
+        splits['train'] += [[p, class_idx] for p in members[num_val_images + num_test_images:]]
+        if k_folds:
+            for i, p in enumerate(members):
+                folds[p] = i % k_folds
+
+    manifest = {'source': os.path.abspath(source), 'seed': seed, 'ratio_list': list(ratio_list),
+                'classes': classes, 'splits': splits, 'k_folds': k_folds, 'folds': folds}
+    manifest['sha256'] = content_hash(manifest)
+    return manifest
+
+
+def write_manifests(source, dest, seeds, ratio_list, k_folds=0):
+    """Write one manifest per seed into `dest`, listing the source directory only once."""
+    if not os.path.exists(dest):
+        os.makedirs(dest)
+    images = list_images(source)
+    paths = []
+    for seed in seeds:
+        manifest = build_manifest(source, seed, ratio_list, k_folds, images)
+        paths.append(manifest_path_for(dest, seed))
+        with open(paths[-1], 'w') as f:
+            json.dump(manifest, f)
+    return paths
+
+
+def load_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    if content_hash(manifest) != manifest.get('sha256'):
+        raise ValueError('Manifest {} does not match its sha256, refusing to use a modified split'.format(path))
+    return manifest
+
+
+def fold_indices(manifest, rel_paths, fold):
+    """(train_idx, test_idx) of the images `rel_paths` for the given fold of the manifest."""
+    folds = manifest['folds']
+    if not folds:
+        raise ValueError('Manifest was written without k-fold assignments')
+    train_idx = [i for i, p in enumerate(rel_paths) if folds[p] != fold]
+    test_idx = [i for i, p in enumerate(rel_paths) if folds[p] == fold]
+    return train_idx, test_idx
+
+
+class ManifestDataset(Dataset):
+    """ImageFolder-compatible dataset over the members of one split of a manifest.
+
+    `split` is 'train', 'val', 'test' or 'all'; images are read from the
+    manifest's source directory unless `root` is given, with `loader` if one
+    is given (e.g. `DraftLoader`).
+    """
+
+    def __init__(self, manifest_path, split, transform=None, target_transform=None, root=None, loader=None):
+        self.manifest = load_manifest(manifest_path)
+        self.loader = loader
+        self.root = root or self.manifest['source']
+        self.transform = transform
+        self.target_transform = target_transform
+        self.classes = self.manifest['classes']
+        self.class_to_idx = {cls_name: i for i, cls_name in enumerate(self.classes)}
+        if split == 'all':
+            members = sorted(sum((self.manifest['splits'][s] for s in SPLITS), []))
+        else:
+            members = self.manifest['splits'][split]
+        self.rel_paths = [p for p, _ in members]
+        self.samples = [(os.path.join(self.root, p), t) for p, t in members]
+        self.targets = [t for _, t in self.samples]
+        self.imgs = self.samples
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        path, target = self.samples[idx]
+        if self.loader is not None:
+            sample = self.loader(path)
+        else:
+            with open(path, 'rb') as f:
+                sample = Image.open(f).convert('RGB')
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
@@ -0,0 +1,37 @@
+"""
+Sync-free metric accumulation for the training and evaluation loops.
+
+Calling `loss.item()`, `.sum().item()` or moving predictions to the CPU on
+every batch forces the host to wait for the device and allocates small
+tensors. `MetricAccumulator` keeps the running loss and a confusion matrix
+on the compute device instead; the correct count is its trace. Nothing is
+read back until `result()` is called once per epoch.
+"""
+import torch
+
+
+class MetricAccumulator(object):
+
+    def __init__(self, num_classes, device):
+        self.num_classes = num_classes
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.confusion = torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)
+        self.count = 0
+
+    def update(self, preds, labels, loss=None):
+        """Add a batch; `loss` is the mean loss of the batch, as returned by the criterion."""
+        n = labels.size(0)
+        if loss is not None:
+            self.loss_sum += loss.detach().double() * n
+        cells = labels.view(-1) * self.num_classes + preds.view(-1)
+        if self.confusion.is_cuda:
+            # bincount needs the maximum of its input on the host, index_add_ does not
+            self.confusion.index_add_(0, cells, torch.ones_like(cells))
+        else:
+            self.confusion += torch.bincount(cells, minlength=self.num_classes * self.num_classes)
+        self.count += n
+
+    def result(self):
+        """(summed loss, number of correct predictions, confusion matrix [true, predicted]) on the CPU."""
+        confusion = self.confusion.view(self.num_classes, self.num_classes).cpu()
+        return self.loss_sum.item(), confusion.diagonal().sum(), confusion
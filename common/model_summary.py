@@ -0,0 +1,68 @@
+"""
+Model summary, computed once per architecture and cached on disk.
+
+The summary (the trainable state of every named parameter, the torchsummary
+layer table and the module tree) needs a forward pass and is the same for
+every seed and every run of an architecture, so it is written to
+``<cache_dir>/<model_name>_<num_classes>c_<input_size>.txt`` the first time it
+is asked for and read from there afterwards. torchsummary is imported only
+when a summary has to be computed.
+
+The forward pass runs in eval mode and the RNG state is restored afterwards,
+so asking for a summary does not change the BatchNorm statistics or the
+random stream of the training that follows.
+"""
+import io
+import os
+import contextlib
+
+import torch
+
+CACHE_DIR = 'model_summaries'
+
+
+def summary_path(model_name, num_classes, input_size, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, '{}_{}c_{}.txt'.format(model_name, num_classes, input_size))
+
+
+def compute_summary(model, input_size, device):
+    text = io.StringIO()
+    text.write('Model Summary:-\n\n')
+    for num, (name, param) in enumerate(model.named_parameters()):
+        text.write('{} {} {}\n'.format(num, name, param.requires_grad))
+
+    was_training = model.training
+    cpu_rng = torch.get_rng_state()
+    cuda_rng = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    model.eval()
+    try:
+        from torchsummary import summary
+        with contextlib.redirect_stdout(text):
+            summary(model, input_size=(3, input_size, input_size), device=device.type)
+    except Exception as e:
+        text.write('\nNo layer table for this architecture ({}: {})\n'.format(
+            type(e).__name__, str(e).splitlines()[0] if str(e) else ''))
+    finally:
+        model.train(was_training)
+        torch.set_rng_state(cpu_rng)
+        if cuda_rng:
+            torch.cuda.set_rng_state_all(cuda_rng)
+    text.write('\n{}\n'.format(model))
+    return text.getvalue()
+
+
+def model_summary(model, model_name, num_classes, input_size, device, cache_dir=CACHE_DIR):
+    """Summary text of `model`, from the cache if this architecture has been summarized before."""
+    path = summary_path(model_name, num_classes, input_size, cache_dir)
+    if os.path.isfile(path):
+        with open(path) as f:
+            return f.read()
+    text = compute_summary(model, input_size, device)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    # concurrent runs of the same architecture each write their own file, the last rename wins
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+    return text
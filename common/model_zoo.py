@@ -0,0 +1,193 @@
+"""
+Registry of the model zoo.
+
+Every model name maps to a `ModelSpec`: how to build the ImageNet-pretrained
+network, the attribute path of its classification head (whose input is the
+feature vector `--train_mode transfer` extracts), its native input size when
+the architecture was trained on something other than 224x224, how it pools
+the output of a 1x1 convolution head, and its sequential feature stages for
+activation checkpointing.
+
+The backend libraries (torchvision, pretrainedmodels, efficientnet_pytorch,
+RepVGG) are imported only when a model of their family is built, so building
+a resnet18 does not pay for importing pretrainedmodels. Adding a model is one
+`register` call.
+
+    model = build_model('resnet50', num_classes=15)
+"""
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+
+class ModelSpec(object):
+
+    def __init__(self, name, build, head, input_size=None, stages=(), aux_heads=(), sized_head=False,
+                 head_pool='avg'):
+        self.name = name
+        self.build = build  # build(num_classes, pretrained) -> model, ImageNet weights if pretrained
+        self.head = head
+        self.sized_head = sized_head  # the builder already gives the head num_classes outputs
+        self.input_size = input_size
+        self.stages = list(stages)
+        self.aux_heads = list(aux_heads)  # further heads replaced before the main one
+        # spatial output of a convolution head to logits, in eval mode: 'avg', 'relu_avg' or 'avgmax'
+        self.head_pool = head_pool
+
+
+MODELS = OrderedDict()
+
+
+def register(name, build, head, input_size=None, stages=(), aux_heads=(), sized_head=False, head_pool='avg'):
+    MODELS[name] = ModelSpec(name, build, head, input_size, stages, aux_heads, sized_head, head_pool)
+
+
+def get_spec(model_name):
+    if model_name not in MODELS:
+        raise ValueError('Unknown model {}, choose one of {}'.format(model_name, ', '.join(MODELS)))
+    return MODELS[model_name]
+
+
+def get_module(model, path):
+    for name in path.split('.'):
+        model = model[int(name)] if name.isdigit() else getattr(model, name)
+    return model
+
+
+def set_module(model, path, module):
+    parent, _, name = path.rpartition('.')
+    if parent:
+        model = get_module(model, parent)
+    if name.isdigit():
+        model[int(name)] = module
+    else:
+        setattr(model, name, module)
+
+
+def new_head(head, num_classes):
+    """A freshly initialized copy of a linear or 1x1 convolution head with `num_classes` outputs."""
+    if isinstance(head, nn.Conv2d):
+        return nn.Conv2d(head.in_channels, num_classes, kernel_size=(1, 1), stride=(1, 1))
+    return nn.Linear(head.in_features, num_classes)
+
+
+def build_model(model_name, num_classes, weight_store=None):
+    """ImageNet-pretrained `model_name` with a new `num_classes` classification head.
+
+    With a `WeightStore`, the architecture is built without weights and the
+    pretrained weights are memory-mapped from the store, without the network.
+    """
+    spec = get_spec(model_name)
+    if weight_store is not None:
+        model = spec.build(1000, pretrained=False)
+        weight_store.load_into(model, model_name)
+    else:
+        model = spec.build(num_classes)
+    if weight_store is not None or not spec.sized_head:
+        for path in spec.aux_heads + [spec.head]:
+            set_module(model, path, new_head(get_module(model, path), num_classes))
+    return model
+
+
+def input_size(model_name, default):
+    """Native input size of `model_name`, `default` if it has none."""
+    return get_spec(model_name).input_size or default
+
+
+# builders, one per backend
+
+# the architecture the pretrained weights were saved from, e.g. googlenet drops its auxiliary classifiers
+PRETRAINED_KWARGS = {
+    'googlenet': {'transform_input': True, 'aux_logits': False, 'init_weights': False},
+    'inception_v3': {'transform_input': True, 'aux_logits': True, 'init_weights': False},
+}
+
+
+def torchvision_model(arch):
+    def build(num_classes, pretrained=True):
+        from torchvision import models
+        if pretrained:
+            return getattr(models, arch)(pretrained=True)
+        return getattr(models, arch)(pretrained=False, **PRETRAINED_KWARGS.get(arch, {}))
+    return build
+
+
+def inception_v3(num_classes, pretrained=True):
+    model = torchvision_model('inception_v3')(num_classes, pretrained)
+    model.aux_logits = False
+    return model
+
+
+def torch_hub_model(arch):
+    def build(num_classes, pretrained=True):
+        if not pretrained:
+            # torchvision v0.10.0 defines the same architecture, no need to fetch the hub repository
+            return torchvision_model(arch)(num_classes, pretrained)
+        torch.hub._validate_not_a_forked_repo = lambda a, b, c: True
+        return torch.hub.load('pytorch/vision:v0.10.0', arch, pretrained=True)
+    return build
+
+
+def pretrainedmodels_model(arch):
+    def build(num_classes, pretrained=True):
+        import pretrainedmodels
+        return getattr(pretrainedmodels, arch)(num_classes=1000, pretrained='imagenet' if pretrained else None)
+    return build
+
+
+def efficientnet_model(arch):
+    def build(num_classes, pretrained=True):
+        from efficientnet_pytorch import EfficientNet
+        if not pretrained:
+            return EfficientNet.from_name(arch, num_classes=num_classes)
+        return EfficientNet.from_pretrained(arch, num_classes=num_classes)
+    return build
+
+
+def repvgg_model(arch):
+    def build(num_classes, pretrained=True):
+        from RepVGG import repvgg
+        model = getattr(repvgg, 'create_' + arch.replace('-', '_'))(deploy=False)
+        if pretrained:
+            model.load_state_dict(torch.load('RepVGG/{}-train.pth'.format(arch)))  # or train from scratch
+        return model
+    return build
+
+
+RESNET_STAGES = ['layer1', 'layer2', 'layer3', 'layer4']
+
+register('resnet18', torchvision_model('resnet18'), 'fc', stages=RESNET_STAGES)
+register('resnet50', torchvision_model('resnet50'), 'fc', stages=RESNET_STAGES)
+register('resnet101', torchvision_model('resnet101'), 'fc', stages=RESNET_STAGES)
+register('resnext50_32x4d', torch_hub_model('resnext50_32x4d'), 'fc', stages=RESNET_STAGES)
+register('resnext101_32x8d', torch_hub_model('resnext101_32x8d'), 'fc', stages=RESNET_STAGES)
+register('alexnet', torchvision_model('alexnet'), 'classifier.6', stages=['features'])
+register('vgg11', torchvision_model('vgg11'), 'classifier.6', stages=['features'])
+register('vgg16', torchvision_model('vgg16'), 'classifier.6', stages=['features'])
+register('vgg19', torchvision_model('vgg19'), 'classifier.6', stages=['features'])
+register('squeezenet', torchvision_model('squeezenet1_0'), 'classifier.1', stages=['features'], head_pool='relu_avg')
+register('densenet121', torchvision_model('densenet121'), 'classifier', stages=['features'])
+register('densenet169', torchvision_model('densenet169'), 'classifier', stages=['features'])
+register('densenet161', torchvision_model('densenet161'), 'classifier', stages=['features'])
+register('inception', inception_v3, 'fc', input_size=299, aux_heads=['AuxLogits.fc'])
+register('googlenet', torchvision_model('googlenet'), 'fc')
+register('mobilenet_v2', torchvision_model('mobilenet_v2'), 'classifier.1', stages=['features'])
+register('mobilenet_v3_small', torchvision_model('mobilenet_v3_small'), 'classifier.3', stages=['features'])
+register('mobilenet_v3_large', torchvision_model('mobilenet_v3_large'), 'classifier.3', stages=['features'])
+register('shufflenet_v2_x0_5', torchvision_model('shufflenet_v2_x0_5'), 'fc', stages=['stage2', 'stage3', 'stage4'])
+register('shufflenet_v2_x1_0', torchvision_model('shufflenet_v2_x1_0'), 'fc', stages=['stage2', 'stage3', 'stage4'])
+register('mnasnet1_0', torchvision_model('mnasnet1_0'), 'classifier.1', stages=['layers'])
+register('inceptionv4', pretrainedmodels_model('inceptionv4'), 'last_linear', input_size=299, stages=['features'])
+register('inceptionresnetv2', pretrainedmodels_model('inceptionresnetv2'), 'last_linear', input_size=299,
+         stages=['repeat', 'repeat_1', 'repeat_2'])
+register('xception', pretrainedmodels_model('xception'), 'last_linear', input_size=299)
+register('nasnetamobile', pretrainedmodels_model('nasnetamobile'), 'last_linear')
+# test-time pooling: 7x7 average pooling before the head, mean of average and max pooling after it
+register('dpn68', pretrainedmodels_model('dpn68'), 'last_linear', head_pool='avgmax')
+register('polynet', pretrainedmodels_model('polynet'), 'last_linear', input_size=331,
+         stages=['stage_a', 'stage_b', 'stage_c'])
+for b in range(7):
+    register('efficientnet-b{}'.format(b), efficientnet_model('efficientnet-b{}'.format(b)), '_fc', sized_head=True)
+for arch in ['RepVGG-A0', 'RepVGG-A1', 'RepVGG-A2', 'RepVGG-B0', 'RepVGG-B1', 'RepVGG-B2']:
+    register(arch, repvgg_model(arch), 'linear', stages=['stage1', 'stage2', 'stage3', 'stage4'])
@@ -7,9 +7,14 @@ import argparse
 import math
 import random
 from os import walk
+import sys
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.shards import ShardWriter
+from common.manifest import write_manifests
 
-def iterate_dir(source, dest, ratio_list):
+
+def iterate_dir(source, dest, ratio_list, writers=None):
     # source = source.replace('\\', '/')
     # dest = dest.replace('\\', '/')
 
@@ -18,12 +23,13 @@ def iterate_dir(source, dest, ratio_list):
         train_dir = os.path.join(dest, 'train', item)
         val_dir = os.path.join(dest, 'val', item)
         test_dir = os.path.join(dest, 'test', item)
-        if not os.path.exists(train_dir):
-            os.makedirs(train_dir)
-        if not os.path.exists(val_dir):
-            os.makedirs(val_dir)
-        if not os.path.exists(test_dir):
-            os.makedirs(test_dir)
+        if writers is None:
+            if not os.path.exists(train_dir):
+                os.makedirs(train_dir)
+            if not os.path.exists(val_dir):
+                os.makedirs(val_dir)
+            if not os.path.exists(test_dir):
+                os.makedirs(test_dir)
 
         # get all the pictures in directory
         images = []
@@ -38,24 +44,42 @@ def iterate_dir(source, dest, ratio_list):
         num_test_images = math.ceil(ratio_list[2] * num_images)
         print("class", "total images", "n_train", "n_val", "n_test",
               item, num_images, (num_images - num_val_images - num_test_images), num_val_images, num_test_images)
+
+        def place(filename, split, split_dir):
+            if writers is None:
+                copyfile(os.path.join(source, item, filename),
+                         os.path.join(split_dir, filename))
+            else:
+                writers[split].add_file(os.path.join(source, item, filename),
+                                        os.path.join(item, filename), item)
+
         for j in range(num_val_images):
             idx = random.randint(0, len(images) - 1)
             filename = images[idx].split("/")[-1]
-            copyfile(os.path.join(source, item, filename),
-                     os.path.join(val_dir, filename))
+            place(filename, 'val', val_dir)
             images.remove(images[idx])
 
         for i in range(num_test_images):
             idx = random.randint(0, len(images) - 1)
             filename = images[idx].split("/")[-1]
-            copyfile(os.path.join(source, item, filename),
-                     os.path.join(test_dir, filename))
+            place(filename, 'test', test_dir)
             images.remove(images[idx])
 
         for file in images:
             filename = file.split("/")[-1]
-            copyfile(os.path.join(source, item, filename),
-                     os.path.join(train_dir, filename))
+            place(filename, 'train', train_dir)
+
+
+def iterate_dir_shards(source, dest, ratio_list):
+    """Same split as `iterate_dir`, but packed into dest/{train,val,test}-NNNNN.shard plus an index each."""
+    if not os.path.exists(dest):
+        os.makedirs(dest)
+    writers = {split: ShardWriter(os.path.join(dest, split)) for split in ['train', 'val', 'test']}
+    try:
+        iterate_dir(source, dest, ratio_list, writers)
+    finally:
+        for writer in writers.values():
+            writer.close()
 
 
 def main():
@@ -77,14 +101,40 @@ def main():
         help='The ratio of the number of test images over the total number of images. The default is 0.1.',
         default=[0.65, 0.2, 0.15],
         type=list)
+    parser.add_argument(
+        '-s', '--shards',
+        help='Write each split as sequential shards with an index instead of copying the images.',
+        action='store_true')
+    parser.add_argument(
+        '-m', '--manifest',
+        help='Only write one index manifest (DATA_<seed>.json) per seed instead of copying the images.',
+        action='store_true')
+    parser.add_argument(
+        '-k', '--k_folds',
+        help='Number of cross-validation folds recorded in the manifests (0 to skip).',
+        default=5,
+        type=int)
+    parser.add_argument(
+        '-n', '--num_seeds',
+        help='Number of seeded splits to generate.',
+        default=5,
+        type=int)
     args = parser.parse_args()
 
-    for i in range(5):
+    if args.manifest:
+        for path in write_manifests(args.imageDir, args.outputDir, range(args.num_seeds), args.ratio_list, args.k_folds):
+            print(path)
+        return
+
+    for i in range(args.num_seeds):
         random.seed(i)
         outputDir = args.outputDir + '/DATA_{}'.format(i)
 
         # Now we are ready to start the iteration
-        iterate_dir(args.imageDir, outputDir, args.ratio_list)
+        if args.shards:
+            iterate_dir_shards(args.imageDir, outputDir, args.ratio_list)
+        else:
+            iterate_dir(args.imageDir, outputDir, args.ratio_list)
 
 
 if __name__ == '__main__':
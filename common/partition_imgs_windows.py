@@ -7,8 +7,12 @@ from shutil import copyfile
 import argparse
 import math
 import random
+import sys
 from os import walk
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.manifest import write_manifests
+
 
 def iterate_dir(source, dest, ratio_list):
     # source = source.replace('\\', '/')
@@ -79,11 +83,30 @@ def main():
         help='The ratio of the number of test images over the total number of images. The default is 0.1.',
         default=[0.65, 0.2, 0.15],
         type=list)
+    parser.add_argument(
+        '-m', '--manifest',
+        help='Only write one index manifest (DATA_<seed>.json) per seed instead of copying the images.',
+        action='store_true')
+    parser.add_argument(
+        '-k', '--k_folds',
+        help='Number of cross-validation folds recorded in the manifests (0 to skip).',
+        default=5,
+        type=int)
+    parser.add_argument(
+        '-n', '--num_seeds',
+        help='Number of seeded splits to generate.',
+        default=5,
+        type=int)
     args = parser.parse_args()
 
     if args.outputDir is None:
         args.outputDir = args.imageDir
 
+    if args.manifest:
+        for path in write_manifests(args.imageDir, args.outputDir, range(args.num_seeds), args.ratio_list, args.k_folds):
+            print(path)
+        return
+
     # Now we are ready to start the iteration
     iterate_dir(args.imageDir, args.outputDir, args.ratio_list)
 
@@ -0,0 +1,158 @@
+"""
+Packed shard format for the image splits.
+
+Encoded image files are concatenated into a few large ``<split>-NNNNN.shard``
+files, and a sidecar ``<split>.index.csv`` records, per image, its original
+relative path, class name, shard file, byte offset and length. Readers then
+open a handful of files and seek into them instead of opening thousands of
+small files.
+
+To pack an existing ImageFolder tree run `python common/shards.py <dir>`.
+"""
+import os
+import io
+import csv
+import argparse
+
+from PIL import Image
+from torch.utils.data import Dataset
+from torchvision.datasets.folder import IMG_EXTENSIONS
+
+INDEX_FIELDS = ['path', 'class', 'shard', 'offset', 'length']
+SHARD_SIZE = 1 << 30  # 1 GiB
+
+
+def shard_index_for(directory):
+    """Index file standing in for the image directory `directory` (e.g. DATA_0/train -> DATA_0/train.index.csv)."""
+    return directory.rstrip('/\\') + '.index.csv'
+
+
+class ShardWriter(object):
+    """Append encoded images to sequential shards next to `prefix` and index them."""
+
+    def __init__(self, prefix, shard_size=SHARD_SIZE):
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.num_shards = 0
+        self.shard = None
+        self.offset = 0
+        self.rows = []
+
+    def _next_shard(self):
+        if self.shard is not None:
+            self.shard.close()
+        name = '{}-{:05d}.shard'.format(os.path.basename(self.prefix), self.num_shards)
+        self.shard = open(os.path.join(os.path.dirname(self.prefix), name), 'wb')
+        self.shard_name = name
+        self.num_shards += 1
+        self.offset = 0
+
+    def add_bytes(self, rel_path, class_name, payload):
+        if self.shard is None or (self.offset and self.offset + len(payload) > self.shard_size):
+            self._next_shard()
+        self.shard.write(payload)
+        self.rows.append([rel_path, class_name, self.shard_name, self.offset, len(payload)])
+        self.offset += len(payload)
+
+    def add_file(self, path, rel_path, class_name):
+        with open(path, 'rb') as f:
+            self.add_bytes(rel_path, class_name, f.read())
+
+    def close(self):
+        if self.shard is not None:
+            self.shard.close()
+            self.shard = None
+        with open(shard_index_for(self.prefix), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(INDEX_FIELDS)
+            writer.writerows(self.rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_shard_index(index_path):
+    with open(index_path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+class ShardDataset(Dataset):
+    """Drop-in replacement for `datasets.ImageFolder` backed by packed shards.
+
+    `root` is the directory the shards replace; its index is `shard_index_for(root)`.
+    Classes are sorted by name, exactly like ImageFolder, so labels match.
+    `loader` decodes the bytes of an image from a file object (e.g. `DraftLoader`).
+    """
+
+    def __init__(self, root, transform=None, target_transform=None, loader=None):
+        self.root = root
+        self.loader = loader
+        self.transform = transform
+        self.target_transform = target_transform
+        self.shard_dir = os.path.dirname(shard_index_for(root))
+
+        rows = read_shard_index(shard_index_for(root))
+        self.classes = sorted(set(row['class'] for row in rows))
+        self.class_to_idx = {cls_name: i for i, cls_name in enumerate(self.classes)}
+        self.entries = [(row['shard'], int(row['offset']), int(row['length'])) for row in rows]
+        self.targets = [self.class_to_idx[row['class']] for row in rows]
+        self.samples = [(row['path'], t) for row, t in zip(rows, self.targets)]
+        self.imgs = self.samples
+        # file handles are per process, opened on first access in each worker
+        self._handles = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def read_bytes(self, idx):
+        shard, offset, length = self.entries[idx]
+        f = self._handles.get(shard)
+        if f is None:
+            f = self._handles[shard] = open(os.path.join(self.shard_dir, shard), 'rb')
+        f.seek(offset)
+        return f.read(length)
+
+    def __getitem__(self, idx):
+        stream = io.BytesIO(self.read_bytes(idx))
+        if self.loader is not None:
+            sample = self.loader(stream)
+        else:
+            sample = Image.open(stream).convert('RGB')
+        target = self.targets[idx]
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_handles'] = {}
+        return state
+
+
+def pack_image_folder(root, prefix=None):
+    """Pack an ImageFolder tree `root` (<root>/<class>/<image>) into shards next to it."""
+    prefix = prefix or root.rstrip('/\\')
+    with ShardWriter(prefix) as writer:
+        for class_name in sorted(os.listdir(root)):
+            class_dir = os.path.join(root, class_name)
+            if not os.path.isdir(class_dir):
+                continue
+            for dirpath, _, filenames in sorted(os.walk(class_dir)):
+                for filename in sorted(filenames):
+                    if not filename.lower().endswith(IMG_EXTENSIONS):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    writer.add_file(path, os.path.relpath(path, root), class_name)
+    return shard_index_for(prefix)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pack an image folder into sequential shards")
+    parser.add_argument('root', type=str, help="image folder with one sub-folder per class")
+    args = parser.parse_args()
+    print(pack_image_folder(args.root))
@@ -0,0 +1,70 @@
+"""
+Startup benchmark: time from the start of the process to the first batch.
+
+Every job of a sweep pays for the interpreter, the imports, building or
+loading the model and starting the DataLoader workers before it processes
+anything. `first_batch` is called by the entry points when their first batch
+(or image) is ready; the first call of a process appends the elapsed time to
+startup_performance.csv, later calls do nothing.
+
+The start of the process is read from /proc/self/stat, so the interpreter
+start-up and the imports of the script itself are included; elsewhere the
+clock starts when this module is imported. A process forked by a launcher
+(the fold workers of train_cross_val.py) measures from the start of the
+launcher, see `inherit_start`.
+"""
+import os
+import csv
+import sys
+import time
+
+CSV_FILE = 'startup_performance.csv'
+IMPORT_TIME = time.time()
+_recorded = False
+_start_time = None
+
+
+def since_process_start():
+    """Seconds since this process started."""
+    try:
+        with open('/proc/self/stat') as f:
+            # the fields after the command name, which may contain spaces; starttime is field 22
+            fields = f.read().rsplit(')', 1)[1].split()
+        start = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.time() - IMPORT_TIME
+
+
+def process_start_time():
+    """Wall-clock time at which this process, or the launcher it inherited it from, started."""
+    if _start_time is not None:
+        return _start_time
+    return time.time() - since_process_start()
+
+
+def inherit_start(start_time):
+    """Measure from `start_time` (the `process_start_time` of the launcher) in a forked child."""
+    global _start_time
+    _start_time = start_time
+
+
+def first_batch(model_name, script=None, csv_path=CSV_FILE):
+    """Record the time to the first batch of this process, once."""
+    global _recorded
+    if _recorded:
+        return
+    _recorded = True
+    script = script or os.path.basename(sys.argv[0])
+    elapsed = time.time() - _start_time if _start_time is not None else since_process_start()
+    print('Time to first batch: {:.2f}s'.format(elapsed))
+    if csv_path is None:
+        return
+    if not os.path.isfile(csv_path):
+        with open(csv_path, mode='w') as csv_file:
+            fieldnames = ['Script', 'Model', 'Time to First Batch (s)']
+            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+            writer.writeheader()
+    with open(csv_path, 'a+', newline='') as write_obj:
+        csv_writer = csv.writer(write_obj)
+        csv_writer.writerow([script, model_name, '{:.2f}'.format(elapsed)])
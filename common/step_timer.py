@@ -0,0 +1,105 @@
+"""
+Per-step timing breakdown of the training and inference loops.
+
+`StepTimer.mark(stage)` charges the time since the previous mark to `stage`,
+so a loop only needs one call after each part of the step:
+
+    data       waiting on the DataLoader
+    h2d        host-to-device copy (and the on-device batch transforms)
+    forward    forward pass and loss
+    backward   backward pass
+    optimizer  optimizer step
+    logging    metric bookkeeping
+
+On CUDA every mark synchronizes the device, so that asynchronous kernels are
+charged to the stage that launched them. At the end of an epoch `report` adds
+the mean time of each stage to TensorBoard as scalars and the distribution of
+the step times as histograms, appends the mean and the 50/90/99th percentiles
+to a CSV file, and says whether the loop is input-bound or compute-bound.
+A disabled timer does nothing.
+"""
+import os
+import csv
+import time
+
+import numpy as np
+import torch
+
+STAGES = ['data', 'h2d', 'forward', 'backward', 'optimizer', 'logging']
+
+
+class StepTimer(object):
+
+    def __init__(self, device, enabled=True, stages=STAGES):
+        self.sync = device.type == 'cuda'
+        self.enabled = enabled
+        self.stages = stages
+        self.reset()
+
+    def reset(self):
+        self.times = {stage: [] for stage in self.stages}
+        self.current = dict.fromkeys(self.stages, 0.0)
+        self.last = None
+
+    def start(self):
+        """Call right before the loop that fetches the batches."""
+        if self.enabled:
+            self.last = time.perf_counter()
+
+    def mark(self, stage):
+        if not self.enabled:
+            return
+        if self.sync:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.current[stage] += now - self.last
+        self.last = now
+
+    def end_step(self):
+        if not self.enabled:
+            return
+        for stage in self.stages:
+            self.times[stage].append(self.current[stage])
+        self.current = dict.fromkeys(self.stages, 0.0)
+
+    def summary(self):
+        """{stage: (mean, p50, p90, p99) in seconds} over the recorded steps."""
+        return {stage: (np.mean(t), np.percentile(t, 50), np.percentile(t, 90), np.percentile(t, 99))
+                for stage, t in self.times.items() if t}
+
+    def report(self, phase, epoch, writer=None, csv_path=None, label=()):
+        """Print, log to TensorBoard and append to `csv_path` the breakdown of this epoch, then reset."""
+        if not self.enabled or not self.times[self.stages[0]]:
+            self.reset()
+            return
+        summary = self.summary()
+        total = sum(mean for mean, _, _, _ in summary.values())
+        print('{} step {:.1f} ms: {}'.format(phase, total * 1000, ', '.join(
+            '{} {:.0f}%'.format(stage, 100 * mean / total) for stage, (mean, _, _, _) in summary.items() if mean)))
+        if 'data' in summary:
+            compute = total - summary['data'][0]
+            print('  {}-bound (data wait {:.1f} ms, rest of the step {:.1f} ms)'.format(
+                'input' if summary['data'][0] > compute else 'compute', summary['data'][0] * 1000, compute * 1000))
+
+        tag = phase.capitalize()
+        if writer is not None:
+            for stage, (mean, _, _, _) in summary.items():
+                writer.add_scalar('{}/StepTime/{}'.format(tag, stage), mean * 1000, epoch)
+                writer.add_histogram('{}/StepTimeDist/{}'.format(tag, stage), np.array(self.times[stage]) * 1000,
+                                     epoch)
+            writer.add_scalar('{}/StepTime/total'.format(tag), total * 1000, epoch)
+            writer.flush()
+
+        if csv_path is not None:
+            if not os.path.isfile(csv_path):
+                with open(csv_path, mode='w') as csv_file:
+                    fieldnames = ['Index', 'Model', 'Phase', 'Epoch', 'Stage', 'Mean (ms)', 'P50 (ms)', 'P90 (ms)',
+                                  'P99 (ms)', 'Share (%)']
+                    csv.DictWriter(csv_file, fieldnames=fieldnames).writeheader()
+            with open(csv_path, 'a+', newline='') as write_obj:
+                csv_writer = csv.writer(write_obj)
+                for stage, values in summary.items():
+                    csv_writer.writerow(list(label) + [phase, epoch, stage] +
+                                        ['{:.3f}'.format(v * 1000) for v in values] +
+                                        ['{:.1f}'.format(100 * values[0] / total)])
+        self.reset()
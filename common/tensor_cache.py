@@ -0,0 +1,118 @@
+"""
+Materialized tensor cache for the deterministic splits.
+
+The validation (and test) transform is Resize + CenterCrop + Normalize, so its
+output never changes between epochs. The split is run through it once, the
+result is stored as a memory-mapped .npy array (uint8 pixels or normalized
+fp16) and every later epoch reads contiguous batches straight from it, with
+no decoding and no worker processes.
+"""
+import os
+import fcntl
+import hashlib
+
+import numpy as np
+import torch
+import torch.utils.data as data
+from torchvision import transforms
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+DTYPES = ['uint8', 'fp16']
+
+
+def cache_transform(img_size, dtype='uint8'):
+    if dtype == 'uint8':
+        return transforms.Compose([
+            transforms.Resize(size=img_size),
+            transforms.CenterCrop(size=img_size),
+            transforms.PILToTensor()])
+    return transforms.Compose([
+        transforms.Resize(size=img_size),
+        transforms.CenterCrop(size=img_size),
+        transforms.ToTensor(),
+        transforms.Normalize(MEAN, STD)])
+
+
+def decode_mode(dataset):
+    """How `dataset` decodes its images: 'cache' (shared decode cache), 'draft' (reduced-size JPEG) or 'full'."""
+    from common.image_cache import CachedImageFolder
+    from common.fast_decode import DraftLoader
+    if isinstance(dataset, CachedImageFolder):
+        return 'cache'
+    if isinstance(getattr(dataset, 'loader', None), DraftLoader):
+        return 'draft'
+    return 'full'
+
+
+def cache_name(dataset, split, seed, img_size, dtype):
+    """File stem identifying a split, its members, the seed, the image size, the storage type and the decoding."""
+    digest = hashlib.sha1('\n'.join(p for p, _ in dataset.samples).encode('utf-8')).hexdigest()[:10]
+    return '{}_{}_{}_{}_{}_{}'.format(split, seed, img_size, dtype, decode_mode(dataset), digest)
+
+
+class TensorCache(object):
+    """Batches of a materialized split, already normalized to float32.
+
+    With `num_replicas` > 1 (data-parallel training) rank `rank` only reads
+    every `num_replicas`-th batch.
+    """
+
+    def __init__(self, path, batch_size, num_replicas=1, rank=0):
+        self.inputs = np.load(path + '.npy', mmap_mode='r')
+        self.labels = torch.from_numpy(np.load(path + '.labels.npy'))
+        self.batch_size = batch_size
+        self.starts = range(rank * batch_size, len(self.labels), num_replicas * batch_size)
+        self.uint8 = self.inputs.dtype == np.uint8
+        self.mean = torch.tensor(MEAN).view(1, -1, 1, 1) * 255
+        self.inv_std = 1.0 / (torch.tensor(STD).view(1, -1, 1, 1) * 255)
+
+    @classmethod
+    def build(cls, dataset, cache_dir, split, seed, img_size, batch_size, dtype='uint8', num_workers=0,
+              num_replicas=1, rank=0):
+        """Materialize `dataset` (its transform is replaced by the cache transform) unless already on disk."""
+        path = os.path.join(cache_dir, cache_name(dataset, split, seed, img_size, dtype))
+        if not os.path.isfile(path + '.npy'):
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, exist_ok=True)
+            # concurrent jobs (e.g. the models of a sweep) share the cache, one of them builds it
+            with open(path + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.isfile(path + '.npy'):
+                    cls._materialize(dataset, path, split, img_size, batch_size, dtype, num_workers)
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return cls(path, batch_size, num_replicas, rank)
+
+    @staticmethod
+    def _materialize(dataset, path, split, img_size, batch_size, dtype, num_workers):
+        print('Materializing the {} split to {}.npy ...'.format(split, path))
+        dataset.transform = cache_transform(img_size, dtype)
+        loader = data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        shape = (len(dataset), 3, img_size, img_size)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        inputs = np.lib.format.open_memmap(tmp + '.npy', mode='w+', shape=shape,
+                                           dtype=np.uint8 if dtype == 'uint8' else np.float16)
+        labels = np.zeros(len(dataset), dtype=np.int64)
+        start = 0
+        for batch, targets in loader:
+            inputs[start:start + len(batch)] = batch.numpy() if dtype == 'uint8' else batch.half().numpy()
+            labels[start:start + len(batch)] = targets.numpy()
+            start += len(batch)
+        inputs.flush()
+        del inputs
+        np.save(tmp + '.labels.npy', labels)
+        # the arrays only get their final names once they are complete, the labels first
+        os.replace(tmp + '.labels.npy', path + '.labels.npy')
+        os.replace(tmp + '.npy', path + '.npy')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for start in self.starts:
+            inputs = torch.from_numpy(np.array(self.inputs[start:start + self.batch_size]))
+            if self.uint8:
+                inputs = inputs.float().sub_(self.mean).mul_(self.inv_std)
+            else:
+                inputs = inputs.float()
+            yield inputs, self.labels[start:start + self.batch_size]
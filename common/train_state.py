@@ -0,0 +1,141 @@
+"""
+Resumable training checkpoints, written in the background.
+
+`training_state` takes a CPU snapshot of everything a run needs to continue
+exactly where it stopped: model, optimizer and scheduler state, the next
+epoch, the best-so-far weights and metrics, and the torch, CUDA, NumPy and
+Python RNG states together with the explicit torch generators (DataLoader
+shuffling, batch augmentation). Copying to host memory is a memcpy; the slow
+part, serializing to disk, runs in a thread of `AsyncSaver` while the next
+epoch trains. Files are written to a temporary name and renamed, so a crash
+during a save leaves the previous checkpoint intact.
+
+Resuming is bit-for-bit deterministic as long as the DataLoader workers are
+not persistent: every epoch draws its worker seeds from the restored
+generator. Persistent workers would carry their RNG state over from the
+previous epochs, which a resumed run does not have, so train_1.py and
+train_cross_val.py never use them, also with --autotune_loader. In a
+data-parallel run rank 0 writes the checkpoint with the RNG states of all the
+ranks and sends it to the other ranks on resume.
+"""
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def checkpoint_path(model_path, directory='checkpoints'):
+    """checkpoints/<name of the saved model>.ckpt"""
+    return os.path.join(directory, os.path.splitext(os.path.basename(model_path))[0] + '.ckpt')
+
+
+def cpu_copy(obj):
+    """Copy of nested dicts/lists/tuples with every tensor cloned to host memory."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_copy(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+
+def rng_state(generators):
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'numpy': np.random.get_state(),
+        'python': random.getstate(),
+        'generators': {name: gen.get_state() for name, gen in generators.items()},
+    }
+
+
+def set_rng_state(state, generators):
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and state['cuda']:
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    for name, gen in generators.items():
+        gen.set_state(state['generators'][name])
+
+
+def all_rank_rng_states(generators):
+    """RNG state of every data-parallel rank, in rank order; called on every rank."""
+    import torch.distributed as dist
+    states = [None] * dist.get_world_size()
+    dist.all_gather_object(states, rng_state(generators))
+    return states
+
+
+def training_state(model, optimizer, scheduler, epoch, generators, rank_rng=None, **extra):
+    """Host-memory snapshot of a run about to start `epoch`, plus any `extra` values (best metrics, ...).
+
+    `rank_rng` holds the RNG states of all the ranks of a data-parallel run (`all_rank_rng_states`).
+    """
+    state = {
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
+        'epoch': epoch,
+        'extra': extra,
+    }
+    state = cpu_copy(state)
+    state['rng'] = rng_state(generators)
+    if rank_rng is not None:
+        state['rank_rng'] = rank_rng
+    return state
+
+
+def load_training_state(path, model, optimizer, scheduler, generators, device=None, rank=0, world_size=1):
+    """Restore a checkpoint written from `training_state` (its path, or the loaded checkpoint),
+    return (next epoch, extra values). Each rank of a data-parallel run gets back its own RNG streams."""
+    state = torch.load(path, map_location='cpu', weights_only=False) if isinstance(path, str) else path
+    model.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    scheduler.load_state_dict(state['scheduler'])
+    if world_size > 1 and len(state.get('rank_rng', [])) == world_size:
+        set_rng_state(state['rank_rng'][rank], generators)
+    else:
+        if world_size > 1:
+            print('Checkpoint has no RNG state for {} ranks, every rank resumes with the RNG of rank 0'.format(
+                world_size))
+        set_rng_state(state['rng'], generators)
+    extra = state['extra']
+    if device is not None:
+        extra = {k: v.to(device) if torch.is_tensor(v) else v for k, v in extra.items()}
+    return state['epoch'], extra
+
+
+class AsyncSaver(object):
+    """Write checkpoints from a background thread, one at a time."""
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def _write(self, state, path):
+        try:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            torch.save(state, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            self.error = e
+
+    def save(self, state, path):
+        # the previous checkpoint must be complete before the next one starts
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(state, path))
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
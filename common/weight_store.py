@@ -0,0 +1,158 @@
+"""
+Offline store of the ImageNet-pretrained weights of the model zoo.
+
+torchvision, torch.hub, pretrainedmodels and efficientnet_pytorch each keep
+their own download cache and reach for the network when it is empty. The
+weight store keeps one state_dict per model in one directory, fetched once on
+a machine with network access:
+
+    python -m common.weight_store prefetch --models resnet18 inceptionv4 ... --store_dir weights
+    python -m common.weight_store verify --store_dir weights
+
+and copied to the training hosts. `train_1.py --weight_store weights` then
+builds the architecture without weights and memory-maps the state_dict from
+the store (`torch.load(mmap=True)`, `load_state_dict(assign=True)`): nothing
+is deserialized into fresh tensors, the pages are read on first touch and
+concurrent jobs on one node share them in the page cache until training
+writes to them.
+
+manifest.json records the sha256, size and modification time of every file.
+`prefetch` and `verify` check the sha256. Loading compares the size, and the
+sha256 only when the modification time differs (a copy without -p), since
+hashing hundreds of megabytes would cost more than loading them.
+"""
+import os
+import sys
+import json
+import fcntl
+import hashlib
+import argparse
+
+import torch
+
+MANIFEST_FILE = 'manifest.json'
+LOCK_FILE = 'lock'
+
+
+def sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class WeightStore(object):
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def path(self, name):
+        return os.path.join(self.store_dir, name)
+
+    def manifest(self):
+        if not os.path.isfile(self.path(MANIFEST_FILE)):
+            return {}
+        with open(self.path(MANIFEST_FILE)) as f:
+            return json.load(f)
+
+    def add(self, model_name, state_dict, source):
+        """Write the state_dict of `model_name` and record its checksum."""
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir, exist_ok=True)
+        file_name = model_name + '.pt'
+        torch.save(state_dict, self.path(file_name + '.tmp'))
+        os.replace(self.path(file_name + '.tmp'), self.path(file_name))
+        stat = os.stat(self.path(file_name))
+        entry = {'file': file_name, 'sha256': sha256(self.path(file_name)), 'bytes': stat.st_size,
+                 'mtime': stat.st_mtime, 'source': source}
+        with open(self.path(LOCK_FILE), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = self.manifest()
+            manifest[model_name] = entry
+            with open(self.path(MANIFEST_FILE + '.tmp'), 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(self.path(MANIFEST_FILE + '.tmp'), self.path(MANIFEST_FILE))
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        return entry
+
+    def entry(self, model_name):
+        manifest = self.manifest()
+        if model_name not in manifest:
+            raise FileNotFoundError('No weights of {} in {}, run python -m common.weight_store prefetch --models {} '
+                                    '--store_dir {} on a machine with network access'.format(
+                                        model_name, self.store_dir, model_name, self.store_dir))
+        entry = manifest[model_name]
+        stat = os.stat(self.path(entry['file']))
+        # cp/scp/rsync without -p give the copy a new modification time, the content decides then
+        if stat.st_size != entry['bytes'] or \
+                (stat.st_mtime != entry['mtime'] and sha256(self.path(entry['file'])) != entry['sha256']):
+            raise ValueError('{} changed since it was stored, run python -m common.weight_store verify '
+                             '--store_dir {}'.format(self.path(entry['file']), self.store_dir))
+        return entry
+
+    def load(self, model_name):
+        """Memory-mapped state_dict of `model_name`."""
+        entry = self.entry(model_name)
+        return torch.load(self.path(entry['file']), map_location='cpu', mmap=True, weights_only=True)
+
+    def load_into(self, model, model_name):
+        # assign=True makes the parameters views of the mapped file instead of copying into them
+        model.load_state_dict(self.load(model_name), assign=True)
+        return model
+
+    def verify(self, model_names=None):
+        """Names of the stored models whose file does not match its sha256."""
+        manifest = self.manifest()
+        bad = []
+        for model_name in model_names or sorted(manifest):
+            entry = manifest.get(model_name)
+            if entry is None or not os.path.isfile(self.path(entry['file'])) or \
+                    sha256(self.path(entry['file'])) != entry['sha256']:
+                bad.append(model_name)
+        return bad
+
+
+def prefetch(model_names, store_dir, force=False):
+    """Download the pretrained weights of `model_names` through their backends into the store."""
+    from common.model_zoo import get_spec
+    store = WeightStore(store_dir)
+    manifest = store.manifest()
+    for model_name in model_names:
+        if model_name in manifest and not force and not store.verify([model_name]):
+            print('{} already stored'.format(model_name))
+            continue
+        spec = get_spec(model_name)
+        try:
+            model = spec.build(1000)
+        except Exception as e:
+            print('{}: download failed ({}: {})'.format(model_name, type(e).__name__, e))
+            continue
+        # the builder of the backend, e.g. torchvision_model or pretrainedmodels_model
+        entry = store.add(model_name, model.state_dict(), spec.build.__qualname__.split('.')[0])
+        print('{}: {:.1f} MB, sha256 {}'.format(model_name, entry['bytes'] / 2 ** 20, entry['sha256']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline store of the pretrained weights of the model zoo')
+    parser.add_argument('command', type=str, choices=['prefetch', 'verify'],
+                        help="prefetch: download into the store, verify: check the checksums")
+    parser.add_argument('--models', type=str, nargs='+', required=False, default=None,
+                        help="model names (prefetch: default every registered model, verify: every stored model)")
+    parser.add_argument('--store_dir', type=str, required=False, default='weights', help="weight store directory")
+    parser.add_argument('--force', action='store_true', help="download again even if the weights are stored")
+    args = parser.parse_args()
+
+    model_names = args.models
+    if args.command == 'prefetch':
+        from common.model_zoo import MODELS
+        model_names = model_names or list(MODELS)
+        prefetch(model_names, args.store_dir, args.force)
+    bad = WeightStore(args.store_dir).verify(model_names)
+    for model_name in bad:
+        print('{}: missing or checksum mismatch'.format(model_name))
+    return 1 if bad else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
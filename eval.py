@@ -16,6 +16,28 @@ def parse_args():
     parser.add_argument('--batch_size', type=int, required=False, default=8, help="Training batch size")
     parser.add_argument('--img_size', type=int, required=False, default=512, help="Image Size")
     parser.add_argument('--use_weighting', type=bool, required=False, default=False, help="use weighted cross entropy or not")
+    parser.add_argument('--draft_decode', action='store_true',
+                        help="decode JPEGs at the smallest 1/2, 1/4 or 1/8 scale still at least img_size")
+    parser.add_argument('--autotune_loader', action='store_true',
+                        help="calibrate num_workers/prefetch_factor/persistent_workers once per host and reuse it")
+    parser.add_argument('--tensor_cache_dir', type=str, required=False, default=None,
+                        help="materialize the test split once into this directory and read it from there")
+    parser.add_argument('--tensor_cache_dtype', type=str, required=False, default='uint8', choices=['uint8', 'fp16'],
+                        help="storage type of the materialized test split")
+    parser.add_argument('--channels_last', action='store_true',
+                        help="run the model and its inputs in the channels_last memory format")
+    parser.add_argument('--compile', action='store_true',
+                        help="compile the model with torch.compile (eager fallback if it fails)")
+    parser.add_argument('--no_plots', action='store_true',
+                        help="write the confusion matrix CSV only, without the heatmap (and its plotting imports)")
+    parser.add_argument('--num_workers', type=int, required=False, default=None,
+                        help="DataLoader workers (default: one per CPU)")
+    parser.add_argument('--cache_dir', type=str, required=False, default=None,
+                        help="decode the images once into this shared cache and read them from it (disabled if not set)")
+    parser.add_argument('--use_shards', action='store_true',
+                        help="read the test split from packed shards (partition_imgs_Ubuntu.py --shards)")
+    parser.add_argument('--use_manifest', action='store_true',
+                        help="build the splits from the DATA_<seed>.json manifest over the original images")
     args = parser.parse_args()
     return args
 
@@ -28,10 +50,7 @@ import random
 from torchvision import datasets, transforms
 import torch.utils.data as data
 import multiprocessing
-from sklearn.metrics import confusion_matrix
-import seaborn as sn
-import pandas as pd
-import matplotlib.pyplot as plt
+from common.startup import first_batch
 
 # for reproducing
 torch.manual_seed(args.seeds)
@@ -60,11 +79,11 @@ if not os.path.isfile('eval_performance.csv'):
         writer.writeheader()
 
 # Load the model for evaluation
-model = torch.load(EVAL_MODEL)
+model = torch.load(EVAL_MODEL, weights_only=False)
 model.eval()
 
 # Configure batch size and number of cpu's
-num_cpu = multiprocessing.cpu_count()
+num_cpu = args.num_workers or multiprocessing.cpu_count()
 # Prepare the eval data loader
 eval_transform = transforms.Compose([
     transforms.Resize(size=img_size),
@@ -73,9 +92,25 @@ eval_transform = transforms.Compose([
     transforms.Normalize([0.485, 0.456, 0.406],
                          [0.229, 0.224, 0.225])])
 
-eval_dataset = datasets.ImageFolder(root=EVAL_DIR, transform=eval_transform)
-eval_loader = data.DataLoader(eval_dataset, batch_size=bs, shuffle=True,
-                              num_workers=num_cpu, pin_memory=True)
+# Reduced-size JPEG decoding, for folders, shards and manifests alike
+draft_loader = None
+if args.draft_decode:
+    from common.fast_decode import DraftLoader
+    draft_loader = DraftLoader(img_size)
+
+if args.use_shards:
+    from common.shards import ShardDataset
+    eval_dataset = ShardDataset(EVAL_DIR, transform=eval_transform, loader=draft_loader)
+elif args.use_manifest:
+    from common.manifest import ManifestDataset, manifest_path_for
+    eval_dataset = ManifestDataset(manifest_path_for(args.EVAL_DIR, args.seeds), 'test', transform=eval_transform,
+                                   loader=draft_loader)
+else:
+    loader = draft_loader or datasets.folder.default_loader
+    eval_dataset = datasets.ImageFolder(root=EVAL_DIR, transform=eval_transform, loader=loader)
+if args.cache_dir:
+    from common.image_cache import CachedImageFolder
+    eval_dataset = CachedImageFolder(eval_dataset, args.cache_dir, img_size)
 
 # Enable gpu mode, if cuda available
 if args.device == 0:
@@ -85,6 +120,26 @@ elif args.device == 1:
 else:
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+# channels_last and/or compiled model, eager if the architecture fails to compile
+if args.channels_last or args.compile:
+    from common.accel import accelerate_model, to_channels_last
+    model = accelerate_model(model, model_name, (bs, 3, img_size, img_size), device,
+                             args.channels_last, args.compile, train=False)
+
+# DataLoader settings, calibrated for this machine, model and batch size if asked
+loader_kwargs = {'num_workers': num_cpu}
+if args.autotune_loader:
+    from common.loader_tune import autotune_loader, eval_step_fn, tune_key
+    loader_kwargs = autotune_loader(eval_dataset, bs, eval_step_fn(model, device),
+                                    tune_key(model_name, img_size, bs, mode='eval', args=args))
+if args.tensor_cache_dir:
+    from common.tensor_cache import TensorCache
+    eval_loader = TensorCache.build(eval_dataset, args.tensor_cache_dir, 'test', args.seeds, img_size, bs,
+                                    args.tensor_cache_dtype, num_workers=loader_kwargs['num_workers'])
+else:
+    eval_loader = data.DataLoader(eval_dataset, batch_size=bs, shuffle=True,
+                                  pin_memory=True, **loader_kwargs)
+
 # Number of classes and dataset-size
 num_classes = len(eval_dataset.classes)
 dsize = len(eval_dataset)
@@ -94,31 +149,27 @@ class_names = ['Carpetweeds', 'Crabgrass', 'Eclipta', 'Goosegrass', 'Morningglor
                'PalmerAmaranth', 'PricklySida', 'Purslane', 'Ragweed', 'Sicklepod',
                 'SpottedSpurge', 'SpurredAnoda', 'Swinecress', 'Waterhemp']
 
-# Initialize the prediction and label lists
-predlist = torch.zeros(0, dtype=torch.long, device='cpu')
-lbllist = torch.zeros(0, dtype=torch.long, device='cpu')
-
-# Evaluate the model accuracy on the dataset
-correct = 0
-total = 0
+# Evaluate the model accuracy on the dataset, the counts stay on the device until the end
+from common.metrics import MetricAccumulator
+metrics = MetricAccumulator(num_classes, device)
 with torch.no_grad():
     for images, labels in eval_loader:
+        first_batch(model_name)
         images, labels = images.to(device), labels.to(device)
+        if args.channels_last:
+            images = to_channels_last(images)
         outputs = model(images)
         _, predicted = torch.max(outputs.data, 1)
-
-        total += labels.size(0)
-        correct += (predicted == labels).sum().item()
-
-        predlist = torch.cat([predlist, predicted.view(-1).cpu()])
-        lbllist = torch.cat([lbllist, labels.view(-1).cpu()])
+        metrics.update(predicted, labels)
 
 # Overall accuracy
-overall_accuracy = 100 * correct / total
+_, correct, conf_mat = metrics.result()
+total = metrics.count
+overall_accuracy = 100 * correct.item() / total
 print('Accuracy of the network on the {:d} test images: {:.2f}%'.format(dsize, overall_accuracy))
 
 # Confusion matrix
-conf_mat = confusion_matrix(lbllist.numpy(), predlist.numpy())
+conf_mat = conf_mat.numpy()
 print('Confusion Matrix')
 # print('-' * 16)
 # print(conf_mat, '\n')
@@ -130,24 +181,34 @@ if not os.path.exists('Confusing_Matrices/plots/'):
 if not os.path.exists('Confusing_Matrices/csv/'):
     os.mkdir('Confusing_Matrices/csv/')
 
-
-plt.figure(figsize=(10, 6))
-df_cm = pd.DataFrame(conf_mat, index=class_names,
-                     columns=class_names)
-sn.set(font_scale=1.0)
-sn.heatmap(df_cm, annot=True, annot_kws={"size": 12}, cmap='Greens')
-plt.xticks(rotation=75, fontsize=14)
-plt.tight_layout()
-if args.use_weighting:
-    plt.savefig('Confusing_Matrices/plots/' + model_name + '_cm_' + str(args.seeds) + '_w.png')
-else:
-    plt.savefig('Confusing_Matrices/plots/' + model_name + '_cm_' + str(args.seeds) + '.png')
-# plt.show()
-
+# the plotting libraries are only imported when the heatmap is drawn
+if not args.no_plots:
+    import seaborn as sn
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    plt.figure(figsize=(10, 6))
+    df_cm = pd.DataFrame(conf_mat, index=class_names,
+                         columns=class_names)
+    sn.set(font_scale=1.0)
+    sn.heatmap(df_cm, annot=True, annot_kws={"size": 12}, cmap='Greens')
+    plt.xticks(rotation=75, fontsize=14)
+    plt.tight_layout()
+    if args.use_weighting:
+        plt.savefig('Confusing_Matrices/plots/' + model_name + '_cm_' + str(args.seeds) + '_w.png')
+    else:
+        plt.savefig('Confusing_Matrices/plots/' + model_name + '_cm_' + str(args.seeds) + '.png')
+    # plt.show()
+
+# same layout as DataFrame.to_csv: class names as header and index
 if args.use_weighting:
-    df_cm.to_csv('Confusing_Matrices/csv/' + model_name + '_cm_' + str(args.seeds) + '_w.csv')
+    cm_csv = 'Confusing_Matrices/csv/' + model_name + '_cm_' + str(args.seeds) + '_w.csv'
 else:
-    df_cm.to_csv('Confusing_Matrices/csv/' + model_name + '_cm_' + str(args.seeds) + '.csv')
+    cm_csv = 'Confusing_Matrices/csv/' + model_name + '_cm_' + str(args.seeds) + '.csv'
+with open(cm_csv, 'w', newline='') as write_obj:
+    csv_writer = csv.writer(write_obj, lineterminator='\n')
+    csv_writer.writerow([''] + class_names)
+    for name, row in zip(class_names, conf_mat):
+        csv_writer.writerow([name] + list(row))
 
 # Per-class accuracy
 class_accuracy = 100 * conf_mat.diagonal() / conf_mat.sum(1)
@@ -16,6 +16,16 @@ def parse_args():
     parser.add_argument('--batch_size', type=int, required=False, default=12, help="Training batch size")
     parser.add_argument('--img_size', type=int, required=False, default=512, help="Image Size")
     parser.add_argument('--use_weighting', type=bool, required=False, default=False, help="use weighted cross entropy or not")
+    parser.add_argument('--autotune_loader', action='store_true',
+                        help="calibrate num_workers/prefetch_factor/persistent_workers once per host and reuse it")
+    parser.add_argument('--num_workers', type=int, required=False, default=None,
+                        help="DataLoader workers (default: 32)")
+    parser.add_argument('--cache_dir', type=str, required=False, default=None,
+                        help="decode the images once into this shared cache and read them from it (disabled if not set)")
+    parser.add_argument('--use_manifest', action='store_true',
+                        help="use the images and folds of the DATA_<seed>.json manifest in the training directory")
+    parser.add_argument('--no_plots', action='store_true',
+                        help="write the confusion matrix CSVs only, without the heatmaps (and their plotting imports)")
     args = parser.parse_args()
     return args
 
@@ -24,7 +34,6 @@ args = parse_args()
 import torch, os
 import random
 import numpy as np
-from sklearn.model_selection import KFold
 
 # for reproducing
 torch.manual_seed(args.seeds)
@@ -49,10 +58,9 @@ g.manual_seed(args.seeds)
 
 from torchvision import datasets, transforms
 import torch.utils.data as data
-from sklearn.metrics import confusion_matrix
-import seaborn as sn
-import pandas as pd
-import matplotlib.pyplot as plt
+from common.startup import first_batch
+from common.metrics import MetricAccumulator
+from common.cv_folds import folds_path, fold_model_path, load_folds, sample_paths
 
 
 num_classes = args.num_classes
@@ -66,14 +74,10 @@ if not os.path.isfile('eval_cross_val.csv'):
         writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
         writer.writeheader()
 
-# Set the model save path
 model_name = args.model_name
-if args.use_weighting:
-    EVAL_MODEL = './models/' + model_name + '_' + str(args.seeds) + '_w' + ".pth"
-else:
-    EVAL_MODEL = './models/' + model_name + '_' + str(args.seeds) + ".pth"
+suffix = '_w' if args.use_weighting else ''
 # Number of workers
-num_cpu = 32  # multiprocessing.cpu_count()
+num_cpu = args.num_workers or 32  # multiprocessing.cpu_count()
 
 print(model_name)
 # Applying transforms to the data
@@ -85,93 +89,138 @@ image_transforms = transforms.Compose([
                          [0.229, 0.224, 0.225])])
 
 # Load data from folders
-dataset = datasets.ImageFolder(root=train_directory, transform=image_transforms)
-
-# Load the model for evaluation
-model = torch.load(EVAL_MODEL)
-model.eval()
+if args.use_manifest:
+    from common.manifest import ManifestDataset, manifest_path_for
+    dataset = ManifestDataset(manifest_path_for(train_directory, args.seeds), 'all', transform=image_transforms)
+else:
+    dataset = datasets.ImageFolder(root=train_directory, transform=image_transforms)
+
+# The held-out fold of every image, as persisted by train_cross_val.py for this seed
+if not os.path.isfile(folds_path('models_cv', args.seeds)):
+    raise FileNotFoundError('No fold assignment {}, train the folds of seed {} with train_cross_val.py first'.format(
+        folds_path('models_cv', args.seeds), args.seeds))
+held_out, k_folds = load_folds(folds_path('models_cv', args.seeds))
+paths = sample_paths(dataset)
+missing = [path for path in paths if path not in held_out]
+if missing:
+    raise ValueError('{} of the {} images of {} are not in {} (e.g. {}), was it trained on another '
+                     '--train_directory?'.format(len(missing), len(paths), train_directory,
+                                                 folds_path('models_cv', args.seeds), missing[0]))
+sample_folds = [held_out[path] for path in paths]
 
 # Enable gpu mode, if cuda available
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-# Size of train and validation data
-k_folds = 5
-kfold = KFold(n_splits=k_folds, shuffle=True)
-
-for fold, (train_idx, test_idx) in enumerate(kfold.split(dataset)):
-    if fold != 4:
+# Load the model of every fold for evaluation
+models = {}
+for fold in range(k_folds):
+    # the models of this seed, trained on the split of folds_<seed>.json
+    EVAL_MODEL = fold_model_path(model_name, args.seeds, fold, args.use_weighting)
+    if not os.path.isfile(EVAL_MODEL):
+        print('No model for fold {} ({}), its images are not evaluated'.format(fold, EVAL_MODEL))
         continue
-    test_subsampler = torch.utils.data.SubsetRandomSampler(test_idx)
-
-    # Create iterators for data loading
-    eval_loader = data.DataLoader(dataset, batch_size=bs, num_workers=num_cpu, pin_memory=True, drop_last=True,
-                                 worker_init_fn=seed_worker, generator=g, sampler=test_subsampler)
-
-    # Class label names
-    class_names = ['Carpetweeds', 'Crabgrass', 'Eclipta', 'Goosegrass', 'Morningglory', 'Nutsedge',
-                   'PalmerAmaranth', 'PricklySida', 'Purslane', 'Ragweed', 'Sicklepod',
-                   'SpottedSpurge', 'SpurredAnoda', 'Swinecress', 'Waterhemp']
-
-    # Initialize the prediction and label lists
-    predlist = torch.zeros(0, dtype=torch.long, device='cpu')
-    lbllist = torch.zeros(0, dtype=torch.long, device='cpu')
-
-    # Evaluate the model accuracy on the dataset
-    correct = 0
-    total = 0
-    with torch.no_grad():
-        for images, labels in eval_loader:
-            images, labels = images.to(device), labels.to(device)
-            outputs = model(images)
+    models[fold] = torch.load(EVAL_MODEL, map_location=device, weights_only=False)
+    models[fold].eval()
+if not models:
+    print("No fold model of {} in models_cv/, exiting...".format(model_name))
+    exit()
+
+# Every image once, grouped by held-out fold so that most batches go to a single model
+eval_idx = sorted((i for i, fold in enumerate(sample_folds) if fold in models), key=lambda i: sample_folds[i])
+if not eval_idx:
+    raise ValueError('None of the images of {} is held out by a fold model of {}'.format(train_directory, model_name))
+eval_folds = torch.tensor([sample_folds[i] for i in eval_idx])
+# Serve the decoded images from the shared cache
+if args.cache_dir:
+    from common.image_cache import CachedImageFolder
+    dataset = CachedImageFolder(dataset, args.cache_dir, img_size)
+
+# DataLoader settings, calibrated for this machine, model and batch size if asked
+loader_kwargs = {'num_workers': num_cpu}
+if args.autotune_loader:
+    from common.loader_tune import autotune_loader, eval_step_fn, tune_key
+    loader_kwargs = autotune_loader(data.Subset(dataset, eval_idx), bs, eval_step_fn(next(iter(models.values())), device),
+                                    tune_key(model_name, img_size, bs, mode='eval', args=args), worker_init_fn=seed_worker)
+
+# Create iterators for data loading, in order and without dropping images
+eval_loader = data.DataLoader(data.Subset(dataset, eval_idx), batch_size=bs, shuffle=False, pin_memory=True,
+                              worker_init_fn=seed_worker, generator=g, **loader_kwargs)
+
+# Class label names
+class_names = ['Carpetweeds', 'Crabgrass', 'Eclipta', 'Goosegrass', 'Morningglory', 'Nutsedge',
+               'PalmerAmaranth', 'PricklySida', 'Purslane', 'Ragweed', 'Sicklepod',
+               'SpottedSpurge', 'SpurredAnoda', 'Swinecress', 'Waterhemp']
+
+# Route each image to the model of its held-out fold, one decode of the dataset for all folds
+metrics = {fold: MetricAccumulator(num_classes, device) for fold in models}
+start = 0
+with torch.no_grad():
+    for images, labels in eval_loader:
+        first_batch(model_name)
+        images, labels = images.to(device), labels.to(device)
+        batch_folds = eval_folds[start:start + len(labels)].to(device)
+        start += len(labels)
+        for fold in torch.unique(batch_folds).tolist():
+            mask = batch_folds == fold
+            outputs = models[fold](images[mask])
             _, predicted = torch.max(outputs.data, 1)
-
-            total += labels.size(0)
-            correct += (predicted == labels).sum().item()
-
-            predlist = torch.cat([predlist, predicted.view(-1).cpu()])
-            lbllist = torch.cat([lbllist, labels.view(-1).cpu()])
-
-    # Overall accuracy
-    overall_accuracy = 100 * correct / total
-    print('Accuracy of the network on the {:d} test images: {:.2f}%'.format(len(test_subsampler), overall_accuracy))
-
-    # Confusion matrix
-    conf_mat = confusion_matrix(lbllist.numpy(), predlist.numpy())
-    # print('Confusion Matrix')
-    # print('-' * 16)
-    # print(conf_mat, '\n')
-
-    if not os.path.exists('Confusing_Matrices_cv'):
-        os.mkdir('Confusing_Matrices_cv')
-    if not os.path.exists('Confusing_Matrices_cv/plots/'):
-        os.mkdir('Confusing_Matrices_cv/plots/')
-    if not os.path.exists('Confusing_Matrices_cv/csv/'):
-        os.mkdir('Confusing_Matrices_cv/csv/')
-
-    plt.figure(figsize=(10, 6))
-    df_cm = pd.DataFrame(conf_mat / conf_mat.sum(1), index=class_names, columns=class_names)
-    sn.set(font_scale=1.0)
-    sn.heatmap(df_cm, annot=True, annot_kws={"size": 12}, cmap='Greens', fmt='0.3f')
-    plt.xticks(rotation=75, fontsize=14)
-    plt.tight_layout()
-    if args.use_weighting:
-        plt.savefig('Confusing_Matrices_cv/plots/' + model_name + '_cm_' + str(args.seeds) + '_w.png')
-    else:
-        plt.savefig('Confusing_Matrices_cv/plots/' + model_name + '_cm_' + str(args.seeds) + '.png')
-    # plt.show()
-
-    if args.use_weighting:
-        df_cm.to_csv('Confusing_Matrices_cv/csv/' + model_name + '_cm_' + str(args.seeds) + '_w.csv')
-    else:
-        df_cm.to_csv('Confusing_Matrices_cv/csv/' + model_name + '_cm_' + str(args.seeds) + '.csv')
-
-    # Per-class accuracy
-    class_accuracy = 100 * conf_mat.diagonal() / conf_mat.sum(1)
-    print('Per class accuracy')
-    print('-' * 18)
-    for label, accuracy in zip(class_names, class_accuracy):
-        print('Accuracy of class %8s : %0.2f %%' % (label, accuracy))
+            metrics[fold].update(predicted, labels[mask])
+
+if not os.path.exists('Confusing_Matrices_cv'):
+    os.mkdir('Confusing_Matrices_cv')
+if not os.path.exists('Confusing_Matrices_cv/plots/'):
+    os.mkdir('Confusing_Matrices_cv/plots/')
+if not os.path.exists('Confusing_Matrices_cv/csv/'):
+    os.mkdir('Confusing_Matrices_cv/csv/')
+
+
+def report(index, name, conf_mat):
+    """Print and save the accuracy and the row-normalized confusion matrix of one fold (or of all pooled)."""
+    total = conf_mat.sum()
+    overall_accuracy = 100 * conf_mat.diagonal().sum() / total
+    print('Accuracy of the network on the {:d} test images of {}: {:.2f}%'.format(total, name, overall_accuracy))
+
+    # each row sums to one: the fraction of the images of a class predicted as each class
+    cm = conf_mat / np.maximum(conf_mat.sum(1, keepdims=True), 1)
+    if not args.no_plots:
+        # the plotting libraries are only imported when a heatmap is drawn
+        import seaborn as sn
+        import pandas as pd
+        import matplotlib.pyplot as plt
+        plt.figure(figsize=(10, 6))
+        df_cm = pd.DataFrame(cm, index=class_names, columns=class_names)
+        sn.set(font_scale=1.0)
+        sn.heatmap(df_cm, annot=True, annot_kws={"size": 12}, cmap='Greens', fmt='0.3f')
+        plt.xticks(rotation=75, fontsize=14)
+        plt.tight_layout()
+        plt.savefig('Confusing_Matrices_cv/plots/' + name + '.png')
+        plt.close()
+        # plt.show()
+
+    # same layout as DataFrame.to_csv: class names as header and index
+    with open('Confusing_Matrices_cv/csv/' + name + '.csv', 'w', newline='') as write_obj:
+        csv_writer = csv.writer(write_obj, lineterminator='\n')
+        csv_writer.writerow([''] + class_names)
+        for label, row in zip(class_names, cm):
+            csv_writer.writerow([label] + [float(v) for v in row])
 
     with open('eval_cross_val.csv', 'a+', newline='') as write_obj:
         csv_writer = csv.writer(write_obj)
-        csv_writer.writerow([model_name, overall_accuracy])
\ No newline at end of file
+        csv_writer.writerow([index, model_name, overall_accuracy])
+    return overall_accuracy
+
+
+pooled = np.zeros((num_classes, num_classes), dtype=np.int64)
+for fold in sorted(models):
+    _, _, conf_mat = metrics[fold].result()
+    conf_mat = conf_mat.numpy()
+    pooled += conf_mat
+    report(fold, model_name + '_cm_' + str(args.seeds) + '_fold' + str(fold) + suffix, conf_mat)
+report('all', model_name + '_cm_' + str(args.seeds) + suffix, pooled)
+
+# Per-class accuracy over all folds
+class_accuracy = 100 * pooled.diagonal() / np.maximum(pooled.sum(1), 1)
+print('Per class accuracy')
+print('-' * 18)
+for label, accuracy in zip(class_names, class_accuracy):
+    print('Accuracy of class %8s : %0.2f %%' % (label, accuracy))
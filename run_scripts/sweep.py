@@ -0,0 +1,302 @@
+"""
+Concurrent experiment sweeps, replacing the serial run_scripts/*.sh files.
+
+    python run_scripts/sweep.py --script train_1.py --models resnet18 resnet50 --seeds 0 1 2 3 4 --weighting both
+
+runs every model x seed x weighting combination of the grid, several at a
+time. Each job gets a fixed set of CPUs (its threads and DataLoader workers are
+pinned to them with sched_setaffinity, and OMP/MKL use that many threads) and
+jobs are only started while their CPUs and memory fit on the machine. The
+footprint of a model (average busy CPUs out of the CPUs it was given, and peak
+resident memory of the whole process tree) is measured when its job runs and
+saved in sweep_footprints.json, so later sweeps pack the jobs by what they
+really use; unknown models start with --default_cpus / --default_memory_gb and
+no job gets fewer than --min_cpus. The scripts that take --num_workers get as
+many DataLoader workers as the job has CPUs. Training
+combinations whose models/*.pth (models_cv/*.pth) already exist are skipped,
+failed jobs are retried up to --retries times, and the output of each job goes
+to sweep_logs/<job>.log.
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import subprocess
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FOOTPRINT_FILE = 'sweep_footprints.json'
+# entry points with --num_workers, their DataLoader workers are sized to the CPUs of the job
+WORKER_SCRIPTS = {'train_1.py', 'train_cross_val.py', 'eval.py', 'eval_cross_val.py'}
+# a job busy on this fraction of its CPUs was limited by them, not by its own demand
+SATURATED = 0.9
+
+# the architectures of run_scripts/train.sh, in the same order
+MODELS = ['alexnet', 'vgg11', 'vgg16', 'vgg19', 'resnet18', 'resnet50', 'resnet101', 'squeezenet', 'densenet121',
+          'densenet169', 'densenet161', 'inception', 'inceptionv4', 'googlenet', 'xception', 'mobilenet_v2',
+          'mobilenet_v3_small', 'mobilenet_v3_large', 'shufflenet_v2_x0_5', 'shufflenet_v2_x1_0',
+          'inceptionresnetv2', 'nasnetamobile', 'dpn68', 'polynet', 'mnasnet1_0', 'efficientnet-b0',
+          'efficientnet-b1', 'efficientnet-b2', 'efficientnet-b3', 'efficientnet-b4', 'efficientnet-b5',
+          'resnext50_32x4d', 'resnext101_32x8d', 'RepVGG-A0', 'RepVGG-A1', 'RepVGG-A2', 'RepVGG-B0', 'RepVGG-B1',
+          'RepVGG-B2']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run a model x seed x weighting grid concurrently')
+    parser.add_argument('--script', type=str, required=False, default='train_1.py',
+                        help="train_1.py, train_cross_val.py, eval.py, test.py, ...")
+    parser.add_argument('--models', type=str, nargs='+', required=False, default=MODELS, help="model names")
+    parser.add_argument('--seeds', type=int, nargs='+', required=False, default=[0, 1, 2, 3, 4], help="seeds")
+    parser.add_argument('--weighting', type=str, required=False, default='off', choices=['off', 'on', 'both'],
+                        help="weighted cross entropy off, on, or both")
+    parser.add_argument('--max_cpus', type=int, required=False, default=multiprocessing.cpu_count(),
+                        help="CPUs the sweep may use")
+    parser.add_argument('--memory_fraction', type=float, required=False, default=0.9,
+                        help="fraction of the machine memory the sweep may use")
+    parser.add_argument('--default_cpus', type=int, required=False, default=8,
+                        help="CPUs given to a model whose footprint has not been measured yet")
+    parser.add_argument('--min_cpus', type=int, required=False, default=2,
+                        help="fewest CPUs reserved for a job, whatever its measured footprint")
+    parser.add_argument('--default_memory_gb', type=float, required=False, default=8.0,
+                        help="memory assumed for a model whose footprint has not been measured yet")
+    parser.add_argument('--retries', type=int, required=False, default=1, help="retries of a failed job")
+    parser.add_argument('--log_dir', type=str, required=False, default='sweep_logs', help="job logs")
+    parser.add_argument('--dry_run', action='store_true', help="print the jobs without running them")
+    parser.add_argument('script_args', nargs=argparse.REMAINDER,
+                        help="arguments passed to every job after --, e.g. -- --epochs 50 --precision bf16")
+    args = parser.parse_args()
+    if args.script_args and args.script_args[0] == '--':
+        args.script_args = args.script_args[1:]
+    return args
+
+
+class Job(object):
+
+    def __init__(self, script, model_name, seed, weighting, script_args):
+        self.script = script
+        self.model_name = model_name
+        self.seed = seed
+        self.weighting = weighting
+        self.script_args = script_args
+        self.attempts = 0
+        self.name = '{}_{}_{}{}'.format(os.path.splitext(os.path.basename(script))[0], model_name, seed,
+                                        '_w' if weighting else '')
+
+    def command(self, num_workers=None):
+        """Command line of the job; `num_workers` sizes its DataLoader workers unless the script arguments do."""
+        cmd = [sys.executable, self.script, '--model_name', self.model_name, '--seeds', str(self.seed)]
+        if self.weighting:
+            cmd += ['--use_weighting', 'True']
+        if num_workers and self.script in WORKER_SCRIPTS and self.option('--num_workers', None) is None:
+            cmd += ['--num_workers', str(num_workers)]
+        return cmd + self.script_args
+
+    def footprint_key(self):
+        # the footprint depends on the model and the run settings, not on the seed, the class weights or the
+        # number of epochs
+        settings = list(self.script_args)
+        if '--epochs' in settings:
+            del settings[settings.index('--epochs'):settings.index('--epochs') + 2]
+        return ' '.join([self.script, self.model_name] + settings)
+
+    def option(self, name, default):
+        """Value of `name` in the script arguments as argparse reads it: `name value` or `name=value`, last wins."""
+        value = default
+        for i, arg in enumerate(self.script_args):
+            if arg == name and i + 1 < len(self.script_args):
+                value = self.script_args[i + 1]
+            elif arg.startswith(name + '='):
+                value = arg[len(name) + 1:]
+        return value
+
+    def outputs(self):
+        """Files a finished job leaves behind, empty if the job has to run anyway."""
+        if self.script == 'train_1.py':
+            # --is_augmentation is type=bool: on by default and for any non-empty value, even 'False'
+            augmented = bool(self.option('--is_augmentation', True))
+            suffix = {(True, True): '_wA', (True, False): '_w', (False, True): '_A', (False, False): ''}
+            return ['{}/{}_{}{}.pth'.format(self.option('--model_dir', 'models'), self.model_name, self.seed,
+                                            suffix[(self.weighting, augmented)])]
+        if self.script == 'train_cross_val.py':
+            # the fold models of this seed, models_cv/<model>_<seed>_<fold>[_w].pth as in common/cv_folds.py
+            return ['models_cv/{}_{}_{}{}.pth'.format(self.model_name, self.seed, fold, '_w' if self.weighting else '')
+                    for fold in range(5)]
+        return []
+
+    def done(self):
+        outputs = self.outputs()
+        return bool(outputs) and all(os.path.isfile(os.path.join(ROOT, p)) for p in outputs)
+
+
+def total_memory():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def process_tree(pid):
+    """pid and all its descendants."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                # the command name may contain spaces, the fields after it do not
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        tree.append(p)
+        stack.extend(children.get(p, []))
+    return tree
+
+
+def tree_memory(pid):
+    """Resident memory of a process and its descendants (DataLoader workers) in bytes."""
+    rss = 0
+    for p in process_tree(pid):
+        try:
+            with open('/proc/{}/statm'.format(p)) as f:
+                rss += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, IndexError, ValueError):
+            pass
+    return rss
+
+
+class Sweep(object):
+
+    def __init__(self, jobs, args):
+        self.pending = jobs
+        self.args = args
+        self.free_cpus = sorted(os.sched_getaffinity(0))[:args.max_cpus]
+        self.memory_budget = args.memory_fraction * total_memory()
+        self.running = {}  # pid -> (job, process, cpus, memory, start, peak memory)
+        self.failed = []
+        self.job_time = 0.0
+        self.footprints = {}
+        if os.path.isfile(FOOTPRINT_FILE):
+            with open(FOOTPRINT_FILE) as f:
+                self.footprints = json.load(f)
+
+    def footprint(self, job):
+        """(CPUs, memory in bytes) reserved for the job.
+
+        The busy CPUs of a run are capped by the CPUs it was pinned to: a run that kept them all busy keeps
+        at least that allocation (and --default_cpus), one that did not gets what it used, so a footprint
+        does not shrink run after run. No job gets fewer than --min_cpus.
+        """
+        known = self.footprints.get(job.footprint_key())
+        if known is None:
+            return max(self.args.min_cpus, min(self.args.default_cpus, len(self.free_cpus) or self.args.max_cpus)), \
+                   self.args.default_memory_gb * 2 ** 30
+        cpus = int(math.ceil(known['cpus']))
+        allocated = known.get('allocated_cpus')
+        if allocated and known['cpus'] >= SATURATED * allocated:
+            cpus = max(cpus, allocated, self.args.default_cpus)
+        cpus = min(max(cpus, self.args.min_cpus), self.args.max_cpus)
+        return cpus, known['memory_gb'] * 2 ** 30
+
+    def used_memory(self):
+        return sum(memory for _, _, _, memory, _, _ in self.running.values())
+
+    def start_next(self):
+        """Start the first pending job that fits, return False if none does."""
+        for job in self.pending:
+            cpus, memory = self.footprint(job)
+            fits = cpus <= len(self.free_cpus) and self.used_memory() + memory <= self.memory_budget
+            if fits or (not self.running and self.free_cpus):
+                # a job too large for the machine still runs, alone
+                self.pending.remove(job)
+                self.launch(job, min(cpus, len(self.free_cpus)), memory)
+                return True
+        return False
+
+    def launch(self, job, num_cpus, memory):
+        cpus, self.free_cpus = self.free_cpus[:num_cpus], self.free_cpus[num_cpus:]
+        env = dict(os.environ, OMP_NUM_THREADS=str(num_cpus), MKL_NUM_THREADS=str(num_cpus))
+        job.attempts += 1
+        log = open(os.path.join(self.args.log_dir, job.name + '.log'), 'a')
+        command = job.command(num_workers=num_cpus)
+        log.write('$ {}\n'.format(' '.join(command)))
+        log.flush()
+        process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+                                   preexec_fn=lambda: os.sched_setaffinity(0, cpus))
+        log.close()
+        print('[{}] start {} on {} CPUs (attempt {})'.format(time.strftime('%H:%M:%S'), job.name, num_cpus,
+                                                             job.attempts))
+        self.running[process.pid] = (job, process, cpus, memory, time.time(), 0)
+
+    def poll(self):
+        for pid, (job, process, cpus, memory, start, peak) in list(self.running.items()):
+            peak = max(peak, tree_memory(pid))
+            self.running[pid] = (job, process, cpus, memory, start, peak)
+            finished, status, usage = os.wait4(pid, os.WNOHANG)
+            if finished == 0:
+                continue
+            del self.running[pid]
+            process.returncode = os.waitstatus_to_exitcode(status)
+            self.free_cpus = sorted(self.free_cpus + cpus)
+            elapsed = time.time() - start
+            self.job_time += elapsed
+            code = process.returncode
+            if code == 0:
+                busy_cpus = (usage.ru_utime + usage.ru_stime) / max(elapsed, 1e-6)
+                self.footprints[job.footprint_key()] = {'cpus': round(busy_cpus, 2), 'allocated_cpus': len(cpus),
+                                                        'memory_gb': round(peak / 2 ** 30, 2),
+                                                        'minutes': round(elapsed / 60, 1)}
+                with open(FOOTPRINT_FILE, 'w') as f:
+                    json.dump(self.footprints, f, indent=2, sort_keys=True)
+                print('[{}] done  {} in {:.1f}m ({:.1f} busy CPUs, {:.1f} GB)'.format(
+                    time.strftime('%H:%M:%S'), job.name, elapsed / 60, busy_cpus, peak / 2 ** 30))
+            elif job.attempts <= self.args.retries:
+                print('[{}] {} failed with exit code {}, retrying'.format(time.strftime('%H:%M:%S'), job.name, code))
+                self.pending.append(job)
+            else:
+                print('[{}] {} failed with exit code {}, see {}'.format(
+                    time.strftime('%H:%M:%S'), job.name, code, os.path.join(self.args.log_dir, job.name + '.log')))
+                self.failed.append(job)
+
+    def run(self):
+        since = time.time()
+        while self.pending or self.running:
+            while self.pending and self.start_next():
+                pass
+            time.sleep(1)
+            self.poll()
+        wall = time.time() - since
+        print('Sweep finished in {:.1f}m, the jobs took {:.1f}m in total ({:.1f}x)'.format(
+            wall / 60, self.job_time / 60, self.job_time / max(wall, 1e-6)))
+        if self.failed:
+            print('Failed:', ', '.join(job.name for job in self.failed))
+        return len(self.failed)
+
+
+def main():
+    args = parse_args()
+    weightings = {'off': [False], 'on': [True], 'both': [False, True]}[args.weighting]
+    jobs = [Job(args.script, model_name, seed, weighting, args.script_args)
+            for model_name in args.models for weighting in weightings for seed in args.seeds]
+    todo = [job for job in jobs if not job.done()]
+    print('{} jobs, {} already done'.format(len(jobs), len(jobs) - len(todo)))
+    sweep = Sweep(todo, args)
+    if args.dry_run:
+        for job in todo:
+            print(' '.join(job.command(num_workers=sweep.footprint(job)[0])))
+        return 0
+    if not os.path.exists(args.log_dir):
+        os.makedirs(args.log_dir)
+    # largest known jobs first, they are the hardest to place later
+    sweep.pending.sort(key=lambda job: sweep.footprint(job), reverse=True)
+    return sweep.run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
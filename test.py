@@ -14,6 +14,14 @@ def parse_args():
     parser.add_argument('--device', type=int, required=False, default=0,
                         help="GPU device")
     parser.add_argument('--img_size', type=int, required=False, default=512, help="Image Size")
+    parser.add_argument('--channels_last', action='store_true',
+                        help="run the model and its inputs in the channels_last memory format")
+    parser.add_argument('--compile', action='store_true',
+                        help="compile the model with torch.compile (eager fallback if it fails)")
+    parser.add_argument('--draft_decode', action='store_true',
+                        help="decode JPEGs at the smallest 1/2, 1/4 or 1/8 scale still at least img_size")
+    parser.add_argument('--profile_steps', action='store_true',
+                        help="time decoding, copy and forward of every image into test_step_timing.csv")
     parser.add_argument('--use_weighting', type=bool, required=False, default=False, help="use weighted cross entropy or not")
     args = parser.parse_args()
     return args
@@ -23,6 +31,9 @@ args = parse_args()
 import torch
 from torchvision import transforms
 from PIL import Image
+from common.fast_decode import draft_open
+from common.step_timer import StepTimer
+from common.startup import first_batch
 from pathlib import Path
 import time
 import random
@@ -41,21 +52,19 @@ np.random.seed(args.seeds)
 IMDIR = args.IMDIR
 model_name = args.model_name
 img_size = args.img_size
-since = time.time()
+load_since = time.time()
 if args.use_weighting:
     print(True)
     PATH = 'models/' + model_name + "_" + str(args.seeds) + "_w" + ".pth"
 else:
     PATH = 'models/' + model_name + "_" + str(args.seeds) + ".pth"
 
-if not os.path.isfile('test_performance.csv'):
-    with open('test_performance.csv', mode='w') as csv_file:
-        fieldnames = ['Index', 'Model', 'Testing Time (s)']
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        writer.writeheader()
+# the header, or the header of a file written before the Loading Time column, upgraded
+from common.csv_log import ensure_header
+ensure_header('test_performance.csv', ['Index', 'Model', 'Testing Time (s)', 'Loading Time (s)'])
 
 # Load the model for testing
-model = torch.load(PATH)
+model = torch.load(PATH, weights_only=False)
 model.eval()
 
 # Retrieve 15 random images from directory
@@ -78,18 +87,47 @@ elif args.device == 1:
 else:
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+# channels_last and/or compiled model, eager if the architecture fails to compile
+if args.channels_last or args.compile:
+    from common.accel import accelerate_model, to_channels_last
+    model = accelerate_model(model, model_name, (1, 3, img_size, img_size), device,
+                             args.channels_last, args.compile, train=False)
+
+# the per-image time covers decoding, preprocessing and inference, not loading the model
+if device.type == 'cuda':
+    torch.cuda.synchronize()
+load_time = time.time() - load_since
+timer = StepTimer(device, enabled=args.profile_steps, stages=['data', 'h2d', 'forward'])
+
 # Perform prediction and plot results
+since = time.time()
 with torch.no_grad():
+    timer.start()
     for num, img in enumerate(images):
         img_name = str(img).split('/')[-1]
-        img = Image.open(img).convert('RGB')
-        inputs = preprocess(img).unsqueeze(0).to(device)
+        if args.draft_decode:
+            img = draft_open(img, img_size)
+        else:
+            img = Image.open(img).convert('RGB')
+        inputs = preprocess(img).unsqueeze(0)
+        timer.mark('data')
+        first_batch(model_name)
+        inputs = inputs.to(device)
+        if args.channels_last:
+            inputs = to_channels_last(inputs)
+        timer.mark('h2d')
         outputs = model(inputs)
+        timer.mark('forward')
+        timer.end_step()
 
+if device.type == 'cuda':
+    torch.cuda.synchronize()
 time_elapsed = time.time() - since
+timer.report('test', 0, csv_path='test_step_timing.csv', label=(args.seeds, model_name))
 # print('Testing time per image in {}s'.format(
 #     time_elapsed / len(images)))
 
 with open('test_performance.csv', 'a+', newline='') as write_obj:
     csv_writer = csv.writer(write_obj)
-    csv_writer.writerow([args.seeds, model_name, '{}'.format(time_elapsed / len(images))])
+    csv_writer.writerow([args.seeds, model_name, '{}'.format(time_elapsed / len(images)),
+                         '{:.3f}'.format(load_time)])
@@ -26,6 +26,62 @@ def parse_args():
     parser.add_argument('--batch_size', type=int, required=False, default=12, help="Training batch size")
     parser.add_argument('--img_size', type=int, required=False, default=512, help="Image Size")
     parser.add_argument('--use_weighting', type=bool, required=False, default=False, help="use weighted cross entropy or not")
+    parser.add_argument('--batch_augmentation', action='store_true',
+                        help="keep samples uint8 in the workers and flip/normalize whole batches")
+    parser.add_argument('--draft_decode', action='store_true',
+                        help="decode JPEGs at the smallest 1/2, 1/4 or 1/8 scale still at least img_size")
+    parser.add_argument('--autotune_loader', action='store_true',
+                        help="calibrate num_workers/prefetch_factor/persistent_workers once per host and reuse it")
+    parser.add_argument('--tensor_cache_dir', type=str, required=False, default=None,
+                        help="materialize the validation split once into this directory and read it from there")
+    parser.add_argument('--tensor_cache_dtype', type=str, required=False, default='uint8', choices=['uint8', 'fp16'],
+                        help="storage type of the materialized validation split")
+    parser.add_argument('--precision', type=str, required=False, default='fp32', choices=['fp32', 'bf16'],
+                        help="bf16 runs the forward pass and the loss under autocast, weights stay fp32")
+    parser.add_argument('--channels_last', action='store_true',
+                        help="run the model and its inputs in the channels_last memory format")
+    parser.add_argument('--compile', action='store_true',
+                        help="compile the model with torch.compile (eager fallback if it fails)")
+    parser.add_argument('--effective_batch_size', type=int, required=False, default=None,
+                        help="target batch size reached by gradient accumulation over the largest micro-batch that fits")
+    parser.add_argument('--checkpoint_activations', action='store_true',
+                        help="recompute the activations of the sequential feature stages during backward")
+    parser.add_argument('--checkpoint_segments', type=int, required=False, default=2,
+                        help="number of checkpointed segments per stage (fewer segments, less memory)")
+    parser.add_argument('--distributed', action='store_true',
+                        help="run as one DistributedDataParallel rank (set by python -m common.ddp)")
+    parser.add_argument('--feature_store_dir', type=str, required=False, default='feature_store',
+                        help="where --train_mode transfer keeps the backbone features")
+    parser.add_argument('--feature_passes', type=int, required=False, default=1,
+                        help="augmented views of each training image stored for --train_mode transfer")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue from the last checkpoint of this model, seed and setting if there is one")
+    parser.add_argument('--checkpoint_every', type=int, required=False, default=1,
+                        help="epochs between two resumable checkpoints")
+    parser.add_argument('--best_weights_file', type=str, required=False, default=None,
+                        help="keep the best weights in this memory-mapped file instead of in memory")
+    parser.add_argument('--model_dir', type=str, required=False, default='models',
+                        help="where the trained model is saved")
+    parser.add_argument('--checkpoint_dir', type=str, required=False, default='checkpoints',
+                        help="where the resumable checkpoints are written")
+    parser.add_argument('--performance_csv', type=str, required=False, default='train_performance.csv',
+                        help="CSV file the results of the run are appended to")
+    parser.add_argument('--show_summary', action='store_true',
+                        help="print the model summary (cached per architecture in model_summaries/)")
+    parser.add_argument('--profile_steps', action='store_true',
+                        help="time the parts of every step (data wait, copy, forward, backward, optimizer, logging)")
+    parser.add_argument('--step_timing_csv', type=str, required=False, default='step_timing.csv',
+                        help="CSV file the per-epoch step time percentiles of --profile_steps are appended to")
+    parser.add_argument('--weight_store', type=str, required=False, default=None,
+                        help="memory-map the pretrained weights from this offline store (python -m common.weight_store)")
+    parser.add_argument('--num_workers', type=int, required=False, default=None,
+                        help="DataLoader workers (default: 32)")
+    parser.add_argument('--cache_dir', type=str, required=False, default=None,
+                        help="decode the images once into this shared cache and read them from it (disabled if not set)")
+    parser.add_argument('--use_shards', action='store_true',
+                        help="read the splits from packed shards (partition_imgs_Ubuntu.py --shards)")
+    parser.add_argument('--use_manifest', action='store_true',
+                        help="build the splits from the DATA_<seed>.json manifest over the original images")
     args = parser.parse_args()
     return args
 
@@ -52,8 +108,15 @@ def seed_worker(worker_id):
     random.seed(worker_seed)
 
 
+# Data-parallel ranks (python -m common.ddp train_1.py ...), rank 0 writes all the outputs
+rank, world_size = 0, 1
+if args.distributed:
+    import torch.distributed as dist
+    from common.ddp import init_distributed, all_reduce_sum, on_rank0
+    rank, world_size = init_distributed()
+
 g = torch.Generator()
-g.manual_seed(args.seeds)
+g.manual_seed(args.seeds + rank)
 
 
 from torchvision import datasets, models, transforms
@@ -62,11 +125,13 @@ from torch.utils.tensorboard import SummaryWriter
 import torch.optim as optim
 from torch.optim import lr_scheduler
 import torch.nn as nn
-from torchsummary import summary
 import time, copy
-import pretrainedmodels  # for inception-v4 and xception
-from efficientnet_pytorch import EfficientNet
-from RepVGG.repvgg import create_RepVGG_A0, create_RepVGG_A1, create_RepVGG_A2, create_RepVGG_B0, create_RepVGG_B1, create_RepVGG_B2
+from common.best_weights import BestWeights
+from common.metrics import MetricAccumulator
+from common.step_timer import StepTimer
+from common.startup import first_batch
+from common.batch_probe import peak_memory
+from common.model_zoo import MODELS, build_model, input_size
 
 
 import sys
@@ -76,37 +141,45 @@ sys.path.append("RepVGG/")
 num_classes = args.num_classes
 model_name = args.model_name
 train_mode = args.train_mode
+# transfer mode trains the head on stored 2-D features: nothing to convert to channels_last or worth compiling
+if train_mode == 'transfer' and (args.channels_last or args.compile):
+    print('--channels_last and --compile do not apply to --train_mode transfer, ignored')
+    args.channels_last = args.compile = False
 num_epochs = args.epochs
 bs = args.batch_size
 img_size = args.img_size
 train_directory = args.train_directory + '/DATA_{}'.format(args.seeds) + '/train'
 valid_directory = args.valid_directory + '/DATA_{}'.format(args.seeds) + '/val'
 
-if not os.path.isfile('train_performance.csv'):
-    with open('train_performance.csv', mode='w') as csv_file:
-        fieldnames = ['Index', 'Model', 'Training Time', 'Trainable Parameters', 'Best Train Acc', 'Best Train Epoch',
-                      'Best Val Acc', 'Best Val Epoch']
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        writer.writeheader()
+# the header, or the header of a file written before the Precision and Train Images/s columns, upgraded
+if rank == 0:
+    from common.csv_log import ensure_header
+    ensure_header(args.performance_csv, ['Index', 'Model', 'Training Time', 'Trainable Parameters', 'Best Train Acc',
+                                         'Best Train Epoch', 'Best Val Acc', 'Best Val Epoch', 'Precision',
+                                         'Train Images/s'])
 
 # Set the model save path
 if args.use_weighting:
     print(True)
     if args.is_augmentation:
-        PATH = 'models/' + model_name + "_" + str(args.seeds) + "_wA" + ".pth"
+        PATH = args.model_dir + '/' + model_name + "_" + str(args.seeds) + "_wA" + ".pth"
     else:
-        PATH = 'models/' + model_name + "_" + str(args.seeds) + "_w" + ".pth"
+        PATH = args.model_dir + '/' + model_name + "_" + str(args.seeds) + "_w" + ".pth"
 else:
     if args.is_augmentation:
-        PATH = 'models/' + model_name + "_" + str(args.seeds) + "_A" + ".pth"
+        PATH = args.model_dir + '/' + model_name + "_" + str(args.seeds) + "_A" + ".pth"
     else:
-        PATH = 'models/' + model_name + "_" + str(args.seeds) + ".pth"
+        PATH = args.model_dir + '/' + model_name + "_" + str(args.seeds) + ".pth"
+
+if rank == 0 and not os.path.exists(args.model_dir):
+    os.makedirs(args.model_dir)
 
-if not os.path.exists('models'):
-    os.mkdir('models')
+# Resumable checkpoint of this run, written every --checkpoint_every epochs
+from common.train_state import checkpoint_path, training_state, load_training_state, all_rank_rng_states, AsyncSaver
+CKPT_PATH = checkpoint_path(PATH, args.checkpoint_dir)
 
 # Number of workers
-num_cpu = 32  # multiprocessing.cpu_count()
+num_cpu = args.num_workers or 32  # multiprocessing.cpu_count()
 
 # Applying transforms to the data
 if args.is_augmentation:
@@ -143,12 +216,46 @@ else:
         ])
     }
 
-
-# Load data from folders
-dataset = {
-    'train': datasets.ImageFolder(root=train_directory, transform=image_transforms['train']),
-    'valid': datasets.ImageFolder(root=valid_directory, transform=image_transforms['valid'])
-}
+# Keep the samples uint8 in the workers; flip, cast and normalize whole batches instead
+batch_transforms = {'train': None, 'valid': None}
+if args.batch_augmentation:
+    from common.batch_transforms import uint8_transforms, BatchAugment
+    image_transforms = uint8_transforms(img_size, args.is_augmentation)
+    g_aug = torch.Generator()
+    g_aug.manual_seed(args.seeds)
+    batch_transforms = {'train': BatchAugment(flip=args.is_augmentation, generator=g_aug),
+                        'valid': BatchAugment()}
+
+# Reduced-size JPEG decoding, for folders, shards and manifests alike
+draft_loader = None
+if args.draft_decode:
+    from common.fast_decode import DraftLoader
+    draft_loader = DraftLoader(img_size)
+
+# Load data from folders, packed shards or a split manifest
+if args.use_shards:
+    from common.shards import ShardDataset
+    dataset = {
+        'train': ShardDataset(train_directory, transform=image_transforms['train'], loader=draft_loader),
+        'valid': ShardDataset(valid_directory, transform=image_transforms['valid'], loader=draft_loader)
+    }
+elif args.use_manifest:
+    from common.manifest import ManifestDataset, manifest_path_for
+    manifest = manifest_path_for(args.train_directory, args.seeds)
+    dataset = {
+        'train': ManifestDataset(manifest, 'train', transform=image_transforms['train'], loader=draft_loader),
+        'valid': ManifestDataset(manifest, 'val', transform=image_transforms['valid'], loader=draft_loader)
+    }
+else:
+    loader = draft_loader or datasets.folder.default_loader
+    dataset = {
+        'train': datasets.ImageFolder(root=train_directory, transform=image_transforms['train'], loader=loader),
+        'valid': datasets.ImageFolder(root=valid_directory, transform=image_transforms['valid'], loader=loader)
+    }
+# Serve the decoded images from the shared cache
+if args.cache_dir:
+    from common.image_cache import CachedImageFolder
+    dataset = {phase: CachedImageFolder(dataset[phase], args.cache_dir, img_size) for phase in dataset}
 
 # Size of train and validation data
 dataset_sizes = {
@@ -156,15 +263,6 @@ dataset_sizes = {
     'valid': len(dataset['valid'])
 }
 
-# Create iterators for data loading
-dataloaders = {
-    'train': data.DataLoader(dataset['train'], batch_size=bs, shuffle=True,
-                             num_workers=num_cpu, pin_memory=True, drop_last=True,
-                             worker_init_fn=seed_worker, generator=g),
-    'valid': data.DataLoader(dataset['valid'], batch_size=bs, shuffle=True,
-                             num_workers=num_cpu, pin_memory=True, drop_last=True,
-                             worker_init_fn=seed_worker, generator=g)}
-
 # Class names or target labels
 class_names = dataset['train'].classes
 print("Classes:", class_names)
@@ -177,162 +275,14 @@ print("\nLoading pretrained-model for finetuning ...\n")
 model_ft = None
 
 
-if model_name == 'resnet18':
-    # Modify fc layers to match num_classes
-    model_ft = models.resnet18(pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'resnext50_32x4d':
-    torch.hub._validate_not_a_forked_repo = lambda a, b, c: True
-    model_ft = torch.hub.load('pytorch/vision:v0.10.0', 'resnext50_32x4d', pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'resnext101_32x8d':
-    torch.hub._validate_not_a_forked_repo = lambda a, b, c: True
-    model_ft = torch.hub.load('pytorch/vision:v0.10.0', 'resnext101_32x8d', pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'resnet50':
-    # Modify fc layers to match num_classes
-    model_ft = models.resnet50(pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'resnet101':
-    # Modify fc layers to match num_classes
-    model_ft = models.resnet101(pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'alexnet':
-    model_ft = models.alexnet(pretrained=True)
-    model_ft.classifier[6] = nn.Linear(4096, num_classes)
-elif model_name == 'vgg11':
-    model_ft = models.vgg11(pretrained=True)
-    model_ft.classifier[6] = nn.Linear(4096, num_classes)
-elif model_name == 'vgg16':
-    model_ft = models.vgg16(pretrained=True)
-    model_ft.classifier[6] = nn.Linear(4096, num_classes)
-elif model_name == 'vgg19':
-    model_ft = models.vgg19(pretrained=True)
-    model_ft.classifier[6] = nn.Linear(4096, num_classes)
-elif model_name == 'squeezenet':
-    model_ft = models.squeezenet1_0(pretrained=True)
-    model_ft.classifier[1] = nn.Conv2d(512, num_classes, kernel_size=(1, 1), stride=(1, 1))
-elif model_name == 'densenet121':
-    model_ft = models.densenet121(pretrained=True)
-    num_ftrs = model_ft.classifier.in_features
-    model_ft.classifier = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'densenet169':
-    model_ft = models.densenet169(pretrained=True)
-    num_ftrs = model_ft.classifier.in_features
-    model_ft.classifier = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'densenet161':
-    model_ft = models.densenet161(pretrained=True)
-    num_ftrs = model_ft.classifier.in_features
-    model_ft.classifier = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'inception':
-    model_ft = models.inception_v3(pretrained=True)
-    model_ft.aux_logits = False
-    # Handle the auxilary net
-    num_ftrs = model_ft.AuxLogits.fc.in_features
-    model_ft.AuxLogits.fc = nn.Linear(num_ftrs, num_classes)
-    # Handle the primary net
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'inceptionv4':
-    model_ft = pretrainedmodels.inceptionv4(pretrained='imagenet')
-    num_ftrs = model_ft.last_linear.in_features
-    model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'googlenet':
-    model_ft = models.googlenet(pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'xception':
-    model_ft = pretrainedmodels.xception(pretrained='imagenet')
-    num_ftrs = model_ft.last_linear.in_features
-    model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'mobilenet_v2':
-    model_ft = models.mobilenet_v2(pretrained=True)
-    model_ft.classifier[1] = nn.Linear(model_ft.last_channel, num_classes)
-elif model_name == 'mobilenet_v3_small':
-    model_ft = models.mobilenet_v3_small(pretrained=True)
-    model_ft.classifier[3] = nn.Linear(model_ft.classifier[3].in_features, num_classes)
-elif model_name == 'mobilenet_v3_large':
-    model_ft = models.mobilenet_v3_large(pretrained=True)
-    model_ft.classifier[3] = nn.Linear(model_ft.classifier[3].in_features, num_classes)
-elif model_name == 'shufflenet_v2_x0_5':
-    model_ft = models.shufflenet_v2_x0_5(pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'shufflenet_v2_x1_0':
-    model_ft = models.shufflenet_v2_x1_0(pretrained=True)
-    num_ftrs = model_ft.fc.in_features
-    model_ft.fc = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'inceptionresnetv2':
-    model_ft = pretrainedmodels.inceptionresnetv2(pretrained='imagenet')
-    num_ftrs = model_ft.last_linear.in_features
-    model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'nasnetamobile':
-    model_ft = pretrainedmodels.nasnetamobile(num_classes=1000, pretrained='imagenet')
-    num_ftrs = model_ft.last_linear.in_features
-    model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'dpn68':
-    model_ft = pretrainedmodels.dpn68(pretrained='imagenet')
-    model_ft.last_linear = nn.Conv2d(832, num_classes, kernel_size=(1, 1), stride=(1, 1))
-elif model_name == 'polynet':
-    model_ft = pretrainedmodels.polynet(num_classes=1000, pretrained='imagenet')
-    num_ftrs = model_ft.last_linear.in_features
-    model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'mnasnet1_0':
-    model_ft = models.mnasnet1_0(pretrained=True)
-    num_ftrs = model_ft.classifier[1].in_features
-    model_ft.classifier[1] = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'efficientnet-b0':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b0', num_classes=num_classes)
-elif model_name == 'efficientnet-b1':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b1', num_classes=num_classes)
-elif model_name == 'efficientnet-b2':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b2', num_classes=num_classes)
-elif model_name == 'efficientnet-b3':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b3', num_classes=num_classes)
-elif model_name == 'efficientnet-b4':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b4', num_classes=num_classes)
-elif model_name == 'efficientnet-b5':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b5', num_classes=num_classes)
-elif model_name == 'efficientnet-b6':
-    model_ft = EfficientNet.from_pretrained('efficientnet-b6', num_classes=num_classes)
-elif model_name == 'RepVGG-A0':
-    model_ft = create_RepVGG_A0(deploy=False)
-    model_ft.load_state_dict(torch.load('RepVGG/RepVGG-A0-train.pth'))  # or train from scratch
-    num_ftrs = model_ft.linear.in_features
-    model_ft.linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'RepVGG-A1':
-    model_ft = create_RepVGG_A1(deploy=False)
-    model_ft.load_state_dict(torch.load('RepVGG/RepVGG-A1-train.pth'))  # or train from scratch
-    num_ftrs = model_ft.linear.in_features
-    model_ft.linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'RepVGG-A2':
-    model_ft = create_RepVGG_A2(deploy=False)
-    model_ft.load_state_dict(torch.load('RepVGG/RepVGG-A2-train.pth'))  # or train from scratch
-    num_ftrs = model_ft.linear.in_features
-    model_ft.linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'RepVGG-B0':
-    model_ft = create_RepVGG_B0(deploy=False)
-    model_ft.load_state_dict(torch.load('RepVGG/RepVGG-B0-train.pth'))  # or train from scratch
-    num_ftrs = model_ft.linear.in_features
-    model_ft.linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'RepVGG-B1':
-    model_ft = create_RepVGG_B1(deploy=False)
-    model_ft.load_state_dict(torch.load('RepVGG/RepVGG-B1-train.pth'))  # or train from scratch
-    num_ftrs = model_ft.linear.in_features
-    model_ft.linear = nn.Linear(num_ftrs, num_classes)
-elif model_name == 'RepVGG-B2':
-    model_ft = create_RepVGG_B2(deploy=False)
-    model_ft.load_state_dict(torch.load('RepVGG/RepVGG-B2-train.pth'))  # or train from scratch
-    num_ftrs = model_ft.linear.in_features
-    model_ft.linear = nn.Linear(num_ftrs, num_classes)
-else:
+if model_name not in MODELS:
     print("Invalid model name, exiting...")
     exit()
+weight_store = None
+if args.weight_store:
+    from common.weight_store import WeightStore
+    weight_store = WeightStore(args.weight_store)
+model_ft = build_model(model_name, num_classes, weight_store)
 
 # Transfer the model to GPU
 if args.device == 0:
@@ -344,17 +294,10 @@ else:
 # model_ft = nn.DataParallel(model_ft)
 model_ft = model_ft.to(device)
 
-# Print model summary
-print('Model Summary:-\n')
-for num, (name, param) in enumerate(model_ft.named_parameters()):
-    print(num, name, param.requires_grad)
-if model_name == 'inception':
-    summary(model_ft, input_size=(3, 299, 299))
-elif model_name == 'densenet121' or 'densenet161' or 'resnext50_32x4d' or 'resnext101_32x8d':
-    pass
-else:
-    summary(model_ft, input_size=(3, img_size, img_size))
-print(model_ft)
+# Print model summary, computed once per architecture and cached in model_summaries/
+if args.show_summary and rank == 0:
+    from common.model_summary import model_summary
+    print(model_summary(model_ft, model_name, num_classes, input_size(model_name, img_size), device))
 
 # for class unbalance
 if args.use_weighting:
@@ -368,6 +311,41 @@ else:
     weights = np.array([1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
     class_weight = torch.FloatTensor(list(weights)).to(device)
 
+# Activation checkpointing, with peak memory and step time measured with and without it
+if args.checkpoint_activations:
+    from common.checkpointing import checkpoint_activations, checkpoint_report, remove_checkpointing
+    if checkpoint_activations(model_ft, model_name, args.checkpoint_segments):
+        checkpoint_report(model_ft, model_name, (bs, 3, img_size, img_size), device, args.checkpoint_segments,
+                          args.precision)
+
+# Transfer learning: only the classification head is trained
+if train_mode == 'transfer':
+    from common.feature_store import freeze_backbone, feature_loaders
+    head_ft = freeze_backbone(model_ft, model_name)
+
+# Reach the effective batch size with the largest micro-batch that fits in memory
+accum_steps = 1
+if args.effective_batch_size:
+    from common.batch_probe import probe_max_batch, probe_key, micro_batch_for
+    key = probe_key(model_name, img_size, args.precision,
+                    args.checkpoint_segments if args.checkpoint_activations else 0, args.channels_last)
+    probe = lambda: probe_max_batch(model_ft, img_size, device, args.effective_batch_size, key, args.precision,
+                                    channels_last=args.channels_last)
+    # rank 0 probes, every rank then runs the same micro-batch and number of backward passes
+    max_batch = on_rank0(probe) if args.distributed else probe()
+    bs, accum_steps = micro_batch_for(args.effective_batch_size, max_batch)
+    print('Effective batch size {}: {} micro-batches of {}'.format(args.effective_batch_size, accum_steps, bs))
+
+# channels_last and/or compiled model, eager if the architecture fails to compile
+if args.channels_last or args.compile:
+    from common.accel import accelerate_model, to_channels_last, unwrap
+    model_ft = accelerate_model(model_ft, model_name, (bs, 3, img_size, img_size), device,
+                                args.channels_last, args.compile, steps_per_epoch=dataset_sizes['train'] // bs)
+
+# One replica per rank, gradients are all-reduced during backward (in transfer mode only the head's, see below)
+if args.distributed and train_mode != 'transfer':
+    model_ft = nn.parallel.DistributedDataParallel(model_ft)
+
 pytorch_total_params = sum(p.numel() for p in model_ft.parameters() if p.requires_grad)
 # print("Total parameters:", pytorch_total_params)
 # Loss function
@@ -379,6 +357,60 @@ optimizer_ft = optim.SGD(model_ft.parameters(), lr=0.001, momentum=0.9)
 # Learning rate decay
 exp_lr_scheduler = lr_scheduler.StepLR(optimizer_ft, step_size=7, gamma=0.1)
 
+# DataLoader settings, calibrated for this machine, model and batch size if asked
+loader_kwargs = {'num_workers': num_cpu}
+if args.autotune_loader:
+    from common.loader_tune import autotune_loader, train_step_fn, tune_key
+    # calibrated on the local replica: the steps of the DDP model would wait for the gradients of the other ranks
+    tune_model = model_ft.module if isinstance(model_ft, nn.parallel.DistributedDataParallel) else model_ft
+    tune = lambda: autotune_loader(dataset['train'], bs,
+                                   train_step_fn(tune_model, criterion, device, batch_transforms['train']),
+                                   tune_key(model_name, img_size, bs, args=args), model=tune_model, worker_init_fn=seed_worker,
+                                   persistent=False)
+    # rank 0 calibrates (and reads/writes loader_tune.json) alone, the other ranks get its settings
+    loader_kwargs = on_rank0(tune) if args.distributed else tune()
+
+# Each rank reads its own part of the splits, reshuffled by the seed and the epoch
+samplers = {'train': None, 'valid': None}
+if args.distributed:
+    from torch.utils.data.distributed import DistributedSampler
+    samplers = {phase: DistributedSampler(dataset[phase], num_replicas=world_size, rank=rank, shuffle=True,
+                                          seed=args.seeds, drop_last=True) for phase in dataset}
+
+# Create iterators for data loading
+dataloaders = {
+    'train': data.DataLoader(dataset['train'], batch_size=bs, shuffle=samplers['train'] is None,
+                             sampler=samplers['train'], pin_memory=True, drop_last=True,
+                             worker_init_fn=seed_worker, generator=g, **loader_kwargs),
+    'valid': data.DataLoader(dataset['valid'], batch_size=bs, shuffle=samplers['valid'] is None,
+                             sampler=samplers['valid'], pin_memory=True, drop_last=True,
+                             worker_init_fn=seed_worker, generator=g, **loader_kwargs)}
+
+# Serve the deterministic validation split from its materialized tensors
+if args.tensor_cache_dir:
+    from common.tensor_cache import TensorCache
+    if args.distributed and rank != 0:
+        dist.barrier()  # rank 0 materializes the split first
+    dataloaders['valid'] = TensorCache.build(dataset['valid'], args.tensor_cache_dir, 'valid', args.seeds, img_size, bs,
+                                             args.tensor_cache_dtype, num_workers=loader_kwargs['num_workers'],
+                                             num_replicas=world_size, rank=rank)
+    if args.distributed and rank == 0:
+        dist.barrier()
+    batch_transforms['valid'] = None
+
+# Run the frozen backbone once, then train the head on the stored features every epoch
+if train_mode == 'transfer':
+    dataloaders, transfer_head = feature_loaders(model_ft, head_ft, model_name, dataset, image_transforms,
+                                                 batch_transforms, args.feature_store_dir, img_size, bs, device,
+                                                 passes=args.feature_passes, augmented=args.is_augmentation,
+                                                 generator=g, num_workers=loader_kwargs['num_workers'],
+                                                 num_replicas=world_size, rank=rank, seed=args.seeds)
+    batch_transforms = {'train': None, 'valid': None}
+    # each rank trains on its share of the features, the head's gradients are all-reduced
+    if args.distributed:
+        transfer_head = nn.parallel.DistributedDataParallel(transfer_head)
+    full_model_ft, model_ft = model_ft, transfer_head
+
 # Model training routine 
 print("\nTraining:-\n")
 
@@ -386,25 +418,61 @@ print("\nTraining:-\n")
 def train_model(model, criterion, optimizer, scheduler, num_epochs=50):
     since = time.time()
 
-    best_model_wts = copy.deepcopy(model.state_dict())
+    # one preallocated copy of the best weights, updated in place on every improvement
+    best_weights = BestWeights(model, args.best_weights_file)
     best_train_acc = 0.0
     best_train_epoch = 0
     best_val_epoch = 0
     best_val_acc = 0.0
-
-    if args.use_weighting:
-        # Tensorboard summary
-        if args.is_augmentation:
-            writer = SummaryWriter(log_dir=('./runs/' + model_name + '_wA' + '/' + str(args.seeds)))
-        else:
-            writer = SummaryWriter(log_dir=('./runs/' + model_name + '_w' + '/' + str(args.seeds)))
-    else:
-        if args.is_augmentation:
-            writer = SummaryWriter(log_dir=('./runs/' + model_name + '/' + str(args.seeds) + '_A'))
+    use_bf16 = args.precision == 'bf16'
+    train_throughput = []
+    timer = StepTimer(device, enabled=args.profile_steps)
+
+    # only rank 0 writes the Tensorboard summary
+    writer = None
+    if rank == 0:
+        if args.use_weighting:
+            # Tensorboard summary
+            if args.is_augmentation:
+                writer = SummaryWriter(log_dir=('./runs/' + model_name + '_wA' + '/' + str(args.seeds)))
+            else:
+                writer = SummaryWriter(log_dir=('./runs/' + model_name + '_w' + '/' + str(args.seeds)))
         else:
-            writer = SummaryWriter(log_dir=('./runs/' + model_name + '/' + str(args.seeds)))
-
-    for epoch in range(num_epochs):
+            if args.is_augmentation:
+                writer = SummaryWriter(log_dir=('./runs/' + model_name + '/' + str(args.seeds) + '_A'))
+            else:
+                writer = SummaryWriter(log_dir=('./runs/' + model_name + '/' + str(args.seeds)))
+
+    # RNG streams that must continue where they stopped when resuming
+    generators = {'loader': g}
+    if args.batch_augmentation:
+        generators['augment'] = g_aug
+    saver = AsyncSaver()
+    start_epoch, elapsed = 0, 0.0
+    resume_state = None
+    if args.resume:
+        read = lambda: torch.load(CKPT_PATH, map_location='cpu', weights_only=False) \
+            if os.path.isfile(CKPT_PATH) else None
+        # rank 0's checkpoint for every rank, the ranks of other nodes do not see its file
+        resume_state = on_rank0(read) if args.distributed else read()
+    if resume_state is not None and resume_state['epoch'] > num_epochs:
+        # a run with a larger budget (an earlier search, other --epochs) is not a prefix of this one
+        print('{} is at epoch {}, past the {} epochs of this run: training from scratch'.format(
+            CKPT_PATH, resume_state['epoch'], num_epochs))
+        resume_state = None
+    if resume_state is not None:
+        start_epoch, best = load_training_state(resume_state, model, optimizer, scheduler, generators, device,
+                                                rank, world_size)
+        best_weights.load_state_dict(best['best_model_wts'])
+        best_train_acc, best_train_epoch = best['best_train_acc'], best['best_train_epoch']
+        best_val_acc, best_val_epoch = best['best_val_acc'], best['best_val_epoch']
+        train_throughput, elapsed = best['train_throughput'], best['elapsed']
+        for loader in dataloaders.values():
+            if hasattr(loader, 'epoch'):  # stored feature views cycle with the epochs
+                loader.epoch = start_epoch
+        print('Resuming from {} at epoch {}'.format(CKPT_PATH, start_epoch))
+
+    for epoch in range(start_epoch, num_epochs):
         print('Epoch {}/{}'.format(epoch, num_epochs - 1))
         print('-' * 10)
 
@@ -415,71 +483,118 @@ def train_model(model, criterion, optimizer, scheduler, num_epochs=50):
             else:
                 model.eval()  # Set model to evaluate mode
 
-            running_loss = 0.0
-            running_corrects = 0
+            metrics = MetricAccumulator(num_classes, device)
+            num_images = 0
+            phase_since = time.time()
+            if samplers[phase] is not None:
+                samplers[phase].set_epoch(epoch)
 
             # Iterate over data.
-            for inputs, labels in dataloaders[phase]:
+            timer.start()
+            for step, (inputs, labels) in enumerate(dataloaders[phase]):
+                timer.mark('data')
+                first_batch(model_name, csv_path='startup_performance.csv' if rank == 0 else None)
                 inputs = inputs.to(device, non_blocking=True)
                 labels = labels.to(device, non_blocking=True)
+                if batch_transforms[phase] is not None:
+                    inputs = batch_transforms[phase](inputs)
+                if args.channels_last:
+                    inputs = to_channels_last(inputs)
+                timer.mark('h2d')
 
-                # zero the parameter gradients
-                optimizer.zero_grad()
+                # zero the parameter gradients at the start of each accumulation window
+                if step % accum_steps == 0:
+                    optimizer.zero_grad()
 
                 # forward
                 # track history if only in train
                 with torch.set_grad_enabled(phase == 'train'):
-                    outputs = model(inputs)
+                    # bf16 autocast for the forward and the loss only, the master weights stay fp32
+                    with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                        outputs = model(inputs)
+                        loss = criterion(outputs, labels)
                     _, preds = torch.max(outputs, 1)
-                    loss = criterion(outputs, labels)
+                    timer.mark('forward')
 
                     # backward + optimize only if in training phase
                     if phase == 'train':
-                        loss.backward()
-                        optimizer.step()
-
-                # statistics
-                running_loss += loss.item() * inputs.size(0)
-                running_corrects += torch.sum(preds == labels.data)
+                        (loss / accum_steps).backward()
+                        timer.mark('backward')
+                        if (step + 1) % accum_steps == 0 or step + 1 == len(dataloaders[phase]):
+                            optimizer.step()
+                        timer.mark('optimizer')
+
+                # statistics, kept on the device until the end of the phase
+                metrics.update(preds, labels, loss)
+                num_images += inputs.size(0)
+                timer.mark('logging')
+                timer.end_step()
             if phase == 'train':
                 scheduler.step()
+            running_loss, running_corrects, _ = metrics.result()
+            if args.distributed:
+                running_loss, running_corrects, num_images = all_reduce_sum(
+                    [running_loss, float(running_corrects), num_images])
+                running_corrects = torch.tensor(running_corrects)
+            images_per_sec = num_images / (time.time() - phase_since)
 
             epoch_loss = running_loss / dataset_sizes[phase]
             epoch_acc = running_corrects.double() / dataset_sizes[phase]
 
-            print('{} Loss: {:.4f} Acc: {:.4f}'.format(
-                phase, epoch_loss, epoch_acc))
+            print('{} Loss: {:.4f} Acc: {:.4f} ({:.1f} images/s)'.format(
+                phase, epoch_loss, epoch_acc, images_per_sec))
+            timer.report(phase, epoch, writer, args.step_timing_csv if rank == 0 else None,
+                         label=(args.seeds, model_name))
 
             # Record training loss and accuracy for each phase
             if phase == 'train':
-                writer.add_scalar('Train/Loss', epoch_loss, epoch)
-                writer.add_scalar('Train/Accuracy', epoch_acc, epoch)
-                writer.flush()
+                if writer is not None:
+                    writer.add_scalar('Train/Loss', epoch_loss, epoch)
+                    writer.add_scalar('Train/Accuracy', epoch_acc, epoch)
+                    writer.add_scalar('Train/Throughput', images_per_sec, epoch)
+                    writer.flush()
+                train_throughput.append(images_per_sec)
                 if epoch_acc > best_train_acc:
                     best_train_acc = epoch_acc
                     best_train_epoch = epoch
-            else:
+            elif writer is not None:
                 writer.add_scalar('Valid/Loss', epoch_loss, epoch)
                 writer.add_scalar('Valid/Accuracy', epoch_acc, epoch)
                 writer.flush()
 
-            # deep copy the model
+            # keep a copy of the best weights
             if phase == 'valid' and epoch_acc > best_val_acc:
                 best_val_acc = epoch_acc
-                best_model_wts = copy.deepcopy(model.state_dict())
+                copy_time = best_weights.update(model)
                 best_val_epoch = epoch
+                print('Best weights ({:.0f} MB) updated in {:.1f} ms, peak memory {:.2f} GB'.format(
+                    best_weights.nbytes / 2 ** 20, copy_time * 1000, peak_memory(device) / 2 ** 30))
         print()
 
-    time_elapsed = time.time() - since
-
-    with open('train_performance.csv', 'a+', newline='') as write_obj:
-        csv_writer = csv.writer(write_obj)
-        csv_writer.writerow([args.seeds, model_name, '{:.0f}m'.format(
-            time_elapsed // 60), pytorch_total_params, '{:4f}'.format(best_train_acc.cpu().numpy()),
-                             best_train_epoch, '{:4f}'.format(best_val_acc.cpu().numpy()), best_val_epoch])
+        # snapshot to host memory now, written to disk while the next epoch runs
+        if (epoch + 1) % args.checkpoint_every == 0 or epoch + 1 == num_epochs:
+            # every rank's RNG streams, each rank was seeded with args.seeds + rank
+            rank_rng = all_rank_rng_states(generators) if args.distributed else None
+            if rank == 0:
+                saver.save(training_state(model, optimizer, scheduler, epoch + 1, generators, rank_rng=rank_rng,
+                                          best_model_wts=best_weights.state_dict(), best_train_acc=best_train_acc,
+                                          best_train_epoch=best_train_epoch, best_val_acc=best_val_acc,
+                                          best_val_epoch=best_val_epoch, train_throughput=train_throughput,
+                                          elapsed=elapsed + time.time() - since), CKPT_PATH)
+    saver.wait()
+
+    time_elapsed = elapsed + time.time() - since
+
+    if rank == 0:
+        with open(args.performance_csv, 'a+', newline='') as write_obj:
+            csv_writer = csv.writer(write_obj)
+            csv_writer.writerow([args.seeds, model_name, '{:.0f}m'.format(
+                time_elapsed // 60), pytorch_total_params, '{:4f}'.format(best_train_acc.cpu().numpy()),
+                                 best_train_epoch, '{:4f}'.format(best_val_acc.cpu().numpy()), best_val_epoch,
+                                 args.precision, '{:.2f}'.format(np.mean(train_throughput))])
 
     # load best model weights
-    model.load_state_dict(best_model_wts)
+    model.load_state_dict(best_weights.state_dict())
     return model
 
 
@@ -487,5 +602,16 @@ def train_model(model, criterion, optimizer, scheduler, num_epochs=50):
 model_ft = train_model(model_ft, criterion, optimizer_ft, exp_lr_scheduler,
                        num_epochs=num_epochs)
 # Save the entire model
-print("\nSaving the model...")
-torch.save(model_ft, PATH)
+if train_mode == 'transfer':
+    model_ft = full_model_ft
+elif args.distributed:
+    model_ft = model_ft.module
+if args.compile:
+    model_ft = unwrap(model_ft)
+if args.checkpoint_activations:
+    model_ft = remove_checkpointing(model_ft)
+if rank == 0:
+    print("\nSaving the model...")
+    torch.save(model_ft, PATH)
+if args.distributed:
+    dist.destroy_process_group()
@@ -17,6 +17,34 @@ def parse_args():
     parser.add_argument('--batch_size', type=int, required=False, default=12, help="Training batch size")
     parser.add_argument('--img_size', type=int, required=False, default=512, help="Image Size")
     parser.add_argument('--use_weighting', type=bool, required=False, default=False, help="use weighted cross entropy or not")
+    parser.add_argument('--batch_augmentation', action='store_true',
+                        help="keep samples uint8 in the workers and flip/normalize whole batches")
+    parser.add_argument('--autotune_loader', action='store_true',
+                        help="calibrate num_workers/prefetch_factor/persistent_workers once per host and reuse it")
+    parser.add_argument('--precision', type=str, required=False, default='fp32', choices=['fp32', 'bf16'],
+                        help="bf16 runs the forward pass and the loss under autocast, weights stay fp32")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the finished folds and continue the current one from its last checkpoint")
+    parser.add_argument('--checkpoint_every', type=int, required=False, default=1,
+                        help="epochs between two resumable checkpoints")
+    parser.add_argument('--best_weights_file', type=str, required=False, default=None,
+                        help="keep the best weights in this memory-mapped file instead of in memory")
+    parser.add_argument('--fold_workers', type=int, required=False, default=0,
+                        help="folds trained concurrently (0: one per GPU, or one per --cpus_per_fold CPUs)")
+    parser.add_argument('--cpus_per_fold', type=int, required=False, default=8,
+                        help="CPUs of a fold when the number of concurrent folds is sized to the machine")
+    parser.add_argument('--show_summary', action='store_true',
+                        help="print the model summary (cached per architecture in model_summaries/)")
+    parser.add_argument('--weight_store', type=str, required=False, default=None,
+                        help="memory-map the pretrained weights from this offline store (python -m common.weight_store)")
+    parser.add_argument('--num_workers', type=int, required=False, default=None,
+                        help="DataLoader workers (default: 32)")
+    parser.add_argument('--cache_dir', type=str, required=False, default=None,
+                        help="decode the images once into this shared cache and read them from it (disabled if not set)")
+    parser.add_argument('--use_shards', action='store_true',
+                        help="read the dataset from packed shards (common/shards.py)")
+    parser.add_argument('--use_manifest', action='store_true',
+                        help="use the images and folds of the DATA_<seed>.json manifest in the training directory")
     args = parser.parse_args()
     return args
 
@@ -54,11 +82,12 @@ from torch.utils.tensorboard import SummaryWriter
 import torch.optim as optim
 from torch.optim import lr_scheduler
 import torch.nn as nn
-from torchsummary import summary
 import time, copy
+from common.best_weights import BestWeights
+from common.batch_probe import peak_memory
+from common.startup import first_batch
+from common.model_zoo import get_spec, build_model, input_size
 import multiprocessing
-import pretrainedmodels  # for inception-v4 and xception
-from efficientnet_pytorch import EfficientNet
 
 
 num_classes = args.num_classes
@@ -68,21 +97,17 @@ num_epochs = args.epochs
 bs = args.batch_size
 img_size = args.img_size
 train_directory = args.train_directory
+# an unknown model fails here, once, instead of in every fold process
+get_spec(model_name)
 
-if not os.path.isfile('train_performance_cv.csv'):
-    with open('train_performance_cv.csv', mode='w') as csv_file:
-        fieldnames = ['Index', 'Model', 'Training Time', 'Trainable Parameters', 'Best Train Acc', 'Best Train Epoch',
-                      'Best Val Acc', 'Best Val Epoch']
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        writer.writeheader()
+# the header, or the header of a file written before the Precision and Train Images/s columns, upgraded
+from common.csv_log import ensure_header
+ensure_header('train_performance_cv.csv', ['Index', 'Model', 'Training Time', 'Trainable Parameters', 'Best Train Acc',
+                                           'Best Train Epoch', 'Best Val Acc', 'Best Val Epoch', 'Precision',
+                                           'Train Images/s'])
 
-# Set the model save path
-if args.use_weighting:
-    PATH = 'models_cv/' + model_name + "_" + str(args.seeds) + "_w" + ".pth"
-else:
-    PATH = 'models_cv/' + model_name + "_" + str(args.seeds) + ".pth"
 # Number of workers
-num_cpu = 32  # multiprocessing.cpu_count()
+num_cpu = args.num_workers or 32  # multiprocessing.cpu_count()
 
 # Applying transforms to the data
 # TODO: modify the normalization terms
@@ -100,34 +125,82 @@ image_transforms = {
         transforms.Normalize([0.485, 0.456, 0.406],
                              [0.229, 0.224, 0.225])])}
 
+# Keep the samples uint8 in the workers; flip, cast and normalize whole batches instead
+batch_transforms = {'train': None, 'valid': None}
+if args.batch_augmentation:
+    from common.batch_transforms import uint8_transforms, BatchAugment
+    image_transforms = uint8_transforms(img_size)
+    g_aug = torch.Generator()
+    g_aug.manual_seed(args.seeds)
+    batch_transforms = {'train': BatchAugment(flip=True, generator=g_aug),
+                        'valid': BatchAugment()}
+
 # Load data from folders
-dataset = datasets.ImageFolder(root=train_directory, transform=image_transforms['train'])
+if args.use_shards:
+    from common.shards import ShardDataset
+    dataset = ShardDataset(train_directory, transform=image_transforms['train'])
+elif args.use_manifest:
+    from common.manifest import ManifestDataset, manifest_path_for
+    dataset = ManifestDataset(manifest_path_for(train_directory, args.seeds), 'all', transform=image_transforms['train'])
+else:
+    dataset = datasets.ImageFolder(root=train_directory, transform=image_transforms['train'])
 # Size of train and validation data
 k_folds = 5
-kfold = KFold(n_splits=k_folds, shuffle=True)
-
-for fold, (train_idx,test_idx) in enumerate(kfold.split(dataset)):
-    if not os.path.exists('models_cv/'):
-        os.mkdir('models_cv/')
-
-    # Set the model save path
-    if args.use_weighting:
-        print(True)
-        PATH = 'models_cv/' + model_name + "_" + str(fold) + "_w" + ".pth"
-    else:
-        PATH = 'models_cv/' + model_name + "_" + str(fold) + ".pth"
+# seeded, the same folds as the global NumPy RNG seeded with args.seeds, but independent of what ran before
+kfold = KFold(n_splits=k_folds, shuffle=True, random_state=args.seeds)
+if args.use_manifest:
+    # the folds recorded by the partitioner, identical for every consumer of the manifest
+    from common.manifest import fold_indices
+    k_folds = dataset.manifest['k_folds']
+    folds = [fold_indices(dataset.manifest, dataset.rel_paths, fold) for fold in range(k_folds)]
+else:
+    folds = list(kfold.split(dataset))
+# the held-out images of every fold, for eval_cross_val.py
+from common.cv_folds import save_folds, folds_path, fold_model_path, fold_workers, run_folds
+if not os.path.exists('models_cv/'):
+    os.mkdir('models_cv/')
+save_folds(folds_path('models_cv', args.seeds), dataset, folds, args.seeds)
+# Serve the decoded images from the shared cache
+if args.cache_dir:
+    from common.image_cache import CachedImageFolder
+    dataset = CachedImageFolder(dataset, args.cache_dir, img_size)
+
+# RNG streams that must continue where they stopped when resuming
+from common.train_state import checkpoint_path, training_state, load_training_state, AsyncSaver
+generators = {'loader': g}
+if args.batch_augmentation:
+    generators['augment'] = g_aug
+
+
+def train_fold(fold, train_idx, test_idx, device, num_cpu=num_cpu):
+    """Train a fresh model on one fold, return its train_performance_cv.csv row (None if already trained)."""
+    # Set the model save path, per seed: every seed has its own split
+    PATH = fold_model_path(model_name, args.seeds, fold, args.use_weighting)
+    CKPT_PATH = checkpoint_path(PATH, 'checkpoints_cv')
+    best_weights_file = None
+    if args.best_weights_file:
+        root, ext = os.path.splitext(args.best_weights_file)
+        best_weights_file = '{}_fold{}{}'.format(root, fold, ext)
+
+    if args.resume and os.path.isfile(PATH) and os.path.isfile(CKPT_PATH):
+        state = torch.load(CKPT_PATH, map_location='cpu', weights_only=False)
+        if state['epoch'] == num_epochs:
+            print('Fold {} already trained, skipping'.format(fold))
+            return None
+
+    # every fold starts from its own seed, whichever folds ran before it and in whichever process
+    fold_seed = args.seeds * k_folds + fold
+    torch.manual_seed(fold_seed)
+    torch.cuda.manual_seed_all(fold_seed)
+    random.seed(fold_seed)
+    np.random.seed(fold_seed)
+    for gen in generators.values():
+        gen.manual_seed(fold_seed)
 
     print('------------fold no---------{}----------------------'.format(fold))
     train_subsampler = torch.utils.data.SubsetRandomSampler(train_idx)
     test_subsampler = torch.utils.data.SubsetRandomSampler(test_idx)
 
-    # Create iterators for data loading
-    dataloaders = {
-        'train': data.DataLoader(dataset, batch_size=bs, num_workers=num_cpu, pin_memory=True, drop_last=True,
-                                 worker_init_fn=seed_worker, generator=g, sampler=train_subsampler),
-        'valid': data.DataLoader(dataset, batch_size=bs, num_workers=num_cpu, pin_memory=True, drop_last=True,
-                                 worker_init_fn=seed_worker, generator=g, sampler=test_subsampler)}
-
     # Class names or target labels
     class_names = dataset.classes
     print("Classes:", class_names)
@@ -135,138 +208,18 @@ for fold, (train_idx,test_idx) in enumerate(kfold.split(dataset)):
     print("\nLoading pretrained-model for finetuning ...\n")
     model_ft = None
 
-    if model_name == 'resnet18':
-        # Modify fc layers to match num_classes
-        model_ft = models.resnet18(pretrained=True)
-        num_ftrs = model_ft.fc.in_features
-        model_ft.fc = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'resnet50':
-        # Modify fc layers to match num_classes
-        model_ft = models.resnet50(pretrained=True)
-        num_ftrs = model_ft.fc.in_features
-        model_ft.fc = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'resnet101':
-        # Modify fc layers to match num_classes
-        model_ft = models.resnet101(pretrained=True)
-        num_ftrs = model_ft.fc.in_features
-        model_ft.fc = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'alexnet':
-        model_ft = models.alexnet(pretrained=True)
-        model_ft.classifier[6] = nn.Linear(4096, num_classes)
-    elif model_name == 'vgg11':
-        model_ft = models.vgg11(pretrained=True)
-        model_ft.classifier[6] = nn.Linear(4096, num_classes)
-    elif model_name == 'vgg16':
-        model_ft = models.vgg16(pretrained=True)
-        model_ft.classifier[6] = nn.Linear(4096, num_classes)
-    elif model_name == 'vgg19':
-        model_ft = models.vgg19(pretrained=True)
-        model_ft.classifier[6] = nn.Linear(4096, num_classes)
-    elif model_name == 'squeezenet':
-        model_ft = models.squeezenet1_0(pretrained=True)
-        model_ft.classifier[1] = nn.Conv2d(512, num_classes, kernel_size=(1, 1), stride=(1, 1))
-    elif model_name == 'densenet121':
-        model_ft = models.densenet121(pretrained=True)
-        num_ftrs = model_ft.classifier.in_features
-        model_ft.classifier = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'densenet169':
-        model_ft = models.densenet169(pretrained=True)
-        num_ftrs = model_ft.classifier.in_features
-        model_ft.classifier = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'densenet161':
-        model_ft = models.densenet161(pretrained=True)
-        num_ftrs = model_ft.classifier.in_features
-        model_ft.classifier = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'inception':
-        model_ft = models.inception_v3(pretrained=True)
-        model_ft.aux_logits = False
-        # Handle the auxilary net
-        num_ftrs = model_ft.AuxLogits.fc.in_features
-        model_ft.AuxLogits.fc = nn.Linear(num_ftrs, num_classes)
-        # Handle the primary net
-        num_ftrs = model_ft.fc.in_features
-        model_ft.fc = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'inceptionv4':
-        model_ft = pretrainedmodels.inceptionv4(pretrained='imagenet')
-        num_ftrs = model_ft.last_linear.in_features
-        model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'googlenet':
-        model_ft = models.googlenet(pretrained=True)
-        num_ftrs = model_ft.fc.in_features
-        model_ft.fc = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'xception':
-        model_ft = pretrainedmodels.xception(pretrained='imagenet')
-        num_ftrs = model_ft.last_linear.in_features
-        model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'mobilenet_v2':
-        model_ft = models.mobilenet_v2(pretrained=True)
-        model_ft.classifier[1] = nn.Linear(model_ft.last_channel, num_classes)
-    elif model_name == 'mobilenet_v3_small':
-        model_ft = models.mobilenet_v3_small(pretrained=True)
-        model_ft.classifier[3] = nn.Linear(model_ft.classifier[3].in_features, num_classes)
-    elif model_name == 'mobilenet_v3_large':
-        model_ft = models.mobilenet_v3_large(pretrained=True)
-        model_ft.classifier[3] = nn.Linear(model_ft.classifier[3].in_features, num_classes)
-    elif model_name == 'shufflenet_v2_x0_5':
-        model_ft = models.shufflenet_v2_x0_5(pretrained=True)
-        num_ftrs = model_ft.fc.in_features
-        model_ft.fc = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'shufflenet_v2_x1_0':
-        model_ft = models.shufflenet_v2_x1_0(pretrained=True)
-        num_ftrs = model_ft.fc.in_features
-        model_ft.fc = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'inceptionresnetv2':
-        model_ft = pretrainedmodels.inceptionresnetv2(pretrained='imagenet')
-        num_ftrs = model_ft.last_linear.in_features
-        model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'nasnetamobile':
-        model_ft = pretrainedmodels.nasnetamobile(num_classes=1000, pretrained='imagenet')
-        num_ftrs = model_ft.last_linear.in_features
-        model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'dpn68':
-        model_ft = pretrainedmodels.dpn68(pretrained='imagenet')
-        model_ft.last_linear = nn.Conv2d(832, num_classes, kernel_size=(1, 1), stride=(1, 1))
-    elif model_name == 'polynet':
-        model_ft = pretrainedmodels.polynet(num_classes=1000, pretrained='imagenet')
-        num_ftrs = model_ft.last_linear.in_features
-        model_ft.last_linear = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'mnasnet1_0':
-        model_ft = models.mnasnet1_0(pretrained=True)
-        num_ftrs = model_ft.classifier[1].in_features
-        model_ft.classifier[1] = nn.Linear(num_ftrs, num_classes)
-    elif model_name == 'efficientnet-b0':
-        model_ft = EfficientNet.from_pretrained('efficientnet-b0', num_classes=num_classes)
-    elif model_name == 'efficientnet-b1':
-        model_ft = EfficientNet.from_pretrained('efficientnet-b1', num_classes=num_classes)
-    elif model_name == 'efficientnet-b2':
-        model_ft = EfficientNet.from_pretrained('efficientnet-b2', num_classes=num_classes)
-    elif model_name == 'efficientnet-b3':
-        model_ft = EfficientNet.from_pretrained('efficientnet-b3', num_classes=num_classes)
-    elif model_name == 'efficientnet-b4':
-        model_ft = EfficientNet.from_pretrained('efficientnet-b4', num_classes=num_classes)
-    elif model_name == 'efficientnet-b5':
-        model_ft = EfficientNet.from_pretrained('efficientnet-b5', num_classes=num_classes)
-    elif model_name == 'efficientnet-b6':
-        model_ft = EfficientNet.from_pretrained('efficientnet-b6', num_classes=num_classes)
-    else:
-        print("Invalid model name, exiting...")
-        exit()
+    weight_store = None
+    if args.weight_store:
+        from common.weight_store import WeightStore
+        weight_store = WeightStore(args.weight_store)
+    model_ft = build_model(model_name, num_classes, weight_store)
 
-    # Set default device as gpu, if available
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     model_ft = model_ft.to(device)
 
-    # Print model summary
-    print('Model Summary:-\n')
-    for num, (name, param) in enumerate(model_ft.named_parameters()):
-        print(num, name, param.requires_grad)
-    if model_name == 'inception':
-        summary(model_ft, input_size=(3, 299, 299))
-    elif model_name == 'densenet121' or 'densenet161':
-        pass
-    else:
-        summary(model_ft, input_size=(3, img_size, img_size))
-    print(model_ft)
+    # Print model summary, computed once per architecture and cached in model_summaries/
+    if args.show_summary:
+        from common.model_summary import model_summary
+        print(model_summary(model_ft, model_name, num_classes, input_size(model_name, img_size), device))
 
     # for class unbalance
     if args.use_weighting:
@@ -290,25 +243,61 @@ for fold, (train_idx,test_idx) in enumerate(kfold.split(dataset)):
     # Learning rate decay
     exp_lr_scheduler = lr_scheduler.StepLR(optimizer_ft, step_size=10, gamma=0.1)
 
+    # DataLoader settings, calibrated for this machine, model and batch size if asked
+    loader_kwargs = {'num_workers': num_cpu}
+    if args.autotune_loader:
+        from common.loader_tune import autotune_loader, train_step_fn, tune_key
+        loader_kwargs = autotune_loader(data.Subset(dataset, train_idx), bs,
+                                        train_step_fn(model_ft, criterion, device, batch_transforms['train']),
+                                        tune_key(model_name, img_size, bs, args=args), model=model_ft, worker_init_fn=seed_worker,
+                                        persistent=False)
+
+    # Create iterators for data loading
+    dataloaders = {
+        'train': data.DataLoader(dataset, batch_size=bs, pin_memory=True, drop_last=True,
+                                 worker_init_fn=seed_worker, generator=g, sampler=train_subsampler, **loader_kwargs),
+        'valid': data.DataLoader(dataset, batch_size=bs, pin_memory=True, drop_last=True,
+                                 worker_init_fn=seed_worker, generator=g, sampler=test_subsampler, **loader_kwargs)}
+
     # Model training routine
     print("\nTraining:-\n")
 
     def train_model(model, criterion, optimizer, scheduler, num_epochs=50):
         since = time.time()
 
-        best_model_wts = copy.deepcopy(model.state_dict())
+        # one preallocated copy of the best weights, updated in place on every improvement
+        best_weights = BestWeights(model, best_weights_file)
         best_train_acc = 0.0
         best_train_epoch = 0
         best_val_epoch = 0
         best_val_acc = 0.0
+        use_bf16 = args.precision == 'bf16'
+        train_throughput = []
 
         if args.use_weighting:
             # Tensorboard summary
-            writer = SummaryWriter(log_dir=('./runs_cv/' + model_name + '_w' + '/' + str(fold)))
+            writer = SummaryWriter(log_dir=('./runs_cv/' + model_name + '_w' + '/' + str(args.seeds) + '_' + str(fold)))
         else:
-            writer = SummaryWriter(log_dir=('./runs_cv/' + model_name + '/' + str(fold)))
-
-        for epoch in range(num_epochs):
+            writer = SummaryWriter(log_dir=('./runs_cv/' + model_name + '/' + str(args.seeds) + '_' + str(fold)))
+
+        saver = AsyncSaver()
+        start_epoch, elapsed = 0, 0.0
+        resume_state = torch.load(CKPT_PATH, map_location='cpu', weights_only=False) \
+            if args.resume and os.path.isfile(CKPT_PATH) else None
+        if resume_state is not None and resume_state['epoch'] > num_epochs:
+            # a run with a larger budget is not a prefix of this one
+            print('{} is at epoch {}, past the {} epochs of this run: training fold {} from scratch'.format(
+                CKPT_PATH, resume_state['epoch'], num_epochs, fold))
+            resume_state = None
+        if resume_state is not None:
+            start_epoch, best = load_training_state(resume_state, model, optimizer, scheduler, generators, device)
+            best_weights.load_state_dict(best['best_model_wts'])
+            best_train_acc, best_train_epoch = best['best_train_acc'], best['best_train_epoch']
+            best_val_acc, best_val_epoch = best['best_val_acc'], best['best_val_epoch']
+            train_throughput, elapsed = best['train_throughput'], best['elapsed']
+            print('Resuming fold {} from {} at epoch {}'.format(fold, CKPT_PATH, start_epoch))
+
+        for epoch in range(start_epoch, num_epochs):
             print('Epoch {}/{}'.format(epoch, num_epochs - 1))
             print('-' * 10)
 
@@ -321,20 +310,27 @@ for fold, (train_idx,test_idx) in enumerate(kfold.split(dataset)):
 
                 running_loss = 0.0
                 running_corrects = 0
+                num_images = 0
+                phase_since = time.time()
 
                 # Iterate over data.
                 for idx, (inputs, labels) in enumerate(dataloaders[phase]):
+                    first_batch(model_name)
                     inputs = inputs.to(device, non_blocking=True)
                     labels = labels.to(device, non_blocking=True)
+                    if batch_transforms[phase] is not None:
+                        inputs = batch_transforms[phase](inputs)
 
                     # zero the parameter gradients
                     optimizer.zero_grad()
 
                     # forward, track history if only in train
                     with torch.set_grad_enabled(phase == 'train'):
-                        outputs = model(inputs)
+                        # bf16 autocast for the forward and the loss only, the master weights stay fp32
+                        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                            outputs = model(inputs)
+                            loss = criterion(outputs, labels)
                         _, preds = torch.max(outputs, 1)
-                        loss = criterion(outputs, labels)
 
                         # backward + optimize only if in training phase
                         if phase == 'train':
@@ -344,19 +340,23 @@ for fold, (train_idx,test_idx) in enumerate(kfold.split(dataset)):
                     # statistics
                     running_loss += loss.item() * inputs.size(0)
                     running_corrects += torch.sum(preds == labels.data)
+                    num_images += inputs.size(0)
                 if phase == 'train':
                     scheduler.step()
+                images_per_sec = num_images / (time.time() - phase_since)
 
                 epoch_loss = running_loss / ((idx + 1) * bs)
                 epoch_acc = running_corrects.double() / ((idx + 1) * bs)
 
-                print('{} Loss: {:.4f} Acc: {:.4f}'.format(
-                    phase, epoch_loss, epoch_acc * 100))
+                print('{} Loss: {:.4f} Acc: {:.4f} ({:.1f} images/s)'.format(
+                    phase, epoch_loss, epoch_acc * 100, images_per_sec))
 
                 # Record training loss and accuracy for each phase
                 if phase == 'train':
                     writer.add_scalar('Train/Loss', epoch_loss, epoch)
                     writer.add_scalar('Train/Accuracy', epoch_acc * 100, epoch)
+                    writer.add_scalar('Train/Throughput', images_per_sec, epoch)
+                    train_throughput.append(images_per_sec)
                     writer.flush()
                     if epoch_acc > best_train_acc:
                         best_train_acc = epoch_acc
@@ -366,28 +366,52 @@ for fold, (train_idx,test_idx) in enumerate(kfold.split(dataset)):
                     writer.add_scalar('Valid/Accuracy', epoch_acc * 100, epoch)
                     writer.flush()
 
-                # deep copy the model
+                # keep a copy of the best weights
                 if phase == 'valid' and epoch_acc > best_val_acc:
                     best_val_acc = epoch_acc
-                    best_model_wts = copy.deepcopy(model.state_dict())
+                    copy_time = best_weights.update(model)
                     best_val_epoch = epoch
+                    print('Best weights ({:.0f} MB) updated in {:.1f} ms, peak memory {:.2f} GB'.format(
+                        best_weights.nbytes / 2 ** 20, copy_time * 1000, peak_memory(device) / 2 ** 30))
             print()
 
-        time_elapsed = time.time() - since
+            # snapshot to host memory now, written to disk while the next epoch runs
+            if (epoch + 1) % args.checkpoint_every == 0 or epoch + 1 == num_epochs:
+                saver.save(training_state(model, optimizer, scheduler, epoch + 1, generators,
+                                          best_model_wts=best_weights.state_dict(), best_train_acc=best_train_acc,
+                                          best_train_epoch=best_train_epoch, best_val_acc=best_val_acc,
+                                          best_val_epoch=best_val_epoch, train_throughput=train_throughput,
+                                          elapsed=elapsed + time.time() - since), CKPT_PATH)
+        saver.wait()
+
+        time_elapsed = elapsed + time.time() - since
 
-        with open('train_performance_cv.csv', 'a+', newline='') as write_obj:
-            csv_writer = csv.writer(write_obj)
-            csv_writer.writerow([fold, model_name, '{:.0f}m'.format(
-                time_elapsed // 60), pytorch_total_params, '{:4f}'.format(best_train_acc.cpu().numpy() * 100),
-                                 best_train_epoch, '{:4f}'.format(best_val_acc.cpu().numpy()  * 100), best_val_epoch])
+        row = [fold, model_name, '{:.0f}m'.format(
+            time_elapsed // 60), pytorch_total_params, '{:4f}'.format(best_train_acc.cpu().numpy() * 100),
+               best_train_epoch, '{:4f}'.format(best_val_acc.cpu().numpy() * 100), best_val_epoch,
+               args.precision, '{:.2f}'.format(np.mean(train_throughput))]
 
         # load best model weights
-        model.load_state_dict(best_model_wts)
-        return model
+        model.load_state_dict(best_weights.state_dict())
+        return model, row
 
     # Train the model
-    model_ft = train_model(model_ft, criterion, optimizer_ft, exp_lr_scheduler,
-                           num_epochs=num_epochs)
+    model_ft, row = train_model(model_ft, criterion, optimizer_ft, exp_lr_scheduler,
+                                num_epochs=num_epochs)
     # Save the entire model
     print("\nSaving the model...")
     torch.save(model_ft, PATH)
+    return row
+
+
+# Train the folds, concurrently if the machine has room for several, and merge their rows in fold order
+workers = args.fold_workers or fold_workers(k_folds, args.cpus_per_fold)
+log_prefix = os.path.join('logs_cv', '{}_{}{}'.format(model_name, args.seeds, '_w' if args.use_weighting else ''))
+rows, failed = run_folds(train_fold, folds, workers, log_prefix, default_workers=num_cpu)
+with open('train_performance_cv.csv', 'a+', newline='') as write_obj:
+    csv_writer = csv.writer(write_obj)
+    for row in rows:
+        csv_writer.writerow(row)
+if failed:
+    print('Folds {} failed, see {}_fold<k>.log'.format(', '.join(str(f) for f in failed), log_prefix))
+    exit(1)
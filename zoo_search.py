@@ -0,0 +1,131 @@
+"""
+Successive-halving search over the model zoo.
+
+    python zoo_search.py --models resnet18 resnet50 densenet121 ... --seeds 0 --min_epochs 2 --max_epochs 50 --eta 3
+
+Every candidate is trained with train_1.py for --min_epochs epochs. The best
+1/eta of them by validation accuracy (averaged over the seeds) survive and are
+trained further, to eta times the budget, and so on until the survivors reach
+--max_epochs. A survivor is not retrained from scratch: train_1.py --resume
+continues from the checkpoint of its previous round, so the learning-rate
+schedule and the data order are exactly those of a full run. A checkpoint
+already past the budget of a round (left in --output_dir by an earlier search
+with a larger budget) is discarded and the job trains from scratch, so the
+results of a round are always those of its own budget. The jobs of a round
+run concurrently through run_scripts/sweep.py.
+
+Everything the search writes goes to --output_dir: the models, the
+checkpoints, rounds.csv (one train_performance.csv row per job) and
+zoo_ranking.csv, the final ranking in the format of train_performance.csv.
+"""
+import os
+import csv
+import sys
+import math
+import argparse
+
+from run_scripts.sweep import Job, Sweep, MODELS
+
+FIELDNAMES = ['Index', 'Model', 'Training Time', 'Trainable Parameters', 'Best Train Acc', 'Best Train Epoch',
+              'Best Val Acc', 'Best Val Epoch', 'Precision', 'Train Images/s']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Successive-halving search over the CottonWeed model zoo')
+    parser.add_argument('--models', type=str, nargs='+', required=False, default=MODELS, help="candidate models")
+    parser.add_argument('--seeds', type=int, nargs='+', required=False, default=[0],
+                        help="seeds every candidate is trained on, the accuracy is averaged over them")
+    parser.add_argument('--min_epochs', type=int, required=False, default=2, help="budget of the first round")
+    parser.add_argument('--max_epochs', type=int, required=False, default=50, help="budget of the last round")
+    parser.add_argument('--eta', type=int, required=False, default=3,
+                        help="keep 1/eta of the candidates and multiply the budget by eta every round")
+    parser.add_argument('--use_weighting', action='store_true', help="use weighted cross entropy")
+    parser.add_argument('--output_dir', type=str, required=False, default='zoo_search', help="search outputs")
+    parser.add_argument('--max_cpus', type=int, required=False, default=os.cpu_count(),
+                        help="CPUs the concurrent jobs may use")
+    parser.add_argument('--memory_fraction', type=float, required=False, default=0.9,
+                        help="fraction of the machine memory the concurrent jobs may use")
+    parser.add_argument('--default_cpus', type=int, required=False, default=8,
+                        help="CPUs given to a model whose footprint has not been measured yet")
+    parser.add_argument('--min_cpus', type=int, required=False, default=2,
+                        help="fewest CPUs reserved for a job, whatever its measured footprint")
+    parser.add_argument('--default_memory_gb', type=float, required=False, default=8.0,
+                        help="memory assumed for a model whose footprint has not been measured yet")
+    parser.add_argument('--retries', type=int, required=False, default=1, help="retries of a failed job")
+    parser.add_argument('script_args', nargs=argparse.REMAINDER,
+                        help="arguments passed to every train_1.py job after --, e.g. -- --precision bf16")
+    args = parser.parse_args()
+    if args.script_args and args.script_args[0] == '--':
+        args.script_args = args.script_args[1:]
+    args.log_dir = os.path.join(args.output_dir, 'logs')
+    return args
+
+
+def budgets(min_epochs, max_epochs, eta):
+    """Epochs of each round: min_epochs * eta^r, the last one max_epochs."""
+    epochs = [min_epochs]
+    while epochs[-1] < max_epochs:
+        epochs.append(min(epochs[-1] * eta, max_epochs))
+    return epochs
+
+
+def last_rows(rounds_csv):
+    """Last result row of every (seed, model) in the rounds file."""
+    rows = {}
+    if os.path.isfile(rounds_csv):
+        with open(rounds_csv, newline='') as f:
+            for row in csv.DictReader(f):
+                rows[(int(row['Index']), row['Model'])] = row
+    return rows
+
+
+def main():
+    args = parse_args()
+    if not os.path.exists(args.log_dir):
+        os.makedirs(args.log_dir)
+    rounds_csv = os.path.join(args.output_dir, 'rounds.csv')
+    job_args = args.script_args + ['--resume', '--performance_csv', rounds_csv,
+                                   '--model_dir', os.path.join(args.output_dir, 'models'),
+                                   '--checkpoint_dir', os.path.join(args.output_dir, 'checkpoints')]
+
+    candidates = list(args.models)
+    reached = {}  # model -> last round it was trained in
+    schedule = budgets(args.min_epochs, args.max_epochs, args.eta)
+    for r, epochs in enumerate(schedule):
+        print('Round {}: {} candidates, {} epochs'.format(r, len(candidates), epochs))
+        jobs = [Job('train_1.py', model_name, seed, args.use_weighting, job_args + ['--epochs', str(epochs)])
+                for model_name in candidates for seed in args.seeds]
+        sweep = Sweep(jobs, args)
+        sweep.run()
+        failed = set(job.model_name for job in sweep.failed)
+
+        rows = last_rows(rounds_csv)
+        scores = {}
+        for model_name in candidates:
+            if model_name in failed:
+                print('{} failed in round {}, dropped'.format(model_name, r))
+                continue
+            scores[model_name] = sum(float(rows[(seed, model_name)]['Best Val Acc']) for seed in args.seeds) / \
+                len(args.seeds)
+            reached[model_name] = r
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        for model_name in ranked:
+            print('  {:24s} {:.4f}'.format(model_name, scores[model_name]))
+        if r + 1 < len(schedule):
+            candidates = ranked[:max(1, int(math.ceil(len(ranked) / args.eta)))]
+
+    # ranking: furthest round first, then validation accuracy
+    rows = last_rows(rounds_csv)
+    ranking = sorted(reached, key=lambda m: (reached[m], sum(float(rows[(s, m)]['Best Val Acc'])
+                                                             for s in args.seeds)), reverse=True)
+    with open(os.path.join(args.output_dir, 'zoo_ranking.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+        writer.writeheader()
+        for model_name in ranking:
+            for seed in args.seeds:
+                writer.writerow({k: rows[(seed, model_name)][k] for k in FIELDNAMES})
+    print('Ranking written to {}'.format(os.path.join(args.output_dir, 'zoo_ranking.csv')))
+
+
+if __name__ == '__main__':
+    sys.exit(main())